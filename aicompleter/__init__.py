@@ -28,6 +28,7 @@ from .utils import (
 from .config import (
     Config,
     ConfigModel,
+    LayeredConfig,
 )
 
 from .handler import (
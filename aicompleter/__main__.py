@@ -39,6 +39,7 @@ parser.add_argument('--load-history', action='store_true', help='Load history wi
 parser.add_argument('--save-history', action='store_true', help='Save history without asking for user. This is priorer than --disable-history', dest='save_history')
 parser.add_argument('--disable-history', action='store_true', help='Disable history', dest='disable_history')
 parser.add_argument('--enable-memory', action='store_true', help='Enable memory', dest='enable_memory')
+parser.add_argument('--queue-log', action='store_true', help='Write the logs in a background thread, with a rotating log file', dest='queue_log')
 # parser.add_argument('--disable-faiss', action='store_true', help='Disable faiss', dest='disable_faiss')
 subparsers = parser.add_subparsers(dest='subcommand', help='subcommands', description='subcommands, including:\n\ttalk: Talk with the AI\n\thelper: The helper of AI Completer, this will launcher a AI assistant to help you solve the problem')
 subparsers.required = True
@@ -56,6 +57,8 @@ helper_pareser.add_argument('--disable-authority', action='store_true', help='Di
 args = parser.parse_args()
 if args.debug:
     __DEBUG__ = True
+if args.queue_log:
+    log.enable_queue()
 
 if not os.path.exists(args.config):
     logger.info("config.json Not Found. Use default config.")
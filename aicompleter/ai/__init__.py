@@ -10,6 +10,7 @@ from .ai import (
     Transformer,
     Message,
     Conversation,
+    MessageList,
     ChatTransformer,
     TextTransformer,
     Function,
@@ -34,6 +35,13 @@ from .interface import (
 from . import (
     prompts,
     agent,
+    cache,
+)
+
+from .cache import (
+    ResponseCache,
+    CachedChatTransformer,
+    CachedTextTransformer,
 )
 
 from .agent import (
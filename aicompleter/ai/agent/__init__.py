@@ -6,10 +6,12 @@ This module will enable you to create a AI agent to automaticly self-yield the m
 from .agent import Agent
 from .reagent import Agent as ReAgent
 from .interface import AgentInterface, ReAgentInterface
+from .executor import CommandExecutor
 
 __all__ = (
     'Agent',
     'AgentInterface',
+    'CommandExecutor',
     'ReAgent',
     'ReAgentInterface'
 )
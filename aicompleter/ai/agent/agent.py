@@ -1,17 +1,17 @@
 import asyncio
-import copy
 import json
 import traceback
 from typing import Any, Callable, Coroutine, NoReturn, Optional, Self, Union, overload
 from ... import *
 from ... import events
 from .. import ChatTransformer
+from .executor import CommandExecutor
 
 class Agent(common.AsyncLifeTimeManager):
     '''
     AI Agent
     '''
-    def __init__(self, chatai: ChatTransformer, init_prompt:Optional[str] = None, user:Optional[str] = None, loop:Optional[asyncio.AbstractEventLoop] = None):
+    def __init__(self, chatai: ChatTransformer, init_prompt:Optional[str] = None, user:Optional[str] = None, loop:Optional[asyncio.AbstractEventLoop] = None, max_wait:float = 0.1, max_concurrency:Optional[int] = 4):
         super().__init__()
         self.ai = chatai
         self._init_prompt = init_prompt
@@ -29,7 +29,16 @@ class Agent(common.AsyncLifeTimeManager):
         '''Enable the ask command'''
 
         self._result_queue: asyncio.Queue[interface.Result] = asyncio.Queue()
-        self._request_queue: asyncio.Queue[ai.Message | None] = asyncio.Queue()
+        self._request_queue: utils.CoalescingQueue[ai.Message | None] = utils.CoalescingQueue(max_wait=max_wait)
+        '''
+        The request queue, the requests are sent to the AI in batches, 
+        the running commands are waited for at most `max_wait` seconds
+        '''
+        self._executor = CommandExecutor(lambda cmd, param: self.on_call(cmd, param), max_concurrency)
+        '''
+        The executor of the commands, the independent commands of a response are run in parallel,
+        at most `max_concurrency` commands are run at the same time
+        '''
         self._handle_task = loop.create_task(self._handle_result())
         self._loop_task = loop.create_task(self._handle_loop())
         self._result = ...
@@ -73,12 +82,12 @@ class Agent(common.AsyncLifeTimeManager):
         '''
         Create a subagent
         '''
-        self._subagents[name] = Agent(ai or self.ai, init_prompt or self._init_prompt, user, self._loop)
+        self._subagents[name] = Agent(ai or self.ai, init_prompt or self._init_prompt, user, self._loop, self._request_queue.max_wait, self._executor.max_concurrency)
         self._subagents[name].on_call = self.on_call
         self._subagents[name]._parent = self
         self._subagents[name]._parent_name = name
         self._subagents[name].ask(init_words)
-        self.logger.debug(f'Create subagent {name}')
+        self.logger.debug('Create subagent %s', name)
         return self._subagents[name]
 
     def _request(self, value:dict, role:str = 'system'):
@@ -152,27 +161,19 @@ class Agent(common.AsyncLifeTimeManager):
         exception = None
         try:
             while not stop_flag:
-                await asyncio.sleep(0.1)
-                # Get all the requests
-
-                request:ai.Message = await self._request_queue.get()
-                # Wait for other command output
-                await asyncio.sleep(0.1)
-
-                requests = [request]
-                while not self._request_queue.empty():
-                    requests.append(self._request_queue.get_nowait())
+                # Get all the requests, with the output of the running commands
+                requests = await self._request_queue.get_batch()
 
                 # Remove None
                 requests = [i for i in requests if i is not None]
                 if len(requests) == 0:
                     self.logger.debug('Empty request')
                 else:
-                    self.logger.debug(f'Get requests: {requests}')
+                    self.logger.debug('Get requests: %s', log.LazyRepr(requests))
 
-                _new_conversation = copy.deepcopy(self.conversation)
-                for request in requests:
-                    _new_conversation.messages.append(request)
+                # The conversation is kept unchanged if the generation failed
+                _new_conversation = self.conversation.fork()
+                _new_conversation.messages.extend(requests)
                 raw = await self.ai.generate_text(conversation=_new_conversation)
                 # Success
                 _new_conversation.messages.append(ai.Message(
@@ -181,14 +182,11 @@ class Agent(common.AsyncLifeTimeManager):
                 ))
                 self.conversation = _new_conversation
 
-                self.logger.debug(f'AI response: {raw}')
+                self.logger.debug('AI response: %s', raw)
                 if raw == '':
                     # Self call ask command, do not input anything
                     raw = '{"commands":[{"cmd":"ask","param":{"content":""}}]}'
 
-                # try to replace the variables
-                raw = raw.replace('$last_result', str(self._last_result) or '')
-
                 try:
                     json_dat = self._parse(raw)
                 except ValueError as e:
@@ -211,13 +209,15 @@ class Agent(common.AsyncLifeTimeManager):
                     continue
 
                 # Execute the commands
+                calls:list[tuple[str, Any]] = []
                 for cmd in json_dat:
                     if cmd['cmd'] == 'stop':
                         stop_flag = True
                         self._result = cmd.pop('param', None)
                         if self._parent:
                             self._parent._subagents.pop(self._parent_name)
-                        continue
+                        # The commands after stop are ignored
+                        break
                     if cmd['cmd'] == 'agent':
                         # Create a subagent
                         if not all(i in cmd['param'] for i in ('name', 'task')):
@@ -225,10 +225,12 @@ class Agent(common.AsyncLifeTimeManager):
                                 'type':'error',
                                 'value':f"Paremeters 'name' and 'word' are required"
                             })
+                            continue
+                        task = CommandExecutor.substitute(cmd['param']['task'], self._last_result)
                         if cmd['param']['name'] in self._subagents:
-                            self._subagents[cmd['param']['name']].ask(cmd['param']['task'])
+                            self._subagents[cmd['param']['name']].ask(task)
                             continue
-                        ret = self.on_subagent(cmd['param']['name'], cmd['param']['task'])
+                        ret = self.on_subagent(cmd['param']['name'], task)
                         if asyncio.iscoroutine(ret):
                             await ret
                         continue
@@ -241,33 +243,27 @@ class Agent(common.AsyncLifeTimeManager):
                             continue
                         # This command will be hooked if the agent is a subagent
                         if self._parent:
-                            self._parent._subagent_ask(self._parent_name, cmd['param'])
-                            await asyncio.sleep(0.1)
+                            self._parent._subagent_ask(self._parent_name, CommandExecutor.substitute(cmd['param'], self._last_result))
                             continue
-                    
-                    def wrap_context():
-                        curcmd = cmd
-                        def when_result(x: asyncio.Future):
-                            try:
-                                ret = x.result()
-                            except asyncio.CancelledError:
-                                return
-                            except Exception as e:
-                                # Unpack Exception, remove the interface & session (to reduce the lenght of the message)
-                                if isinstance(e, error.BaseException):
-                                    e.kwargs.pop('interface', None)
-                                    e.kwargs.pop('handler', None)
-                                    e.kwargs.pop('session', None)
-                                    e.parent = None
-                                self._result_queue.put_nowait(interface.Result(curcmd['cmd'], False, str(e)))
-                                self.logger.error(f'Exception when executing command {curcmd["cmd"]}: {e}')
-                            else:
-                                self._result_queue.put_nowait(interface.Result(curcmd['cmd'], True, ret))
-                                self.logger.info(f'Command {curcmd["cmd"]} executed successfully, Result: {ret}')
-                        self._loop.create_task(self.on_call(curcmd['cmd'], curcmd['param'])).add_done_callback(when_result)
-
-                    wrap_context()
-            
+                    calls.append((cmd['cmd'], cmd['param']))
+
+                if calls:
+                    try:
+                        tasks = self._executor.submit(calls, self._last_result)
+                    except ValueError as e:
+                        self._request({
+                            'type':'error',
+                            'value':str(e),
+                        })
+                        continue
+                    for _ in tasks:
+                        # The result will be requested by _handle_result, which releases the queue
+                        self._request_queue.hold()
+                    self._loop.create_task(self._report_results(calls, tasks))
+                    if stop_flag:
+                        # The commands before stop are run before the agent stops
+                        await asyncio.wait(tasks)
+
         except asyncio.CancelledError as e:
             exception = e
         except Exception as e:
@@ -278,6 +274,7 @@ class Agent(common.AsyncLifeTimeManager):
         finally:
             # The loop is done
             self.logger.debug('The agent is stopped')
+            self._executor.cancel()
             self._loop.create_task(self.close())
             if exception is not None:
                 if isinstance(exception, asyncio.CancelledError):
@@ -287,20 +284,48 @@ class Agent(common.AsyncLifeTimeManager):
             
         self.logger.debug('The loop is done')
 
+    async def _report_results(self, calls:list[tuple[str, Any]], tasks:list[asyncio.Task]) -> None:
+        '''
+        Report the results of the commands in order
+        '''
+        for (cmd, _), task in zip(calls, tasks):
+            try:
+                ret = await task
+            except asyncio.CancelledError:
+                if not task.cancelled():
+                    raise
+                self._request_queue.release()
+                continue
+            except Exception as e:
+                # Unpack Exception, remove the interface & session (to reduce the lenght of the message)
+                if isinstance(e, error.BaseException):
+                    e.kwargs.pop('interface', None)
+                    e.kwargs.pop('handler', None)
+                    e.kwargs.pop('session', None)
+                    e.parent = None
+                self._result_queue.put_nowait(interface.Result(cmd, False, str(e)))
+                self.logger.error('Exception when executing command %s: %s', cmd, e)
+            else:
+                self._result_queue.put_nowait(interface.Result(cmd, True, ret))
+                self.logger.info('Command %s executed successfully, Result: %s', cmd, ret)
+
     async def _handle_result(self) -> Coroutine[None, None, NoReturn]:
         while True:
             result = await self._result_queue.get()
-            if result.cmd == 'ask':
-                # Excpetion
-                self.ask(result.ret)
-                continue
+            try:
+                if result.cmd == 'ask':
+                    # Excpetion
+                    self.ask(result.ret)
+                    continue
 
-            self._last_result = result.ret
-            self._request({
-                'type':'command-result',
-                'success': result.success,
-                'result': result.ret,
-            })
+                self._last_result = result.ret
+                self._request({
+                    'type':'command-result',
+                    'success': result.success,
+                    'result': result.ret,
+                })
+            finally:
+                self._request_queue.release()
 
     def ask(self, value:str):
         '''
@@ -324,7 +349,7 @@ class Agent(common.AsyncLifeTimeManager):
         '''
         Ask the agent to execute a command
         '''
-        self.logger.debug(f'The subagent[{name}] ask: {value}')
+        self.logger.debug('The subagent[%s] ask: %s', name, value)
         self._request({
             'type':'ask-from-subagent',
             'name': name,
@@ -146,7 +146,7 @@ class AgentF:
         self._subagents[name]._parent = self
         self._subagents[name]._parent_name = name
         self._subagents[name].ask(init_words)
-        self.logger.debug(f'Create subagent {name}')
+        self.logger.debug('Create subagent %s', name)
         return self._subagents[name]
 
     def _request(self, value:dict, role:str = 'system'):
@@ -174,7 +174,7 @@ class AgentF:
                 while not self._request_queue.empty():
                     requests.append(self._request_queue.get_nowait())
 
-                self.logger.debug(f'Get requests: {requests}')
+                self.logger.debug('Get requests: %s', log.LazyRepr(requests))
 
                 def _try_parse(x:Any):
                     if not isinstance(x, str):
@@ -205,7 +205,7 @@ class AgentF:
                 self.conversation.messages.append(new_message)
 
                 raw = new_message.content
-                self.logger.debug(f'AI response content: {raw}')
+                self.logger.debug('AI response content: %s', raw)
 
                 # Only one of function call and text will be meaningful 
 
@@ -227,17 +227,17 @@ class AgentF:
                                 role = 'function',
                                 user = name,
                             ))
-                            self.logger.info(f'Command {name} executed successfully, Result: {ret}')
+                            self.logger.info('Command %s executed successfully, Result: %s', name, ret)
 
                     self._loop.create_task(self.on_call(name, param)).add_done_callback(when_result)
 
                 if new_message.data.get('function_call') == None:
                     # Ask Command
-                    self.logger.debug(f'Text: {new_message.content}')
+                    self.logger.debug('Text: %s', new_message.content)
                     call_cmd('ask', {'content':new_message.content})
                 else:
                     # The message is a function call
-                    self.logger.debug(f'Function call: {new_message.data["function_call"]}')
+                    self.logger.debug('Function call: %s', new_message.data["function_call"])
                     function_call = new_message.data['function_call']
                     
                     if isinstance(function_call, str):
@@ -317,7 +317,7 @@ class AgentF:
         '''
         Ask the agent to execute a command
         '''
-        self.logger.debug(f'The subagent[{name}] ask: {value}')
+        self.logger.debug('The subagent[%s] ask: %s', name, value)
         self._request({
             'type':'event',
             'event': 'ask-from-subagent',
@@ -329,7 +329,7 @@ class AgentF:
         '''
         Ask the agent to execute a command
         '''
-        self.logger.debug(f'Ask: {value}')
+        self.logger.debug('Ask: %s', value)
         self._request_queue.put_nowait(ai.Message(
             content = value,
             role = 'user',
@@ -0,0 +1,127 @@
+'''
+Executor of the commands of the agent
+'''
+import asyncio
+import json
+import re
+from typing import Any, Awaitable, Callable, Optional
+
+from ... import error
+
+_reference = re.compile(r'\$(?:last_result|result\[(\d+)\])')
+
+class CommandExecutor:
+    '''
+    Executor of the commands returned by the AI in one response
+
+    The commands are run in parallel with a concurrency limit, except the dependent ones,
+    a command depends on another one if its parameters refer to the result of it:
+    `$last_result` refers to the previous command (or the last result of the agent for the first command),
+    `$result[N]` refers to the N-th command (0-based) of the response.
+    The references are replaced by the results before the command is called.
+
+    :param call: The function to call a command, with the command name and the parameters
+    :param max_concurrency: The max number of the running commands, None for no limit
+    '''
+    def __init__(self, call:Callable[[str, Any], Awaitable[Any]], max_concurrency:Optional[int] = 4) -> None:
+        if max_concurrency is not None and max_concurrency <= 0:
+            raise ValueError("max_concurrency must be positive")
+        self._call = call
+        self.max_concurrency:Optional[int] = max_concurrency
+        '''Max number of the running commands'''
+        self._semaphore:Optional[asyncio.Semaphore] = asyncio.Semaphore(max_concurrency) if max_concurrency is not None else None
+        self._tasks:set[asyncio.Task] = set()
+
+    @property
+    def running(self) -> int:
+        '''Number of the commands not done'''
+        return len(self._tasks)
+
+    @staticmethod
+    def dependencies(params:list[Any]) -> list[set[int]]:
+        '''
+        Get the indexes of the commands that each command depends on
+        '''
+        ret:list[set[int]] = []
+        for index, param in enumerate(params):
+            deps:set[int] = set()
+            text = param if isinstance(param, str) else json.dumps(param, ensure_ascii=False, default=str)
+            for match in _reference.finditer(text):
+                if match.group(1) is None:
+                    if index > 0:
+                        deps.add(index - 1)
+                elif int(match.group(1)) < index:
+                    deps.add(int(match.group(1)))
+                else:
+                    raise ValueError(f"Command {index} refers to the result of a later command: {match.group(0)}")
+            ret.append(deps)
+        return ret
+
+    @staticmethod
+    def substitute(param:Any, last_result:Any = None, results:Optional[dict[int, Any]] = None) -> Any:
+        '''
+        Replace the references in the parameters by the results
+        '''
+        results = results or {}
+        def _replace(match:re.Match) -> str:
+            if match.group(1) is None:
+                return str(last_result)
+            index = int(match.group(1))
+            if index not in results:
+                return match.group(0)
+            return str(results[index])
+        def _sub(value:Any) -> Any:
+            if isinstance(value, str):
+                return _reference.sub(_replace, value)
+            if isinstance(value, dict):
+                return {key: _sub(item) for key, item in value.items()}
+            if isinstance(value, list):
+                return [_sub(item) for item in value]
+            return value
+        return _sub(param)
+
+    def submit(self, commands:list[tuple[str, Any]], last_result:Any = None) -> list[asyncio.Task]:
+        '''
+        Submit the commands of one response
+
+        :param commands: The commands, tuples of the name and the parameters
+        :param last_result: The value of `$last_result` of the first command
+        :return: The tasks of the commands, in the same order
+        '''
+        loop = asyncio.get_running_loop()
+        deps = self.dependencies([param for _, param in commands])
+        tasks:list[asyncio.Task] = []
+        for index, (cmd, param) in enumerate(commands):
+            task = loop.create_task(self._run(index, cmd, param, {i: tasks[i] for i in deps[index]}, last_result))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            tasks.append(task)
+        return tasks
+
+    async def _run(self, index:int, cmd:str, param:Any, deps:dict[int, asyncio.Task], last_result:Any) -> Any:
+        results:dict[int, Any] = {}
+        for dep, task in deps.items():
+            try:
+                results[dep] = await task
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                raise error.Interrupted(f"The command {dep} which command {index} ({cmd}) depends on failed") from e
+        if index - 1 in results:
+            last_result = results[index - 1]
+        param = self.substitute(param, last_result, results)
+        if self._semaphore is None:
+            return await self._call(cmd, param)
+        async with self._semaphore:
+            return await self._call(cmd, param)
+
+    def cancel(self) -> None:
+        '''
+        Cancel the commands not done
+        '''
+        for task in list(self._tasks):
+            task.cancel()
+
+__all__ = (
+    'CommandExecutor',
+)
@@ -1,11 +1,10 @@
 import asyncio
-import copy
 import uuid
 from abc import abstractclassmethod
 from typing import Optional
 
 from ... import Session, utils
-from ...ai.ai import AuthorType, ChatTransformer, Conversation, Message as AIMessage
+from ...ai.ai import AuthorType, ChatTransformer, Conversation, Message as AIMessage, MessageList
 from ...ai.interface import TransformerInterface
 from ...common import serialize
 from ...config import Config
@@ -43,7 +42,7 @@ class AgentInterface(TransformerInterface):
         agent = Agent(self.ai, user=session.id.hex[:8])
         self.ai: ChatTransformer
         conversation = self.ai.new_conversation(user=session.id.hex[:8])
-        conversation.messages = copy.copy(self.init_messages)
+        conversation.messages = MessageList(self.init_messages)
         agent.conversation = conversation
         self.getdata(session)['agent'] = agent
     
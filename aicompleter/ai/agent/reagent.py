@@ -5,9 +5,8 @@ This is a agent class which put more details to the Interface class.
 '''
 import asyncio
 import contextlib
-import copy
 from typing import Any, Callable, Coroutine, Iterable, Optional, Self
-from ... import log
+from ... import log, utils
 from ...common import AsyncLifeTimeManager
 from ..ai import AuthorType, Conversation, ChatTransformer
 from .. import ai as aiclass
@@ -31,10 +30,11 @@ class Agent(AsyncLifeTimeManager):
         self._logger = log.getLogger('Agent', [name])
         self._parent:Optional[Self] = None
         self._name = name
-        self._request_queue: asyncio.Queue[aiclass.Message | None] = asyncio.Queue()           # AI request queue, will send to the AI
-        self._pre_request_time: float = 0.1                                             
-        # The time between the requests, for example, the agent got a request at time 0,
-        # and the next request(and all new requests) will be sent at time 0.1
+        self._request_queue: utils.CoalescingQueue[aiclass.Message | None] = utils.CoalescingQueue(max_wait=0.1)
+        '''
+        AI request queue, will send to the AI in batches,
+        the held producers (see `CoalescingQueue.hold`) are waited for at most `_pre_request_time` seconds
+        '''
 
         task = self._loop.create_task(self._agent_loop())
 
@@ -47,6 +47,15 @@ class Agent(AsyncLifeTimeManager):
 
         self._subagents: dict[str, Self] = {}
 
+    @property
+    def _pre_request_time(self) -> float:
+        '''Max time to wait for the held producers of the requests'''
+        return self._request_queue.max_wait
+
+    @_pre_request_time.setter
+    def _pre_request_time(self, value:float) -> None:
+        self._request_queue.max_wait = value
+
     def on_response(self, func: Callable[[Self,aiclass.Message], Coroutine[None, None, None]]):
         '''
         Set the on_response function
@@ -83,10 +92,10 @@ class Agent(AsyncLifeTimeManager):
                 return [agent._name]
             else:
                 return [*_get_parents_name(agent._parent), agent._name]
-        agent = cls(parent._ai, parent.conversation, name, loop=parent._loop)
+        agent = cls(parent._ai, parent.conversation.fork(), name, loop=parent._loop)
         agent._parent = parent
-        agent._logger.pop()
-        agent._logger.push(_get_parents_name(agent))
+        # The loggers are shared, do not change the stack of it
+        agent._logger = log.getLogger('Agent', _get_parents_name(agent))
         parent._subagents[name] = agent
         return agent
     
@@ -99,28 +108,20 @@ class Agent(AsyncLifeTimeManager):
     async def _agent_loop(self):
         # The agent loop, will run in a coroutine, handle the AI result
         while not self.closed:
-            request = await self._request_queue.get()
-            requests = []
-            if request is not None:
-                requests.append(request)
-                await asyncio.sleep(self._pre_request_time)
-                while not self._request_queue.empty():
-                    to_add = self._request_queue.get_nowait()
-                    if to_add != None:
-                        requests.append(to_add)
+            requests = [i for i in await self._request_queue.get_batch() if i is not None]
             for request in requests:
-                self._logger.debug('Got request: %s', repr(request))
+                self._logger.debug('Got request: %s', log.LazyRepr(request))
 
             @contextlib.contextmanager
             def _append_conversation():
                 # Append the conversation to the conversation list
                 # The conversation will be removed when the context is exited
-                before = copy.copy(self.conversation)
+                before = self.conversation.messages.fork()
                 self.conversation.messages.extend(requests)
                 try:
                     yield self.conversation
                 except Exception as e:
-                    self.conversation = before
+                    self.conversation.messages = before
                     raise e
                 
             with _append_conversation() as conversation:
@@ -1,16 +1,21 @@
 from __future__ import annotations
 
+import bisect
 import copy
 import enum
+import itertools
 import time
 import uuid
 from abc import abstractmethod
-from typing import Any, AsyncGenerator, Coroutine, Generator, Optional, Self, Union, final, overload
+from collections.abc import MutableSequence
+from typing import Any, AsyncGenerator, Coroutine, Generator, Iterable, Iterator, Optional, Self, Union, final, overload
 
+import aiohttp
 import attr
 
 from ..utils.etype import link_property
-from ..common import JSONSerializable
+from ..utils import network
+from ..common import JSONSerializable, serialize
 from ..config import Config
 from ..memory import JsonMemory, Memory, MemoryItem
 from . import token
@@ -101,13 +106,22 @@ class Transformer(AI):
         '''
         if '_encoder' not in self.__dict__:
             if self.encoding:
-                self._encoder = token.Encoder(encoding=self.encoding)
+                self._encoder = token.Encoder.get(encoding=self.encoding)
             elif self.model:
-                self._encoder = token.Encoder(model=self.model)
+                self._encoder = token.Encoder.get(model=self.model)
             else:
                 raise ValueError("No encoder specified")
         return self._encoder
 
+    @property
+    def http_session(self) -> aiohttp.ClientSession:
+        '''
+        Get the shared http session of the running loop
+
+        The session is pooled by the process, do not close it in the transformer
+        '''
+        return network.get_session()
+
 class Embedder(Transformer):
     '''
     Abstract class for Embed transformer
@@ -219,6 +233,27 @@ class Message(JSONSerializable):
 
     def __repr__(self):
         return f"{{content: {self.content}, role: {self.role}, id: {self.id}, user: {self.user}}}"
+
+    def __serialize__(self) -> dict:
+        # The token cache is not a part of the message
+        return {
+            key: serialize(value) for key, value in self.__dict__.items() if key != '_token_cache'
+        }
+
+    def getTokenLength(self, encoder:token.Encoder) -> int:
+        '''
+        Get the token length of the content
+
+        The length is cached for each encoding, and will be recalculated when the content is changed
+        '''
+        cache:dict[str, tuple[str, int]] = self.__dict__.setdefault('_token_cache', {})
+        content = self.content
+        cached = cache.get(encoder.name, None)
+        if cached is not None and (cached[0] is content or cached[0] == content):
+            return cached[1]
+        length = encoder.getTokenLength(content)
+        cache[encoder.name] = (content, length)
+        return length
     
     def getMemoryItem(self) -> MemoryItem:
         '''
@@ -290,12 +325,147 @@ class Funccall(JSONSerializable):
     parameters: dict[str, Any] = attr.ib(factory=dict, validator=attr.validators.deep_mapping(key_validator=attr.validators.instance_of(str), value_validator=attr.validators.instance_of(str)))
     'Parameters of function call'
 
+_versions = itertools.count()
+'''The versions of the message lists, a list gets a new version when its buffer is modified in place'''
+
+class MessageList(MutableSequence[Message]):
+    '''
+    List of messages with structural sharing
+
+    The forks share the same buffer, and each of them sees its own length of the buffer.
+    Appending to the end of the buffer is done in place, 
+    the other modifications of a shared list copy the buffer first (copy-on-write),
+    so the fork and rollback (keep a fork and restore it) are O(1).
+
+    The messages are shared by the forks as well, replace a message instead of modifying it.
+    '''
+    __slots__ = ('_buffer', '_length', '_shared', '_version')
+    def __init__(self, messages:Iterable[Message] = ()) -> None:
+        self._buffer:list[Message] = list(messages)
+        self._length:int = len(self._buffer)
+        self._shared:bool = False
+        self._version:int = next(_versions)
+        '''
+        Version of the buffer, the lists with the same buffer and version have the same messages in their common length,
+        only the appended messages differ
+        '''
+
+    def fork(self, length:Optional[int] = None) -> Self:
+        '''
+        Fork the list in O(1), the fork is independent of this list
+
+        :param length: The length of the fork, the whole list by default
+        '''
+        ret = self.__class__.__new__(self.__class__)
+        ret._buffer = self._buffer
+        ret._length = self._length if length is None else length
+        ret._shared = self._shared = True
+        ret._version = self._version
+        return ret
+
+    def _own(self) -> list[Message]:
+        '''
+        Get the buffer which is owned by this list only
+        '''
+        if self._shared:
+            self._buffer = self._buffer[:self._length]
+            self._shared = False
+        return self._buffer
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __iter__(self) -> Iterator[Message]:
+        return itertools.islice(self._buffer, self._length)
+
+    @overload
+    def __getitem__(self, index:int) -> Message:
+        ...
+
+    @overload
+    def __getitem__(self, index:slice) -> Self:
+        ...
+
+    def __getitem__(self, index:int | slice) -> Message | Self:
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._length)
+            if start == 0 and step == 1:
+                # The prefix is shared
+                return self.fork(max(stop, 0))
+            return self.__class__(self._buffer[:self._length][index])
+        if index < 0:
+            index += self._length
+        if index < 0 or index >= self._length:
+            raise IndexError("list index out of range")
+        return self._buffer[index]
+
+    def __setitem__(self, index:int | slice, value:Message | Iterable[Message]) -> None:
+        buffer = self._own()
+        buffer[index] = value
+        self._length = len(buffer)
+        self._version = next(_versions)
+
+    def __delitem__(self, index:int | slice) -> None:
+        buffer = self._own()
+        del buffer[index]
+        self._length = len(buffer)
+        self._version = next(_versions)
+
+    def insert(self, index:int, value:Message) -> None:
+        buffer = self._own()
+        buffer.insert(index, value)
+        self._length = len(buffer)
+        self._version = next(_versions)
+
+    def append(self, value:Message) -> None:
+        if self._length != len(self._buffer):
+            # Another fork has appended to the buffer
+            self._own()
+        self._buffer.append(value)
+        self._length += 1
+
+    def extend(self, values:Iterable[Message]) -> None:
+        for value in values:
+            self.append(value)
+
+    def clear(self) -> None:
+        self._buffer = []
+        self._length = 0
+        self._shared = False
+        self._version = next(_versions)
+
+    def copy(self) -> Self:
+        return self.fork()
+
+    __copy__ = copy
+
+    def __deepcopy__(self, memo:dict) -> Self:
+        return self.__class__(copy.deepcopy(list(self), memo))
+
+    def __reduce__(self):
+        return (self.__class__, (list(self),))
+
+    def __eq__(self, other:object) -> bool:
+        if isinstance(other, MessageList):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        if isinstance(other, list):
+            return list(self) == other
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"MessageList({list(self)!r})"
+
+def _to_message_list(value:Iterable[Message]) -> MessageList:
+    if isinstance(value, MessageList):
+        return value
+    return MessageList(value)
+
 @attr.dataclass
 class Conversation(JSONSerializable):
     '''
     Conversation
     '''
-    messages: list[Message] = attr.ib(factory=list, validator=attr.validators.deep_iterable(member_validator=attr.validators.instance_of(Message), iterable_validator=attr.validators.instance_of(list)))
+    messages: MessageList = attr.ib(factory=MessageList, converter=_to_message_list, validator=attr.validators.deep_iterable(member_validator=attr.validators.instance_of(Message), iterable_validator=attr.validators.instance_of(MessageList)))
     'Messages of conversation'
     id: uuid.UUID = attr.ib(
         factory=uuid.uuid4, validator=attr.validators.instance_of(uuid.UUID))
@@ -332,6 +502,98 @@ class Conversation(JSONSerializable):
     def __bool__(self):
         return True
 
+    def __serialize__(self) -> dict:
+        # The token cache is not a part of the conversation
+        return {
+            key: serialize(list(value) if key == 'messages' else value) for key, value in self.__dict__.items() if key != '_token_prefix'
+        }
+
+    def fork(self) -> Self:
+        '''
+        Fork the conversation in O(1), the messages are shared (see `MessageList`),
+        the modification of either conversation won't affect the other one
+
+        The validators are not run again
+        '''
+        if not isinstance(self.messages, MessageList):
+            # The messages are assigned directly
+            self.messages = MessageList(self.messages)
+        ret = copy.copy(self)
+        ret.__dict__.pop('_token_prefix', None)
+        ret.messages = self.messages.fork()
+        ret.data = dict(self.data)
+        return ret
+
+    def getTokenPrefix(self, encoder:token.Encoder) -> list[int]:
+        '''
+        Get the prefix sum of the token length of messages, the i-th item is the total length of the first i messages
+
+        The prefix sum is cached for each encoding, only the appended or changed messages will be counted again,
+        the appended messages are found in O(1) (the messages are replaced, not modified, see `MessageList`)
+        '''
+        cache:dict[str, list] = self.__dict__.setdefault('_token_prefix', {})
+        messages = self.messages
+        entry = cache.get(encoder.name, None)
+        if entry is None:
+            # [buffer, version, messages, contents, prefix]
+            entry = cache[encoder.name] = [None, None, [], [], [0]]
+        buffer, version, snapshot, contents, prefix = entry
+        stamp = (getattr(messages, '_buffer', None), getattr(messages, '_version', None))
+        if buffer is not None and buffer is stamp[0] and version == stamp[1] and len(messages) >= len(snapshot):
+            # Only appended since the last time
+            index = len(snapshot)
+        else:
+            # Find the unchanged part
+            index = 0
+            count = min(len(snapshot), len(messages))
+            while index < count and messages[index] is snapshot[index] and messages[index].content is contents[index]:
+                index += 1
+            if index < len(snapshot):
+                del snapshot[index:], contents[index:], prefix[index + 1:]
+        for message in itertools.islice(messages, index, None):
+            snapshot.append(message)
+            contents.append(message.content)
+            prefix.append(prefix[-1] + message.getTokenLength(encoder))
+        entry[0], entry[1] = stamp
+        return prefix
+
+    def getTokenLength(self, encoder:token.Encoder) -> int:
+        '''
+        Get the total token length of the messages
+        '''
+        return self.getTokenPrefix(encoder)[-1]
+
+    def limit_token(self, encoder:token.Encoder, max_token:int = 2048, ignore_init_prompt:bool = True) -> Self:
+        '''
+        Limit the tokens of the conversation, the earliest messages will be removed,
+        and the earliest remaining message may be cut from left to fit the limit
+
+        The conversation is not modified, a new conversation sharing the messages will be returned if the cut is needed
+        :param encoder: The encoder
+        :param max_token: The max token
+        :param ignore_init_prompt: Ignore the init prompt, the init prompt will be kept and not counted
+        '''
+        if len(self.messages) == 0:
+            return self
+        if len(self.messages) == 1 and ignore_init_prompt:
+            return self
+        prefix = self.getTokenPrefix(encoder)
+        start = 1 if ignore_init_prompt else 0
+        total = prefix[-1]
+        if total - prefix[start] <= max_token:
+            return self
+        # The index of the last message to remove, the messages after it fit the limit
+        index = bisect.bisect_left(prefix, total - max_token, lo=start + 1) - 1
+        remain = max_token - (total - prefix[index + 1])
+        ret = self.fork()
+        ret_messages = ret.messages[:start]
+        if remain > 0:
+            cut_message = self.messages[index]
+            ret_messages.append(attr.evolve(cut_message, content=encoder.decode(encoder.encode(cut_message.content)[-remain:])))
+        ret_messages.extend(itertools.islice(self.messages, index + 1, None))
+        ret.messages = ret_messages
+        return ret
+
 class ChatTransformer(Transformer):
     '''
     Abstract class for Chatable transformer
@@ -361,6 +623,19 @@ class ChatTransformer(Transformer):
         '''
         return super().generate( conversation=conversation, *args, **kwargs)
 
+    def request_payload(self, conversation: Conversation) -> Any:
+        '''
+        Get the payload of the request of the conversation, it's the key of the cached responses
+
+        By default, all the fields of the conversation and the messages except the ids, the times and the timeout,
+        override this to return the payload sent to the API
+        '''
+        def _fields(value:Any) -> dict[str, Any]:
+            return {key: item for key, item in value.__dict__.items() if key not in ('id', 'time', 'timeout') and not key.startswith('_')}
+        ret = _fields(conversation)
+        ret['messages'] = [_fields(message) for message in conversation.messages]
+        return ret
+
     def generate_many(self, conversation: Conversation, num: int, *args,  **kwargs) -> AsyncGenerator[list[Message], None]:
         '''
         Generate many possible content (if supported)
@@ -373,7 +648,7 @@ class ChatTransformer(Transformer):
         Ask the AI
         '''
         # If this function is not inherited, it will use generate() instead
-        new_conversation = copy.deepcopy(history)
+        new_conversation = history.fork()
         new_conversation.messages.append(message)
         async for value in self.generate(*args, conversation=new_conversation, **kwargs):
             yield value.content
@@ -420,6 +695,14 @@ class TextTransformer(Transformer):
     def generate(self, prompt: str, *args,  **kwargs) -> AsyncGenerator[Message, None]:
         return super().generate(prompt=prompt, *args, **kwargs)
 
+    def request_payload(self, prompt: str) -> Any:
+        '''
+        Get the payload of the request of the prompt, it's the key of the cached responses
+
+        By default, the prompt, override this to return the payload sent to the API
+        '''
+        return prompt
+
     def generate_many(self, prompt: str, num: int, *args,  **kwargs) -> AsyncGenerator[list[Message], None]:
         '''
         Generate many possible content (if supported)
@@ -0,0 +1,336 @@
+'''
+Cache of the AI responses
+'''
+from __future__ import annotations
+
+import asyncio
+import collections
+import contextlib
+import copy
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, AsyncGenerator, Callable, Optional
+
+import attr
+
+from .. import log
+from ..utils.aio import SingleFlight
+from .ai import AuthorType, ChatTransformer, Conversation, Message, TextTransformer, Transformer
+
+_TRANSPORT_KEYS = {'api-key', 'api_key', 'api-url', 'api_url', 'proxy'}
+'''Config keys which don't affect the responses'''
+
+def generation_params(transformer:Transformer) -> dict[str, Any]:
+    '''
+    Get the generation parameters of the transformer,
+    the config without the transport settings (api key, url and proxy)
+    '''
+    def _filter(value:Any) -> Any:
+        if isinstance(value, dict):
+            return {key: _filter(item) for key, item in value.items() if key not in _TRANSPORT_KEYS}
+        return value
+    return _filter(dict(transformer.config))
+
+def is_deterministic(params:dict[str, Any]) -> bool:
+    '''
+    Whether the responses are deterministic by the parameters,
+    the temperature should be set to 0 explicitly
+    '''
+    for key, value in params.items():
+        if key == 'temperature':
+            return value == 0
+        if isinstance(value, dict) and is_deterministic(value):
+            return True
+    return False
+
+def _role(role:Any) -> Any:
+    return role.value if isinstance(role, AuthorType) else role
+
+class ResponseCache:
+    '''
+    Content-addressed cache of the AI responses
+
+    The responses are keyed by the hash of the model, the request payload and the generation parameters,
+    kept in a memory LRU, and optionally in a sqlite database on disk.
+
+    :param maxsize: Max number of the responses in memory
+    :param ttl: Time to live (in seconds) of the responses, None for no limit
+    :param path: Path of the sqlite database, None to disable the disk cache
+    '''
+    def __init__(self, maxsize:int = 1024, ttl:Optional[float] = None, path:Optional[str] = None) -> None:
+        if maxsize <= 0:
+            raise ValueError("maxsize must be positive")
+        self.maxsize:int = maxsize
+        '''Max number of the responses in memory'''
+        self.ttl:Optional[float] = ttl
+        '''Time to live of the responses'''
+        self.path:Optional[str] = path
+        '''Path of the sqlite database'''
+        self.hits:int = 0
+        '''Metrics, the number of the hits (in memory or on disk)'''
+        self.disk_hits:int = 0
+        '''Metrics, the number of the hits on disk'''
+        self.misses:int = 0
+        '''Metrics, the number of the misses'''
+        self._memory:collections.OrderedDict[str, tuple[Optional[float], dict]] = collections.OrderedDict()
+        self._db:Optional[sqlite3.Connection] = None
+        self._db_lock:threading.Lock = threading.Lock()
+        if path is not None:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            with self._db:
+                self._db.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL)')
+
+    @property
+    def hit_rate(self) -> float:
+        '''Metrics, the rate of the hits'''
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    @staticmethod
+    def key(model:str, payload:Any, params:dict[str, Any]) -> str:
+        '''
+        Get the stable key of the request
+
+        :param model: The model
+        :param payload: The payload of the request, see `ChatTransformer.request_payload`
+        :param params: The generation parameters
+        '''
+        raw = json.dumps([model, payload, params], sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _expired(self, expires:Optional[float]) -> bool:
+        return expires is not None and expires < time.time()
+
+    def _get_disk(self, key:str) -> Optional[tuple[Optional[float], dict]]:
+        with self._db_lock:
+            row = self._db.execute('SELECT value, expires FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return row[1], json.loads(row[0])
+
+    def _set_disk(self, key:str, value:dict, expires:Optional[float]) -> None:
+        with self._db_lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO responses (key, value, expires) VALUES (?, ?, ?)', (key, json.dumps(value, default=str), expires))
+
+    def _remember(self, key:str, expires:Optional[float], value:dict) -> None:
+        self._memory[key] = (expires, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
+
+    async def get(self, key:str) -> Optional[dict]:
+        '''
+        Get the response, None if not cached or expired
+
+        A copy is returned, the cached response is not changed by the caller
+        '''
+        item = self._memory.get(key, None)
+        if item is not None and not self._expired(item[0]):
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return copy.deepcopy(item[1])
+        if self._db is not None:
+            # The disk is accessed in the executor, not to block the event loop
+            item = await asyncio.get_running_loop().run_in_executor(None, self._get_disk, key)
+            if item is not None and not self._expired(item[0]):
+                self._remember(key, *item)
+                self.hits += 1
+                self.disk_hits += 1
+                return copy.deepcopy(item[1])
+        self.misses += 1
+        return None
+
+    async def set(self, key:str, value:dict) -> None:
+        '''
+        Set the response, the value is copied
+        '''
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        value = copy.deepcopy(value)
+        self._remember(key, expires, value)
+        if self._db is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self._set_disk, key, value, expires)
+
+    def clear(self) -> None:
+        '''
+        Clear the cache, both in memory and on disk
+        '''
+        self._memory.clear()
+        if self._db is not None:
+            with self._db_lock, self._db:
+                self._db.execute('DELETE FROM responses')
+
+    def close(self) -> None:
+        '''
+        Close the disk cache
+        '''
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+def _dump_message(message:Message) -> dict:
+    return {
+        'content': message.content,
+        'role': _role(message.role),
+        'author': isinstance(message.role, AuthorType),
+        'user': message.user,
+        'data': message.data,
+    }
+
+def _load_message(data:dict) -> Message:
+    role = AuthorType(data['role']) if data.get('author', False) else data['role']
+    return Message(content=data['content'], role=role, user=data['user'], data=data['data'])
+
+class _CachedTransformer:
+    '''
+    Common part of the cached transformers, the other attributes are delegated to the wrapped transformer
+    '''
+    def __init__(self, wrapped:Transformer, cache:Optional[ResponseCache], params:Callable[[Transformer], dict[str, Any]] = generation_params, only_deterministic:bool = True, flight:Optional[SingleFlight] = None) -> None:
+        self.__dict__['_wrapped'] = wrapped
+        self.cache:Optional[ResponseCache] = cache
+        '''The response cache, None to disable caching'''
+        self.flight:Optional[SingleFlight] = flight
+        '''The identical requests in flight share one stream, None to disable the deduplication'''
+        self.params:Callable[[Transformer], dict[str, Any]] = params
+        '''Function to get the generation parameters of the wrapped transformer'''
+        self.only_deterministic:bool = only_deterministic
+        '''Only cache the responses of the deterministic parameters (temperature 0)'''
+        self.logger:log.Logger = log.getLogger('ResponseCache')
+
+    @property
+    def wrapped(self) -> Transformer:
+        '''The wrapped transformer'''
+        return self._wrapped
+
+    def __getattr__(self, name:str) -> Any:
+        try:
+            wrapped = self.__dict__['_wrapped']
+        except KeyError:
+            raise AttributeError(name) from None
+        return getattr(wrapped, name)
+
+    @property
+    def encoder(self):
+        return self._wrapped.encoder
+
+    def _key(self, request:Conversation | str) -> tuple[str, bool]:
+        '''
+        Get the key of the request, and whether the response can be cached
+        '''
+        params = self.params(self._wrapped)
+        cacheable = self.cache is not None and (not self.only_deterministic or is_deterministic(params))
+        payload = self._wrapped.request_payload(request)
+        return ResponseCache.key(getattr(self._wrapped, 'model', '') or self._wrapped.name, payload, params), cacheable
+
+    async def _source(self, key:str, cacheable:bool, generate:Callable[[], AsyncGenerator[Message, None]]) -> AsyncGenerator[Message, None]:
+        value = None
+        async with contextlib.aclosing(generate()) as generator:
+            async for value in generator:
+                yield value
+        if cacheable and value is not None:
+            try:
+                await self.cache.set(key, _dump_message(value))
+            except (TypeError, ValueError) as e:
+                # The response is already streamed, a failure of caching it is not raised to the consumer
+                self.logger.warning("Failed to cache the response %s: %s", key, e)
+
+    async def _generate(self, key:str, cacheable:bool, generate:Callable[[], AsyncGenerator[Message, None]]) -> AsyncGenerator[Message, None]:
+        if cacheable:
+            cached = await self.cache.get(key)
+            if cached is not None:
+                self.logger.debug("Cache hit: %s", key)
+                yield _load_message(cached)
+                return
+        shared = self.flight is not None
+        if not shared:
+            stream = self._source(key, cacheable, generate)
+        else:
+            # The stream is shared by the identical requests in flight, and cached only once
+            stream = self.flight.stream(key, lambda: self._source(key, cacheable, generate))
+        async with contextlib.aclosing(stream):
+            async for value in stream:
+                if shared:
+                    # The messages of a shared stream are copied for each consumer
+                    value = attr.evolve(value, data=copy.deepcopy(value.data))
+                yield value
+
+class CachedChatTransformer(_CachedTransformer, ChatTransformer):
+    '''
+    Cached ChatTransformer, the identical requests will be responsed from the cache
+
+    Only the final message is cached, so a cached stream yields only once
+
+    :param wrapped: The wrapped ChatTransformer
+    :param cache: The response cache, None to disable caching
+    :param params: Function to get the generation parameters, the config without the transport settings by default
+    :param only_deterministic: Only cache the responses of the deterministic parameters (temperature 0)
+    :param flight: Share one stream among the identical requests in flight, whether deterministic or not
+    '''
+    def new_conversation(self, *args, **kwargs) -> Conversation:
+        return self._wrapped.new_conversation(*args, **kwargs)
+
+    def update_config(self, config) -> None:
+        self._wrapped.update_config(config)
+
+    def generate(self, conversation:Conversation, *args, **kwargs) -> AsyncGenerator[Message, None]:
+        if args or kwargs:
+            return self._wrapped.generate(conversation, *args, **kwargs)
+        # The conversation may be modified later, the request is bound to a fork
+        conversation = conversation.fork()
+        return self._generate(*self._key(conversation), lambda: self._wrapped.generate(conversation))
+
+    def generate_many(self, *args, **kwargs) -> AsyncGenerator[list[Message], None]:
+        return self._wrapped.generate_many(*args, **kwargs)
+
+class CachedTextTransformer(_CachedTransformer, TextTransformer):
+    '''
+    Cached TextTransformer, the identical prompts will be responsed from the cache
+
+    :param wrapped: The wrapped TextTransformer
+    :param cache: The response cache, None to disable caching
+    :param params: Function to get the generation parameters, the config without the transport settings by default
+    :param only_deterministic: Only cache the responses of the deterministic parameters (temperature 0)
+    :param flight: Share one stream among the identical requests in flight, whether deterministic or not
+    '''
+    def generate(self, prompt:str, *args, **kwargs) -> AsyncGenerator[Message, None]:
+        if args or kwargs:
+            return self._wrapped.generate(prompt, *args, **kwargs)
+        return self._generate(*self._key(prompt), lambda: self._wrapped.generate(prompt))
+
+    def generate_many(self, *args, **kwargs) -> AsyncGenerator[list[Message], None]:
+        return self._wrapped.generate_many(*args, **kwargs)
+
+    def set_stopwords(self, stopwords:set[str]):
+        return self._wrapped.set_stopwords(stopwords)
+
+def cached(transformer:Transformer, cache:Optional[ResponseCache], **kwargs) -> CachedChatTransformer | CachedTextTransformer:
+    '''
+    Wrap the transformer with the response cache
+    '''
+    if isinstance(transformer, ChatTransformer):
+        return CachedChatTransformer(transformer, cache, **kwargs)
+    if isinstance(transformer, TextTransformer):
+        return CachedTextTransformer(transformer, cache, **kwargs)
+    raise TypeError(f"Unsupported transformer: {type(transformer)}")
+
+def single_flight(transformer:Transformer, flight:Optional[SingleFlight] = None) -> CachedChatTransformer | CachedTextTransformer:
+    '''
+    Wrap the transformer to deduplicate the identical requests in flight, without caching the responses
+
+    Pass the same flight to share it among the transformers
+    '''
+    return cached(transformer, None, flight=flight or SingleFlight())
+
+__all__ = (
+    'ResponseCache',
+    'CachedChatTransformer',
+    'CachedTextTransformer',
+    'cached',
+    'single_flight',
+    'generation_params',
+)
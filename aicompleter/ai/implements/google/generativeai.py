@@ -8,7 +8,7 @@ import aiohttp
 from ...ai import Conversation, Message
 from .... import error
 from ....config import Config, ConfigModel
-from ....utils import asdict
+from ....utils import asdict, network
 from ...ai import AuthorType, ChatTransformer, Conversation, Message, TextTransformer
 from ...token import Encoder
 from ... import ai
@@ -127,22 +127,22 @@ class Chater(ChatTransformer):
         '''
         if not self.check_conversation(conversation):
             raise ValueError('Conversation is not in proper format')
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f'{self.api_url}{self.model}:generateMessage?key={self.api_key}', data=json.dumps({
-                "prompt":self._generate_format(conversation),
-                **asdict(self.config.options, filter=lambda k, v: v is not None and k != 'candidate_count')
-            }), headers={
-                'Content-Type': 'application/json'
-            }, proxy = self.config.proxy) as response:
-                data = await response.json()
-                if not response.ok:
-                    raise error.HTTPStatusError(response.status, data=data)
-                if 'candidates' not in data:
-                    # The message is banned by some reason
-                    from ....error import AIGenerateError
-                    raise AIGenerateError('', data=data)
-                candidate = data['candidates'][0]
-                yield Message(content=candidate['content'], role='assistant', data=data)
+        session = self.http_session
+        async with session.post(f'{self.api_url}{self.model}:generateMessage?key={self.api_key}', data=json.dumps({
+            "prompt":self._generate_format(conversation),
+            **asdict(self.config.options, filter=lambda k, v: v is not None and k != 'candidate_count')
+        }), headers={
+            'Content-Type': 'application/json'
+        }, proxy = self.config.proxy) as response:
+            data = await response.json()
+            if not response.ok:
+                raise error.HTTPStatusError(response.status, data=data)
+            if 'candidates' not in data:
+                # The message is banned by some reason
+                from ....error import AIGenerateError
+                raise AIGenerateError('', data=data)
+            candidate = data['candidates'][0]
+            yield Message(content=candidate['content'], role='assistant', data=data)
 
     async def generate_many(self, conversation: Conversation, num:int) -> AsyncGenerator[list[Message], None]:
         '''
@@ -160,26 +160,26 @@ class Chater(ChatTransformer):
         '''
         if not self.check_conversation(conversation):
             raise ValueError('Conversation is not in proper format')
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f'{self.api_url}{self.model}:generateMessage?key={self.api_key}', data=json.dumps({
-                "prompt":self._generate_format(conversation),
-                "candidate_count":num,
-                **asdict(self.config.options, filter=lambda k, v: v is not None and k != 'candidate_count'),
-            }), headers={
-                'Content-Type': 'application/json'
-            }, proxy = self.config.proxy) as response:
-                data = await response.json()
-                if not response.ok:
-                    raise error.HTTPStatusError(response.status, data=data)
-                if 'candidates' not in data:
-                    # The message is banned by some reason
-                    from ....error import AIGenerateError
-                    raise AIGenerateError('', data=data)
-                candidates = data['candidates']
-                ret = []
-                for candidate in candidates:
-                    ret.append(Message(content=candidate['content'], role='assistant', data=data))
-                yield ret
+        session = self.http_session
+        async with session.post(f'{self.api_url}{self.model}:generateMessage?key={self.api_key}', data=json.dumps({
+            "prompt":self._generate_format(conversation),
+            "candidate_count":num,
+            **asdict(self.config.options, filter=lambda k, v: v is not None and k != 'candidate_count'),
+        }), headers={
+            'Content-Type': 'application/json'
+        }, proxy = self.config.proxy) as response:
+            data = await response.json()
+            if not response.ok:
+                raise error.HTTPStatusError(response.status, data=data)
+            if 'candidates' not in data:
+                # The message is banned by some reason
+                from ....error import AIGenerateError
+                raise AIGenerateError('', data=data)
+            candidates = data['candidates']
+            ret = []
+            for candidate in candidates:
+                ret.append(Message(content=candidate['content'], role='assistant', data=data))
+            yield ret
 
     def limit_token(self, history:Conversation, max_token:int = 2048, ignore_init_prompt:bool = True):
         '''
@@ -188,48 +188,7 @@ class Chater(ChatTransformer):
         :param max_token: The max token
         :param ignore_init_prompt: Ignore the init prompt
         '''
-        if len(history.messages) == 0:
-            return history
-        if len(history.messages) == 1 and ignore_init_prompt:
-            return history
-        encoder = Encoder(model = self.model)
-        totallen = sum(encoder.getTokenLength(message.content) for message in history.messages)
-        init_len = encoder.getTokenLength(history.messages[0].content)
-        if totallen <= max_token:
-            return history
-        if ignore_init_prompt:
-            if totallen - init_len <= max_token:
-                return history
-        # Cut needed
-        new_his = copy.deepcopy(history)
-        for index in range(len(new_his.messages)):
-            totallen -= encoder.getTokenLength(new_his.messages[index].content)
-            if ignore_init_prompt and index == 0:
-                continue
-            if totallen <= max_token:
-                break
-        
-        add_msg = None
-        for rv in range(index, -1, -1):
-            if ignore_init_prompt and rv == 0:
-                continue
-            add_msg = new_his.messages[rv]
-            break
-
-        add_msg.content = encoder.decode(encoder.encode(add_msg.content)[totallen-max_token:])
-        ret_messages = []
-        for i, message in enumerate(new_his.messages):
-            if ignore_init_prompt and i == 0:
-                ret_messages.append(message)
-                continue
-            if i == rv:
-                ret_messages.append(add_msg)
-                continue
-            if i < index:
-                continue
-            ret_messages.append(message)
-        new_his.messages = ret_messages
-        return new_his
+        return history.limit_token(Encoder.get(model = self.model), max_token, ignore_init_prompt)
 
 class TextCompleter(TextTransformer):
     '''
@@ -266,24 +225,24 @@ class TextCompleter(TextTransformer):
         --------
         AsyncGenerator[Message, None], the completed Message, due to the API limit, the message will be yield for only one time.
         '''
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f'{self.api_url}{self.model}:generateText?key={self.api_key}', data=json.dumps({
-                "prompt": {
-                    "text": text
-                },
-                **asdict(self.config.options, filter=lambda k, v: v is not None)
-            }), headers={
-                'Content-Type': 'application/json'
-            }, proxy = self.config.proxy) as response:
-                data = await response.json()
-                if not response.ok:
-                    raise error.HTTPStatusError(response.status, data=data)
-                if 'candidates' not in data:
-                    # The message is banned by some reason
-                    from ....error import AIGenerateError
-                    raise AIGenerateError('', data=data)
-                candidate = data['candidates'][0]
-                yield Message(content=candidate['output'], data=data)
+        session = self.http_session
+        async with session.post(f'{self.api_url}{self.model}:generateText?key={self.api_key}', data=json.dumps({
+            "prompt": {
+                "text": text
+            },
+            **asdict(self.config.options, filter=lambda k, v: v is not None)
+        }), headers={
+            'Content-Type': 'application/json'
+        }, proxy = self.config.proxy) as response:
+            data = await response.json()
+            if not response.ok:
+                raise error.HTTPStatusError(response.status, data=data)
+            if 'candidates' not in data:
+                # The message is banned by some reason
+                from ....error import AIGenerateError
+                raise AIGenerateError('', data=data)
+            candidate = data['candidates'][0]
+            yield Message(content=candidate['output'], data=data)
 
     async def generate_many(self, prompt: str, num: int) -> AsyncGenerator[list[Message], None]:
         '''
@@ -298,26 +257,26 @@ class TextCompleter(TextTransformer):
         --------
         AsyncGenerator[list[Message], None], the completed Messages, due to the API limit, the messages will be yield for only one time.
         '''
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f'{self.api_url}{self.model}:generateText?key={self.api_key}', data=json.dumps({
-                "prompt": prompt,
-                "candidate_count":num,
-                **asdict(self.config.options, filter=lambda k, v: v is not None and k != 'candidate_count'),
-            }), headers={
-                'Content-Type': 'application/json'
-            }, proxy = self.config.proxy) as response:
-                data = await response.json()
-                if not response.ok:
-                    raise error.HTTPStatusError(response.status, data=data)
-                candidates = data['candidates']
-                if 'candidates' not in data:
-                    # The message is banned by some reason
-                    from ....error import AIGenerateError
-                    raise AIGenerateError('', data=data)
-                ret = []
-                for candidate in candidates:
-                    ret.append(Message(content=candidate['output'], data=data))
-                yield ret
+        session = self.http_session
+        async with session.post(f'{self.api_url}{self.model}:generateText?key={self.api_key}', data=json.dumps({
+            "prompt": prompt,
+            "candidate_count":num,
+            **asdict(self.config.options, filter=lambda k, v: v is not None and k != 'candidate_count'),
+        }), headers={
+            'Content-Type': 'application/json'
+        }, proxy = self.config.proxy) as response:
+            data = await response.json()
+            if not response.ok:
+                raise error.HTTPStatusError(response.status, data=data)
+            candidates = data['candidates']
+            if 'candidates' not in data:
+                # The message is banned by some reason
+                from ....error import AIGenerateError
+                raise AIGenerateError('', data=data)
+            ret = []
+            for candidate in candidates:
+                ret.append(Message(content=candidate['output'], data=data))
+            yield ret
 
 class Embedder(ai.Embedder):
     def __init__(self, config: Config):
@@ -340,16 +299,16 @@ class Embedder(ai.Embedder):
         --------
         AsyncGenerator[list[float], None], the embedding, due to the API limit, the embedding will be yield for only one time.
         '''
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f'https://generativelanguage.googleapis.com/v1beta2/models/{self.model}:embedText?key={self.api_key}', data=json.dumps({
-                "text": prompt,
-            }), headers={
-                'Content-Type': 'application/json'
-            }, proxy = self.proxy) as response:
-                data = await response.json()
-                if not response.ok:
-                    raise error.HTTPStatusError(response.status, data=data)
-                yield data['embedding']['value']
+        session = self.http_session
+        async with session.post(f'https://generativelanguage.googleapis.com/v1beta2/models/{self.model}:embedText?key={self.api_key}', data=json.dumps({
+            "text": prompt,
+        }), headers={
+            'Content-Type': 'application/json'
+        }, proxy = self.proxy) as response:
+            data = await response.json()
+            if not response.ok:
+                raise error.HTTPStatusError(response.status, data=data)
+            yield data['embedding']['value']
 
 class GooglePaLMAPI:
     '''
@@ -361,10 +320,10 @@ class GooglePaLMAPI:
         self.options = kwargs
 
     async def _request(self, url:str, data:Optional[dict] = None):
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=data, **self.options) as response:
-                response.raise_for_status()
-                return await response.json()
+        session = network.get_session()
+        async with session.post(url, json=data, **self.options) as response:
+            response.raise_for_status()
+            return await response.json()
 
     def generateText(self, model:str, data:dict):
         return self._request(f'{self.api_url}models/{model}:generateText?key={self.api_key}', data)
@@ -1,6 +1,6 @@
-import copy
+import contextlib
 import json
-from typing import Any, Generator, Iterator, Literal, Optional, Self
+from typing import Any, AsyncGenerator, Generator, Iterator, Literal, Optional, Self
 import uuid
 
 import aiohttp
@@ -95,10 +95,78 @@ class OpenAIConversation(Conversation):
         '''
         Convert a conversation to OpenAIConversation
         '''
+        # Share the messages and the caches, the validators are not run again
+        conversation = conversation.fork()
         ret = OpenAIConversation.__new__(OpenAIConversation)
-        ret.__init__(**conversation.__dict__)
+        ret.__dict__.update(conversation.__dict__)
         return ret
 
+def _from_message(raw:dict) -> Message:
+    '''
+    Convert the raw message to Message
+    '''
+    ret_message = Message(
+        content = raw.get('content', None) or '',
+        role = raw['role'],
+        user = raw.get('name', None),
+        data = raw,
+    )
+    if 'function_call' in raw:
+        # Function call will be interpreted in the agent calss
+        ret_message.function_call = raw['function_call']
+    return ret_message
+
+def _apply_delta(message:Message, delta:dict) -> None:
+    '''
+    Apply the delta of stream mode to the message
+    '''
+    raw = message.data
+    if 'role' in delta:
+        message.role = raw['role'] = delta['role']
+    if delta.get('content', None):
+        message.content += delta['content']
+        raw['content'] = message.content
+    if 'function_call' in delta:
+        function_call = raw.setdefault('function_call', {'name': '', 'arguments': ''})
+        for key, value in delta['function_call'].items():
+            if value:
+                function_call[key] = function_call.get(key, '') + value
+        message.function_call = function_call
+
+def _apply_chat_events(events:list[utils.network.ServerSentEvent], messages:list[Message]) -> bool:
+    '''
+    Accumulate the chat completion chunks into the messages, return whether the messages are updated
+    '''
+    updated = False
+    for event in events:
+        if event.data == utils.network.SSEDecoder.DONE:
+            break
+        for choice in json.loads(event.data)['choices']:
+            index = choice.get('index', 0)
+            while len(messages) <= index:
+                messages.append(Message(content='', role='assistant', data={'role': 'assistant', 'content': ''}))
+            _apply_delta(messages[index], choice.get('delta', {}))
+            updated = True
+    return updated
+
+def _apply_text_events(events:list[utils.network.ServerSentEvent], messages:list[Message]) -> bool:
+    '''
+    Accumulate the text completion chunks into the messages, return whether the messages are updated
+    '''
+    updated = False
+    for event in events:
+        if event.data == utils.network.SSEDecoder.DONE:
+            break
+        data = json.loads(event.data)
+        for choice in data['choices']:
+            index = choice.get('index', 0)
+            while len(messages) <= index:
+                messages.append(Message(content=''))
+            messages[index].content += choice.get('text', '')
+            messages[index].data = data
+            updated = True
+    return updated
+
 class OpenAIGPT(Transformer):
     '''
     OpenAI GPT
@@ -165,128 +233,103 @@ class Chater(ChatTransformer,OpenAIGPT):
         '''
         self.config = config
         self.model = self.config.get('model', 'gpt-3.5-turbo')
+        # The encoder depends on the model
+        self.__dict__.pop('_encoder', None)
         self.api_key:str = self.config.require('openai.api-key')
         self.proxy:Optional[str] = self.config.get('proxy', None)
         self.api_url = self.config.get('openai.api-url', DEFAULT_API_URL)
         self.location = self.api_url + 'chat/completions'
         self.config.setdefault('sys.max_token', 2048)
     
-    async def _request(self, conversation: Conversation) -> Generator[str, Any, None]:
+    def request_payload(self, conversation: Conversation, **options) -> dict[str, Any]:
         '''
-        Request the conversation
+        Get the json payload of the request
         '''
         utils.typecheck(conversation, Conversation)
         # Convert to OoenAIConversation
         if not isinstance(conversation, OpenAIConversation):
             conversation = OpenAIConversation.from_conversation(conversation)
         conversation = self.limit_token(conversation, self.config['sys.max_token'])
+        return dict(
+            **conversation.generate_json(),
+            **{**self.config['chat'], **options},
+            model = self.model,
+        )
 
-        async with aiohttp.ClientSession() as session:
-
-            async with session.post(
-                url=self.location,
-                json=dict(
-                    **conversation.generate_json(),
-                    **self.config['chat'],
-                    model = self.model,
-                ),
-                proxy=self.proxy if self.proxy else None,
-                headers={
-                    'Authorization': f'Bearer {self.api_key}'
-                }
-            ) as res:
-                if res.status != 200:
-                    raise RuntimeError(f'Error: {res.status} {res.reason}: ' + await res.text())
-                async for value in res.content:
-                    yield value.decode()
+    async def _request(self, conversation: Conversation, **options) -> AsyncGenerator[bytes, None]:
+        '''
+        Request the conversation
+        '''
+        session = self.http_session
+
+        async with session.post(
+            url=self.location,
+            json=self.request_payload(conversation, **options),
+            proxy=self.proxy if self.proxy else None,
+            headers={
+                'Authorization': f'Bearer {self.api_key}'
+            }
+        ) as res:
+            if res.status != 200:
+                raise RuntimeError(f'Error: {res.status} {res.reason}: ' + await res.text())
+            async for value in res.content.iter_any():
+                yield value
 
-    async def generate_raw(self, conversation: Conversation) -> str:
+    async def generate_raw(self, conversation: Conversation, **options) -> str:
         '''
-        Generate the conversation and return raw bytes
+        Generate the conversation and return raw text
         '''
-        return ''.join([value async for value in self._request(conversation)])
-    
-    async def generate(self, conversation: Conversation) -> Generator[Message, Any, None]:
+        return b''.join([value async for value in self._request(conversation, **options)]).decode()
+
+    async def _generate_stream(self, conversation: Conversation, **options) -> AsyncGenerator[list[Message], None]:
+        '''
+        Generate the conversation in stream mode,
+        the delta of the choices will be accumulated into the messages, and the messages will be yield when updated
+        '''
+        decoder = utils.network.SSEDecoder()
+        messages:list[Message] = []
+        async with contextlib.aclosing(self._request(conversation, **options)) as response:
+            async for chunk in response:
+                if _apply_chat_events(decoder.feed(chunk), messages):
+                    yield messages
+                if decoder.done:
+                    return
+        if _apply_chat_events(decoder.flush(), messages):
+            yield messages
+
+    async def generate(self, conversation: Conversation) -> AsyncGenerator[Message, None]:
         '''
         Generate the conversation and return text
-        '''
-        full_text = ''
-        async for value in self._request(conversation):
-            full_text += value
-            if '\n' in full_text:
-                lines = full_text.splitlines()
-                for line in lines[:-1]:
-                    if line == 'data:[DONE]':
-                        break
-                    raw = json.loads(line)['choices'][0]['message']
-                    ret_message = Message(
-                        content = raw.get('content', ''),
-                        role = raw['role'],
-                        user = raw.get('name', None),
-                        data = raw,
-                    )
-                    if 'function_call' in raw:
-                        # Function call will be interpreted in the agent calss
-                        ret_message.function_call = raw['function_call']
-                    yield ret_message
-
-                full_text = lines[-1]
-        # Last line
-        if full_text:
-            raw = json.loads(full_text)['choices'][0]['message']
-            ret_message = Message(
-                content = raw.get('content', ''),
-                role = raw['role'],
-                user = raw.get('name', None),
-                data = raw,
-            )
-            if 'function_call' in raw:
-                # Function call will be interpreted in the agent calss
-                ret_message.function_call = raw['function_call']
-            yield ret_message
-
-    async def generate_many(self, conversation: Conversation) -> Generator[list[Message], Any, None]:
+
+        In stream mode, the same message will be yield with the growing content
+        '''
+        if not self.stream:
+            raw = json.loads(await self.generate_raw(conversation))
+            yield _from_message(raw['choices'][0]['message'])
+            return
+        async for messages in self._generate_stream(conversation):
+            if messages:
+                yield messages[0]
+
+    async def generate_many(self, conversation: Conversation, num: Optional[int] = None) -> AsyncGenerator[list[Message], None]:
         '''
         Generate the conversations and return text
-        '''
-        def _from_message(raw:dict, i:int) -> Message:
-            '''
-            Convert the raw message to Message
-            '''
-            raw = raw['choices'][i]['message']
-            ret_message = Message(
-                content = raw['content'],
-                role = raw['role'],
-                user = raw['name'] if 'name' in raw else None,
-                data = raw,
-            )
-            if 'function_call' in raw:
-                # Function call will be interpreted in the agent calss
-                ret_message.function_call = raw['function_call']
-            return ret_message
-        full_text = ''
-        async for value in self.generate(conversation):
-            full_text += value
-            if '\n' in full_text:
-                lines = full_text.splitlines(keepends=True)
-                for line in lines[:-1]:
-                    yield [
-                        _from_message(json.loads(line), i)
-                        for i in range(len(json.loads(line)['choices']))
-                        ]
-                full_text = lines[-1]
-        # Last line
-        if full_text:
-            yield [
-                _from_message(json.loads(full_text), i)
-                for i in range(len(json.loads(full_text)['choices']))
-                ]
+
+        The count of the choices is decided by the config 'chat.n' if num is not specified
+        '''
+        options = {} if num is None else {'n': num}
+        if not self.stream:
+            raw = json.loads(await self.generate_raw(conversation, **options))
+            yield [_from_message(choice['message']) for choice in raw['choices']]
+            return
+        async for messages in self._generate_stream(conversation, **options):
+            yield list(messages)
     
     async def update_conversation(self, history:Conversation, message: Message) -> Conversation:
         '''
         Ask the message
         '''
-        new_his = copy.deepcopy(history)
+        new_his = history.fork()
         new_his.messages.append(message)
         new_his = self.limit_token(new_his, self.config['sys.max_token'])
         ret = await self.generate_text(new_his)
@@ -303,54 +346,13 @@ class Chater(ChatTransformer,OpenAIGPT):
         :param max_token: The max token
         :param ignore_init_prompt: Ignore the init prompt
         '''
-        if len(history.messages) == 0:
-            return history
-        if len(history.messages) == 1 and ignore_init_prompt:
-            return history
-        encoder = Encoder(model = self.model)
-        totallen = sum(encoder.getTokenLength(message.content) for message in history.messages)
-        init_len = encoder.getTokenLength(history.messages[0].content)
-        if totallen <= max_token:
-            return history
-        if ignore_init_prompt:
-            if totallen - init_len <= max_token:
-                return history
-        # Cut needed
-        new_his = copy.deepcopy(history)
-        for index in range(len(new_his.messages)):
-            totallen -= encoder.getTokenLength(new_his.messages[index].content)
-            if ignore_init_prompt and index == 0:
-                continue
-            if totallen <= max_token:
-                break
-        
-        add_msg = None
-        for rv in range(index, -1, -1):
-            if ignore_init_prompt and rv == 0:
-                continue
-            add_msg = new_his.messages[rv]
-            break
-
-        add_msg.content = encoder.decode(encoder.encode(add_msg.content)[totallen-max_token:])
-        ret_messages = []
-        for i, message in enumerate(new_his.messages):
-            if ignore_init_prompt and i == 0:
-                ret_messages.append(message)
-                continue
-            if i == rv:
-                ret_messages.append(add_msg)
-                continue
-            if i < index:
-                continue
-            ret_messages.append(message)
-        new_his.messages = ret_messages
-        return new_his
+        return history.limit_token(self.encoder, max_token, ignore_init_prompt)
     
     def getToken(self, text: str) -> list[int]:
         '''
         Get the token of the text
         '''
-        return Encoder(model = self.model).encode(text)
+        return self.encoder.encode(text)
     
 class Completer(TextTransformer,OpenAIGPT):
     '''
@@ -397,63 +399,81 @@ class Completer(TextTransformer,OpenAIGPT):
         self.location = self.api_url + 'completions'
         self.config.setdefault('sys.max_token', 2048)
 
-    async def _request(self, prompt: str) -> Generator[str, Any, None]:
+    def request_payload(self, prompt: str, **options) -> dict[str, Any]:
         '''
-        Generate the prompt
+        Get the json payload of the request
         '''
         utils.typecheck(prompt, str)
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                url=self.location,
-                json=dict(
-                    prompt=prompt,
-                    **self.config['chat'],
-                    model = self.name,
-                ),
-                proxy=self.proxy if self.proxy else None,
-                headers={
-                    'Authorization': f'Bearer {self.api_key}'
-                }
-            ) as res:
-                if res.status != 200:
-                    raise RuntimeError(f'Error: {res.status} {res.reason}')
-                async for value in res.content:
-                    yield value.decode()
+        return dict(
+            prompt=prompt,
+            **{**self.config['chat'], **options},
+            model = self.name,
+        )
 
-    async def generate_raw(self, prompt: str) -> str:
+    async def _request(self, prompt: str, **options) -> AsyncGenerator[bytes, None]:
         '''
-        Generate the prompt and return raw bytes
+        Generate the prompt
         '''
-        return ''.join([value async for value in self._request(prompt)])
+        session = self.http_session
+        async with session.post(
+            url=self.location,
+            json=self.request_payload(prompt, **options),
+            proxy=self.proxy if self.proxy else None,
+            headers={
+                'Authorization': f'Bearer {self.api_key}'
+            }
+        ) as res:
+            if res.status != 200:
+                raise RuntimeError(f'Error: {res.status} {res.reason}')
+            async for value in res.content.iter_any():
+                yield value
 
-    async def generate(self, prompt: str) -> Generator[Message, Any, None]:
+    async def generate_raw(self, prompt: str, **options) -> str:
         '''
-        Generate the prompt and return text
+        Generate the prompt and return raw text
         '''
-        full_text = ''
-        async for value in self._request(prompt):
-            full_text += value
-            if '\n' in full_text:
-                lines = full_text.split('\n')
-                for line in lines[:-1]:
-                    data = json.loads(line)
-                    yield Message(content = data['choices'][0]['text'], data=data)
-                full_text = lines[-1]
+        return b''.join([value async for value in self._request(prompt, **options)]).decode()
 
-    async def generate_many(self, prompt: str) -> Generator[list[Message], Any, None]:
+    async def _generate_stream(self, prompt: str, **options) -> AsyncGenerator[list[Message], None]:
+        '''
+        Generate the prompt in stream mode,
+        the text of the choices will be accumulated into the messages, and the messages will be yield when updated
+        '''
+        decoder = utils.network.SSEDecoder()
+        messages:list[Message] = []
+        async with contextlib.aclosing(self._request(prompt, **options)) as response:
+            async for chunk in response:
+                if _apply_text_events(decoder.feed(chunk), messages):
+                    yield messages
+                if decoder.done:
+                    return
+        if _apply_text_events(decoder.flush(), messages):
+            yield messages
+
+    async def generate(self, prompt: str) -> AsyncGenerator[Message, None]:
         '''
         Generate the prompt and return text
+
+        In stream mode, the same message will be yield with the growing content
+        '''
+        if not self.stream:
+            data = json.loads(await self.generate_raw(prompt))
+            yield Message(content = data['choices'][0]['text'], data=data)
+            return
+        async for messages in self._generate_stream(prompt):
+            if messages:
+                yield messages[0]
+
+    async def generate_many(self, prompt: str, num: Optional[int] = None) -> AsyncGenerator[list[Message], None]:
         '''
-        full_text = ''
-        async for value in self.generate(prompt):
-            full_text += value
-            if '\n' in full_text:
-                lines = full_text.splitlines(keepends=True)
-                for line in lines[:-1]:
-                    data = json.loads(line)
-                    yield [
-                        Message(content=data['choices'][i]['text'], data = data)
-                        for i in range(len(json.loads(line)['choices']))
-                    ]
-                full_text = lines[-1]
+        Generate the prompt and return text
+
+        The count of the choices is decided by the config 'chat.n' if num is not specified
+        '''
+        options = {} if num is None else {'n': num}
+        if not self.stream:
+            data = json.loads(await self.generate_raw(prompt, **options))
+            yield [Message(content=choice['text'], data=data) for choice in data['choices']]
+            return
+        async for messages in self._generate_stream(prompt, **options):
+            yield list(messages)
@@ -1,42 +1,109 @@
-from typing import Optional
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Self
 import tiktoken
 
+_registry:dict[tuple[Optional[str], Optional[str]], 'Encoder'] = {}
+'''
+Shared encoders, keyed by (model, encoding)
+'''
+_registry_lock = threading.Lock()
+_executor:Optional[ThreadPoolExecutor] = None
+'''
+Shared thread pool for batch encoding
+'''
+
+@functools.cache
+def _load_encoding(model:Optional[str], encoding:Optional[str]) -> tiktoken.Encoding:
+    '''
+    Load the tiktoken encoding, the result is memoized
+    '''
+    if model != None:
+        return tiktoken.encoding_for_model(model)
+    return tiktoken.get_encoding(encoding)
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _registry_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(thread_name_prefix="TokenEncoder")
+    return _executor
+
+def _to_text(token) -> str:
+    if not isinstance(token, str):
+        # For compatibility with ai.ai
+        # TODO: find a better way
+        from .ai import ZipContent
+        if isinstance(token, ZipContent):
+            return token.zip
+        raise TypeError("token should be str or ZipContent")
+    return token
+
 class Encoder:
     '''
     Encoding operations for tokens
+
+    Use `Encoder.get` to get a shared encoder instead of constructing a new one
     '''
     def __init__(self, *, model:Optional[str] = None, encoding:Optional[str] = None) -> None:
         if model == None and encoding == None:
             raise ValueError("Either model or encoding should be specified")
-        if model != None:
-            self._enc = tiktoken.encoding_for_model(model)
-        else:
-            self._enc = tiktoken.get_encoding(encoding)
+        self._enc = _load_encoding(model, encoding if model == None else None)
+
+    @classmethod
+    def get(cls, *, model:Optional[str] = None, encoding:Optional[str] = None) -> Self:
+        '''
+        Get the shared encoder of the model or encoding
+        '''
+        key = (model, None) if model != None else (None, encoding)
+        ret = _registry.get(key, None)
+        if ret is None:
+            with _registry_lock:
+                ret = _registry.get(key, None)
+                if ret is None:
+                    ret = _registry[key] = cls(model=model, encoding=encoding)
+        return ret
+
+    @property
+    def name(self) -> str:
+        '''Name of the encoding'''
+        return self._enc.name
 
     def encode(self, token:str) -> list[int]:
         '''Encode token'''
-        if not isinstance(token, str):
-            # For compatibility with ai.ai
-            # TODO: find a better way
-            from .ai import ZipContent
-            if isinstance(token, ZipContent):
-                token = token.zip
-            else:
-                raise TypeError("token should be str or ZipContent")
-        return self._enc.encode(token)
+        return self._enc.encode(_to_text(token))
 
     def decode(self, token:list[int]) -> str:
         '''Decode token'''
         return self._enc.decode(token)
-    
+
     def encode_batch(self, tokens:list[str]) -> list[list[int]]:
         '''Encode tokens'''
-        return self._enc.encode_batch(tokens)
-    
+        return self._enc.encode_batch([_to_text(token) for token in tokens])
+
     def decode_batch(self, tokens:list[list[int]]) -> list[str]:
         '''Decode tokens'''
         return self._enc.decode_batch(tokens)
-    
+
+    async def encode_many(self, tokens:list[str]) -> list[list[int]]:
+        '''
+        Encode tokens in the thread pool, the event loop will not be blocked
+        '''
+        tokens = [_to_text(token) for token in tokens]
+        return await asyncio.get_running_loop().run_in_executor(_get_executor(), self._enc.encode_batch, tokens)
+
+    async def count_many(self, tokens:list[str]) -> list[int]:
+        '''
+        Get the lengths of tokens in the thread pool, the event loop will not be blocked
+        '''
+        tokens = [_to_text(token) for token in tokens]
+        def _count() -> list[int]:
+            return [len(i) for i in self._enc.encode_batch(tokens)]
+        return await asyncio.get_running_loop().run_in_executor(_get_executor(), _count)
+
     def limit(self, token:str, max_length:int, from_right:bool = False) -> str:
         '''
         Limit the length of token
@@ -53,4 +120,3 @@ class Encoder:
     def getTokenLength(self, token:str) -> int:
         '''Get the length of token'''
         return len(self.encode(token))
-    
\ No newline at end of file
@@ -59,6 +59,7 @@ class BaseTemplate(ABC):
     '''
     A template class for all the template classes in aicompleter
     '''
+    __slots__ = ()
 
 _T = TypeVar('_T')
 class AsyncTemplate(BaseTemplate, Generic[_T]):
@@ -114,6 +115,7 @@ class JSONSerializable(Serializable):
     '''
     This class is used to serialize object to json
     '''
+    __slots__ = ()
     def __serialize__(self) -> list:
         '''
         Convert to json format
@@ -4,10 +4,10 @@ Description: Configuration file for aicompleter
 '''
 from __future__ import annotations
 
+import copy
 import json
 import os
-from re import A
-from typing import Any, Optional, Self, TypeAlias
+from typing import Any, Callable, Optional, Self, TypeAlias
 
 from .error import ConfigureMissing
 from .utils import EnhancedDict, make_model
@@ -18,9 +18,22 @@ Pointer type
 Use list to implement pointer
 '''
 
+_MISSING = object()
+
+def _unchanged(old:Any, value:Any) -> bool:
+    '''Whether setting the value will not change the old value'''
+    if old is _MISSING:
+        return False
+    if old is value:
+        return True
+    if type(old) is not type(value) and not (isinstance(old, dict) and isinstance(value, dict)):
+        return False
+    return old == value
+
 class Config(EnhancedDict):
     '''Configuration Class'''
     ALLOWED_VALUE_TYPE = (str, int, float, bool, type(None))
+    __slots__ = ('__on_setter__', '_generation', '_owner')
 
     @classmethod
     def loadFromFile(cls, path:str) -> Self:
@@ -54,26 +67,131 @@ class Config(EnhancedDict):
         '''Get global config'''
         return self.get('global', Config())
     
+    def _init_slots(self, readonly:bool) -> None:
+        super()._init_slots(readonly)
+        self.__on_setter__:Optional[Callable[[str, Any], None]] = None
+        '''Hook called before a value is set'''
+        self._generation:int = 0
+        self._owner:Optional[Config] = None
+        '''The config that this nested config belongs to'''
+
+    @property
+    def generation(self) -> int:
+        '''
+        Generation of the config, increased when the config or its nested configs are changed,
+        the caches built from the config (layered views, session template) will be dropped when changed
+        '''
+        return self._generation
+
+    def _touch(self) -> None:
+        '''Increase the generation of the config and the configs it belongs to'''
+        config = self
+        while config is not None:
+            config._generation += 1
+            config = config._owner
+
+    def _adopt(self, value:Any) -> Any:
+        if isinstance(value, Config):
+            value._owner = self
+        return value
+
+    def _wrap(self, key:Any, value:Any) -> Any:
+        ret = super()._wrap(key, value)
+        if ret is not value:
+            self._adopt(ret)
+        return ret
+
+    def _init_nested(self) -> None:
+        super()._init_nested()
+        # The nested dicts are checked here, they won't be checked again when wrapped
+        for key, value in dict.items(self):
+            if isinstance(value, dict):
+                self._check_value(key, value)
+
+    @classmethod
+    def _check_value(cls, key: Any, value: Any) -> None:
+        '''
+        Check the type of key and value, raise TypeError if invalid
+        '''
+        if not isinstance(key, str):
+            raise TypeError(f"Invalid key type: {key!r}")
+        if isinstance(value, dict):
+            for k, v in value.items():
+                cls._check_value(k, v)
+            return
+        if isinstance(value, list):
+            for i in value:
+                cls._check_value(key, i)
+            return
+        if not isinstance(value, cls.ALLOWED_VALUE_TYPE):
+            raise TypeError(f"Invalid value type: {value!r}")
+
     def __setitem__(self, __key: Any, __value: Any) -> None:
         # Check type
         self.__on_setter__ and self.__on_setter__(__key, __value)
+        self._check_value(__key, __value)
+        return self.set(__key, __value)
+
+    def set(self, path:str, value:Any):
+        '''
+        Set a value, the generation is increased only when the value is changed
+        '''
+        if '.' in path:
+            key, subpath = path.split('.', 1)
+            if not dict.__contains__(self, key):
+                dict.__setitem__(self, key, self._adopt(self.__class__()))
+                self._touch()
+            self[key].set(subpath, value)
+            return
+        if _unchanged(dict.get(self, path, _MISSING), value):
+            return
+        if isinstance(value, dict):
+            value = self._adopt(self.__class__(value))
+        dict.__setitem__(self, path, value)
+        self._touch()
+
+    def setdefault(self, path:str | dict, default:Any = None) -> Any:
+        if isinstance(path, str) and '.' not in path and not dict.__contains__(self, path):
+            self._touch()
+        return super().setdefault(path, default)
+
+    def __delitem__(self, __key: Any) -> None:
+        super().__delitem__(__key)
+        self._touch()
+
+    def pop(self, key:Any, *args) -> Any:
+        if not dict.__contains__(self, key):
+            return super().pop(key, *args)
+        ret = super().pop(key)
+        if isinstance(ret, Config):
+            ret._owner = None
+        self._touch()
+        return ret
+
+    def popitem(self) -> tuple[str, Any]:
+        key, value = super().popitem()
+        if isinstance(value, Config):
+            value._owner = None
+        self._touch()
+        return key, value
 
-        def _check(key: Any, value: Any) -> None:
-            if not isinstance(key, str):
-                raise TypeError(f"Invalid key type: {key!r}")
+    def clear(self) -> None:
+        if dict.__len__(self):
+            super().clear()
+            self._touch()
+    
+    def __serialize__(self) -> dict:
+        '''
+        Serialize to a json dict, the values of config are always in json format
+        '''
+        def _to_json(value:Any) -> Any:
             if isinstance(value, dict):
-                for k, v in value.items():
-                    _check(k, v)
-                return
+                return {key: _to_json(val) for key, val in value.items()}
             if isinstance(value, list):
-                for i in value:
-                    _check(key, i)
-                return
-            if not isinstance(value, self.ALLOWED_VALUE_TYPE):
-                raise TypeError(f"Invalid value type: {value!r}")
-        _check(__key, __value)
-        return super().__setitem__(__key, __value)
-    
+                return [_to_json(val) for val in value]
+            return value
+        return _to_json(self)
+
     @staticmethod
     def __deserialize__(data:dict) -> Self:
         '''
@@ -91,7 +209,344 @@ class Config(EnhancedDict):
             if isinstance(value, dict):
                 value.update(super().__getitem__('global'))
 
-    __on_setter__ = None
+class _DELETED:
+    '''Placeholder for the key deleted in the layered config'''
+
+class _ViewList(list):
+    '''
+    List resolved from the layers of a view, which is a copy of the list in the layer,
+    it will be stored in the view when modified (copy-on-write)
+    '''
+    __slots__ = ('_view', '_key')
+
+    def __init__(self, value:list, view:LayeredConfig, key:str) -> None:
+        super().__init__(value)
+        self._view:LayeredConfig = view
+        self._key:str = key
+
+    def _modifier(name:str):
+        method = getattr(list, name)
+        def wrapper(self, *args, **kwargs):
+            ret = method(self, *args, **kwargs)
+            view = self._view
+            if view._overrides.get(self._key, None) is not self:
+                view._overrides[self._key] = self
+                dict.__setitem__(view, self._key, self)
+            view._mark_modified()
+            return ret
+        wrapper.__name__ = name
+        wrapper.__doc__ = method.__doc__
+        return wrapper
+    for _name in ('append', 'extend', 'insert', 'remove', 'pop', 'clear', 'sort', 'reverse',
+                  '__setitem__', '__delitem__', '__iadd__', '__imul__'):
+        locals()[_name] = _modifier(_name)
+    del _modifier, _name
+
+    def __reduce__(self):
+        # The copies are plain lists, detached from the view
+        return (list, (list(self),))
+
+class LayeredConfig(Config):
+    '''
+    Layered view of configs
+
+    The layers are looked up from the last to the first, like `collections.ChainMap`,
+    and the nested configs in the layers are merged into nested views lazily.
+    The layers are never modified, the modification is stored in the view itself,
+    and the nested views which are modified are kept in the view.
+    The dict storage of the view keeps the resolved values (the nested dicts are nested views),
+    so the code reading the dict directly (like `json.dumps`) gets the merged values,
+    it's filled when created, and refreshed when the view is accessed after any layer is modified,
+    only the modification of the configs (and views) is tracked, so the layers should be configs.
+
+    Examples
+    --------
+    ::
+        >>> base = Config({'a': 1, 'b': {'c': 2, 'd': 3}})
+        >>> top = Config({'b': {'c': 4}})
+        >>> view = LayeredConfig(base, top)
+        >>> view['b.c'], view['b.d']
+        (4, 3)
+        >>> view['a'] = 5
+        >>> view['a'], base['a'], view.modified
+        (5, 1, True)
+    '''
+    __slots__ = ('_layers', '_overrides', '_synced', '_parent', 'modified')
+
+    def __init__(self, *layers:dict) -> None:
+        self._layers:tuple[dict, ...] = ()
+        self._overrides:dict[str, Any] = {}
+        super().__init__()
+        self._layers = layers
+        '''Layers, from the lowest priority to the highest'''
+        self._overrides = {}
+        '''The modification of the view, the deleted keys are marked by `_DELETED`'''
+        self._synced:Optional[int] = None
+        '''Generation of the layers when the dict storage is synced'''
+        self._parent:Optional[tuple[LayeredConfig, str]] = None
+        '''The parent view and the key in it'''
+        self.modified:bool = False
+        '''Whether the view is modified'''
+        self._sync()
+
+    @property
+    def layers(self) -> tuple[dict, ...]:
+        '''Layers of the view'''
+        return self._layers
+
+    @property
+    def generation(self) -> int:
+        '''Generation of the view, increased when the view or any layer is modified'''
+        return self._generation + self._layers_generation()
+
+    def _layers_generation(self) -> int:
+        # The generations are only increased, so the sum is changed when any of them is changed
+        return sum(layer.generation for layer in self._layers if isinstance(layer, Config))
+
+    def _mark_modified(self) -> None:
+        view = self
+        while view is not None:
+            view._generation += 1
+            view.modified = True
+            if view._parent is None:
+                break
+            parent, key = view._parent
+            # Keep the modified nested view in the parent
+            if parent._overrides.get(key, None) is not view:
+                parent._overrides[key] = view
+                parent._sync()
+                dict.__setitem__(parent, key, view)
+            view = parent
+
+    def _new_view(self, key:str, layers:tuple[dict, ...]) -> LayeredConfig:
+        ret = LayeredConfig(*layers)
+        ret._parent = (self, key)
+        return ret
+
+    def _merge(self, key:str) -> Any:
+        '''
+        Merge the value of a key (without dot) from the layers, `_DELETED` if not found
+        '''
+        values = []
+        for layer in self._layers:
+            if isinstance(layer, LayeredConfig):
+                try:
+                    values.append(layer._resolve(key))
+                except KeyError:
+                    pass
+            elif dict.__contains__(layer, key):
+                values.append(layer[key])
+        if not values:
+            return _DELETED
+        if isinstance(values[-1], dict):
+            index = len(values)
+            while index > 0 and isinstance(values[index - 1], dict):
+                index -= 1
+            return self._new_view(key, tuple(values[index:]))
+        if isinstance(values[-1], list):
+            # The list in the layer should not be modified through the view
+            return _ViewList(values[-1], self, key)
+        return values[-1]
+
+    def _sync(self) -> None:
+        '''
+        Refresh the dict storage if any layer is modified since the last time
+        '''
+        generation = self._layers_generation()
+        if self._synced == generation:
+            return
+        self._synced = generation
+        keys:dict[str, None] = {}
+        for layer in self._layers:
+            keys.update(dict.fromkeys(layer.keys() if isinstance(layer, LayeredConfig) else dict.keys(layer)))
+        keys.update(dict.fromkeys(self._overrides))
+        dict.clear(self)
+        for key in keys:
+            value = self._overrides.get(key, _MISSING)
+            if value is _MISSING:
+                value = self._merge(key)
+            if value is not _DELETED:
+                dict.__setitem__(self, key, value)
+
+    def _resolve(self, key:str) -> Any:
+        '''
+        Resolve the value of a key (without dot), raise KeyError if not found
+        '''
+        self._sync()
+        ret = dict.get(self, key, _MISSING)
+        if ret is _MISSING:
+            raise KeyError(key)
+        return ret
+
+    def keys(self) -> list[str]:
+        self._sync()
+        return list(dict.keys(self))
+
+    def values(self) -> list[Any]:
+        return [value for _, value in self.items()]
+
+    def items(self) -> list[tuple[str, Any]]:
+        self._sync()
+        ret = list(dict.items(self))
+        for _, value in ret:
+            # The nested views are read directly after this (by json for example)
+            if isinstance(value, LayeredConfig):
+                value._sync()
+        return ret
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self) -> int:
+        self._sync()
+        return dict.__len__(self)
+
+    def __bool__(self) -> bool:
+        return len(self) != 0
+
+    def __contains__(self, __key: str) -> bool:
+        key, _, subpath = __key.partition('.')
+        try:
+            value = self._resolve(key)
+        except KeyError:
+            return False
+        if subpath:
+            return isinstance(value, dict) and subpath in value
+        return True
+
+    has = __contains__
+
+    def __getitem__(self, __key: str) -> Any:
+        key, _, subpath = __key.partition('.')
+        try:
+            value = self._resolve(key)
+        except KeyError:
+            # Create a empty nested view like defaultdict, it's kept only when modified,
+            # so the key added to the layers later is not hidden
+            value = self._new_view(key, ())
+        if subpath:
+            return value[subpath]
+        return value
+
+    def get(self, path:str, default:Any = ...) -> Any:
+        key, _, subpath = path.partition('.')
+        try:
+            value = self._resolve(key)
+        except KeyError:
+            return Config() if default is ... else default
+        if subpath:
+            if not isinstance(value, dict):
+                return Config() if default is ... else default
+            return value.get(subpath, default)
+        return value
+
+    def view(self, path:str, default:Any = ...) -> Any:
+        # The values are views already
+        return self.get(path, default)
+
+    def require(self, path:str) -> Any:
+        if path not in self:
+            raise ConfigureMissing(f"Configure missing: {path}",origin=self)
+        return self.get(path)
+
+    def __setitem__(self, __key: Any, __value: Any) -> None:
+        if not isinstance(__key, str):
+            raise TypeError(f"Invalid key type: {__key!r}")
+        key, _, subpath = __key.partition('.')
+        if subpath:
+            self[key][subpath] = __value
+            return
+        self._check_value(key, __value)
+        if isinstance(__value, dict) and not isinstance(__value, Config):
+            __value = Config(__value)
+        self._overrides[key] = self._adopt(__value)
+        self._sync()
+        dict.__setitem__(self, key, __value)
+        self._mark_modified()
+
+    set = __setitem__
+
+    def setdefault(self, path:str | dict, default:Any = None) -> Any:
+        if isinstance(path, dict):
+            for key, value in path.items():
+                self.setdefault(key, value)
+            return
+        if path not in self:
+            self[path] = default
+        return self[path]
+
+    def __delitem__(self, __key: str) -> None:
+        key, _, subpath = __key.partition('.')
+        if subpath:
+            del self[key][subpath]
+            return
+        self._resolve(key)
+        self._overrides[key] = _DELETED
+        dict.__delitem__(self, key)
+        self._mark_modified()
+
+    def pop(self, key:str, *args) -> Any:
+        try:
+            ret = self[key] if key in self else self._resolve(key)
+        except KeyError:
+            if args:
+                return args[0]
+            raise
+        del self[key]
+        return ret
+
+    def popitem(self) -> tuple[str, Any]:
+        keys = self.keys()
+        if not keys:
+            raise KeyError('popitem(): config is empty')
+        return keys[-1], self.pop(keys[-1])
+
+    def clear(self) -> None:
+        for key in self.keys():
+            self._overrides[key] = _DELETED
+        dict.clear(self)
+        self._mark_modified()
+
+    def materialize(self) -> Config:
+        '''
+        Merge the layers and modification into a new Config
+        '''
+        ret = Config()
+        for key, value in self.items():
+            if isinstance(value, LayeredConfig):
+                value = value.materialize()
+            elif isinstance(value, _ViewList):
+                value = list(value)
+            dict.__setitem__(ret, key, value)
+        return ret
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, LayeredConfig):
+            other = other.materialize()
+        return self.materialize() == other
+
+    def __ne__(self, other: object) -> bool:
+        return not self == other
+
+    def __repr__(self) -> str:
+        return repr(self.materialize())
+
+    __str__ = __repr__
+
+    def __copy__(self) -> Config:
+        return self.materialize()
+
+    def __deepcopy__(self, memo:dict) -> Config:
+        return copy.deepcopy(self.materialize(), memo)
+
+    def __reduce__(self):
+        return (Config, (self.materialize(),))
+
+    def __serialize__(self) -> dict:
+        return self.materialize().__serialize__()
+
+    def save(self, path:str) -> None:
+        self.materialize().save(path)
 
 ConfigModel = make_model(Config)
 '''
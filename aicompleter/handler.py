@@ -2,19 +2,23 @@
 Handler between the interfaces
 '''
 import asyncio
+import collections
 import copy
 import functools
 import importlib
 import json
+import os
+import shutil
+import time
 import uuid
-from typing import Any, Coroutine, Generator, Iterator, Optional, Self, overload
+from typing import Any, Callable, Coroutine, Generator, Iterator, Optional, Self, overload
 
 from . import utils
 from .utils.storage import StorageManager
 from .common import AsyncLifeTimeManager, Saveable
 
 from . import error, events, interface, log, session
-from .config import Config
+from .config import Config, LayeredConfig
 from .interface import Command, Interface, User, Group, UserSet, GroupSet
 from .interface.command import Commands
 from .session.base import Session
@@ -53,8 +57,53 @@ class Handler(AsyncLifeTimeManager, Saveable):
         '''User Set of Handler'''
         self._groupset:GroupSet = GroupSet()
         '''Group Set of Handler'''
-        self._running_sessions:list[Session] = []
-        '''Running Sessions of Handler'''
+        self._running_sessions:collections.OrderedDict[uuid.UUID, Session] = collections.OrderedDict()
+        '''Running Sessions of Handler, ordered by the last activity (the least recently used first)'''
+        self.session_ttl:Optional[float] = None
+        '''Max idle time (in seconds) of a session, the idle sessions will be evicted, None for no limit'''
+        self.max_sessions:Optional[int] = None
+        '''Max number of running sessions, the least recently used sessions will be evicted, None for no limit'''
+        self.session_save_dir:Optional[str] = None
+        '''Directory to save the evicted sessions, the sessions won't be saved if None'''
+        self._eviction_task:Optional[asyncio.Task] = None
+        self.autosave_path:Optional[str] = None
+        '''Path of the checkpoints, used by `checkpoint` and the autosave'''
+        self.autosave_interval:Optional[float] = None
+        '''Interval (in seconds) of the autosave, None to disable the autosave'''
+        self._autosave_task:Optional[asyncio.Task] = None
+        self._checkpoint_lock:asyncio.Lock = asyncio.Lock()
+        self._checkpoint_path:Optional[str] = None
+        '''Path of the last checkpoint'''
+        self._checkpoint_state:Optional[tuple[str, str]] = None
+        '''Serialized state and config of the last checkpoint'''
+        self._checkpoint_write_lock:asyncio.Lock = asyncio.Lock()
+        '''
+        Held from collecting the changes until the writer in the executor finishes,
+        the stores are not changed while the files are being written
+        '''
+        self._checkpoint_storage:Optional[tuple[StorageManager, StorageManager]] = None
+        '''Storage managers (root and sessions) of the last checkpoint'''
+        self.history_window:Optional[int] = None
+        '''
+        Max number of messages kept in memory of each session history, None for no limit (the default)
+
+        This is opt-in, when set, the older messages will be spilled to disk as json,
+        the message data which is not json serializable will be loaded as strings
+        '''
+        self.history_spill_dir:Optional[str] = None
+        '''Directory of the spilled session histories, the temporary directory by default'''
+        self.lazy_session_init:bool = False
+        '''
+        Whether to initialize the interfaces of the session lazily, 
+        when enabled, the session init of an interface will be run when its command is called in the session for the first time.
+        This can be overridden by `Interface.lazy_session_init`
+        '''
+        self._session_template:Optional[Config] = None
+        '''
+        Template of the session config, the merged config of the handler
+        This will be rebuilt when the config or the interfaces are changed
+        '''
+        self._session_template_key:Optional[tuple] = None
 
         self.logger:log.Logger = log.getLogger('handler')
         '''Logger of Handler'''
@@ -67,6 +116,8 @@ class Handler(AsyncLifeTimeManager, Saveable):
                 asyncio.set_event_loop(self._loop)
         else:
             self._loop = loop
+        # The pooled http session of the loop is closed when all the handlers on the loop are closed
+        utils.network.default_pool.acquire(self, self._loop)
         
         self._namespace = Namespace(
             name='root',
@@ -107,19 +158,102 @@ class Handler(AsyncLifeTimeManager, Saveable):
     async def close(self):
         '''Close the handler'''
         self.logger.debug("Closing handler")
-        for i in self._running_sessions:
+        if self._eviction_task is not None:
+            self._eviction_task.cancel()
+            self._eviction_task = None
+        if self._autosave_task is not None:
+            self._autosave_task.cancel()
+            self._autosave_task = None
+        for i in list(self._running_sessions.values()):
             if not i.closed:
                 await i.close()
+        if self.autosave_path is not None and self.autosave_interval is not None:
+            # The final checkpoint, with the sessions closed
+            await self.checkpoint()
         for i in self._interfaces:
             await i._invoke_final(self)
             await i.close()
+        # Release the pooled http connections of this loop, if no other handler is using them
+        await utils.network.default_pool.release(self, self._loop)
         await super().close()
 
     async def close_session(self, session:Session):
         '''Close the session'''
         await session.close()
-        self._running_sessions.remove(session)
+        self._running_sessions.pop(session.id, None)
+        self._update_running_sessions()
+
+    def get_session(self, id:uuid.UUID) -> Session:
+        '''
+        Get the running session by id
+        '''
+        try:
+            ret = self._running_sessions[id]
+        except KeyError:
+            raise error.NotFound(id, handler=self, content='Session Not In Handler') from None
+        if ret.closed:
+            self._running_sessions.pop(id)
+            raise error.NotFound(id, handler=self, content='Session Closed')
+        return ret
+
+    @property
+    def sessions(self) -> list[Session]:
+        '''Running sessions, the least recently used first'''
+        return list(self._running_sessions.values())
+
+    def _touch_session(self, session:Session) -> None:
+        '''Mark the activity of the session'''
+        session.last_active = time.time()
+        session._dirty = True
+        if session.id in self._running_sessions:
+            self._running_sessions.move_to_end(session.id)
+
+    def _add_session(self, session:Session) -> None:
+        self._running_sessions[session.id] = session
+        self._touch_session(session)
+        if self.session_ttl is not None and self._eviction_task is None:
+            self._eviction_task = self._loop.create_task(self._evict_loop())
+
+    async def _evict_loop(self):
+        while self.session_ttl is not None:
+            await asyncio.sleep(self.session_ttl / 2)
+            try:
+                await self.evict_sessions()
+            except Exception as e:
+                await self.on_exception.trigger(e)
+        self._eviction_task = None
+
+    async def evict_sessions(self) -> list[Session]:
+        '''
+        Evict the sessions by the idle ttl and max sessions policies, 
+        the evicted sessions will be saved (if session_save_dir is set) and closed.
+        The sessions with running commands won't be evicted.
+
+        :return: The evicted sessions
+        '''
         self._update_running_sessions()
+        victims:list[Session] = []
+        now = time.time()
+        excess = len(self._running_sessions) - self.max_sessions if self.max_sessions is not None else 0
+        for session in self._running_sessions.values():
+            if session._running_tasks:
+                continue
+            if excess > 0:
+                victims.append(session)
+                excess -= 1
+            elif self.session_ttl is not None and now - session.last_active > self.session_ttl:
+                victims.append(session)
+            else:
+                # The sessions are ordered by the last activity
+                break
+        for session in victims:
+            self.logger.debug("Evicting session %s", session.id)
+            if self.session_save_dir is not None:
+                os.makedirs(self.session_save_dir, exist_ok=True)
+                path = os.path.join(self.session_save_dir, session.id.hex)
+                await self._write_in_executor(lambda: session._prepare_save(path))
+            await self.close_session(session)
+        return victims
 
     def reload_users(self) -> None:
         '''Reload users from interfaces'''
@@ -156,12 +290,9 @@ class Handler(AsyncLifeTimeManager, Saveable):
         '''Get command by name'''
         if dst_interface == None:
             if src_interface == None:
-                return next(self._namespace.getcmd(cmd), None)
+                return self._namespace.get_executable_cmd(cmd)
             else:
-                # Create a new Commands class
-                ret = Commands()
-                ret.add(*self._namespace.get_executable(src_interface.user))
-                return ret.get(cmd, None)
+                return self._namespace.get_executable_cmd(cmd, src_interface.user)
         else:
             if dst_interface not in self._interfaces:
                 raise error.NotFound(interface, handler=self, content='Interface Not In Handler')
@@ -368,10 +499,11 @@ class Handler(AsyncLifeTimeManager, Saveable):
         #         raise error.PermissionDenied(from_, cmd, self)
         message.session = session
         message.dest_interface = cmd.in_interface
+        self._touch_session(session)
 
         if not message._check_cache.get('src_interface', False): 
             if message.src_interface is None:
-                callercommand = getcallercommand(commands=self._namespace.get_executable())
+                callercommand = getcallercommand()
                 if callercommand:
                     message.src_interface = callercommand.in_interface
             message._check_cache['src_interface'] = True
@@ -391,7 +523,7 @@ class Handler(AsyncLifeTimeManager, Saveable):
         
         if not message._check_cache.get('src_interface', False): 
             if message.src_interface == None:
-                callercommand = getcallercommand(commands=self._namespace.get_executable())
+                callercommand = getcallercommand()
                 if callercommand:
                     message.src_interface = callercommand.in_interface
             message._check_cache['src_interface'] = True
@@ -404,12 +536,12 @@ class Handler(AsyncLifeTimeManager, Saveable):
                     call_groups = message.dest_interface.check_cmd_support(message.cmd).callable_groups
                     if any([i in call_groups for i in message.src_interface.user.all_groups]) == False:
                         raise error.PermissionDenied(message.cmd, interface=message.src_interface, handler=self)
-            else:
-                if self.get_cmd(message.cmd) == None:
-                    raise error.CommandNotImplement(message.cmd, self, detail = "Either the command is not implemented in the handler or the interface has no permission to call the command.")
         message.session = session
+        self._touch_session(session)
         cmd = self.get_cmd(message.cmd, message.dest_interface, message.src_interface)
         if cmd == None:
+            if message.src_interface and not message.dest_interface:
+                raise error.CommandNotImplement(message.cmd, self, detail = "Either the command is not implemented in the handler or the interface has no permission to call the command.")
             raise error.CommandNotImplement(message.cmd, self)
 
         async def _handle_call():
@@ -432,9 +564,25 @@ class Handler(AsyncLifeTimeManager, Saveable):
         self._loop.create_task(_handle_call())
 
     def _update_running_sessions(self):
-        for i in self._running_sessions:
-            if i.closed:
-                self._running_sessions.remove(i)
+        for id in [id for id, i in self._running_sessions.items() if i.closed]:
+            del self._running_sessions[id]
+
+    def _get_session_template(self) -> Config:
+        '''
+        Get the session config template, rebuild it if the config or the interfaces are changed
+
+        The template should not be modified, use a layered view of it instead
+        '''
+        key = (id(self.config), self.config.generation, tuple(id(i) for i in self._interfaces))
+        if self._session_template is None or self._session_template_key != key:
+            template = copy.deepcopy(self.config)
+            template.each(
+                lambda key,value: value.update(template['global']),
+                lambda key,value: key != 'global'
+            )
+            self._session_template = template
+            self._session_template_key = key
+        return self._session_template
 
     async def new_session(self, 
                           config:Optional[Config] = None) -> session.Session:
@@ -449,17 +597,16 @@ class Handler(AsyncLifeTimeManager, Saveable):
         # Initialize session
         ret.config = config
         if config == None:
-            ret.config = copy.deepcopy(self.config)
-            ret.config.each(
-                lambda key,value: value.update(ret.config['global']),
-                lambda key,value: key != 'global'
-            )
+            # Copy-on-write, the template is shared by the sessions
+            ret.config = LayeredConfig(self._get_session_template())
         try:
             await ret._init_session()
         except Exception as e:
             self.logger.critical("Unexception: %s", e)
             raise e
-        self._running_sessions.append(ret)
+        self._add_session(ret)
+        if self.max_sessions is not None and len(self._running_sessions) > self.max_sessions:
+            await self.evict_sessions()
         return ret
     
     def loadSession(self, data:dict[str, Any]) -> session.Session:
@@ -472,10 +619,11 @@ class Handler(AsyncLifeTimeManager, Saveable):
             for j in self._interfaces:
                 if j.id.hex == i['id']:
                     j.setStorage(ret, i['data'])
+                    ret._initialized_interfaces.add(j.id)
                     break
             else:
                 raise error.NotFound("Interface %s not found" % i['id'], handler=self)
-        self._running_sessions.append(ret)
+        self._add_session(ret)
         return ret
     
     def getstate(self):
@@ -549,32 +697,157 @@ class Handler(AsyncLifeTimeManager, Saveable):
                     raise error.NotFound(cmd['name'], interface=_inter, handler=self)
                 _inter.commands[cmd['name']].callable_groups = set(cmd['callable_groups'])
 
+    def _prepare_checkpoint(self, path:str | StorageManager) -> Callable[[], None]:
+        '''
+        Collect the changes since the last checkpoint in the event loop,
+        only the dirty sessions, and the config and interfaces when changed, are collected.
+
+        :return: The writer to write the changes, which can be run in another thread
+        '''
+        if isinstance(path, StorageManager):
+            root = path
+        elif self._checkpoint_storage is not None and self._checkpoint_path == path:
+            root = self._checkpoint_storage[0]
+        else:
+            root = StorageManager.load(path) if StorageManager.isstoragedir(path) else StorageManager(path)
+        full = self._checkpoint_path != root.path
+        if full or self._checkpoint_storage is None or self._checkpoint_storage[0] is not root:
+            if 'sessions' in root:
+                sessions = StorageManager.load(root['sessions'].path)
+            else:
+                sessions = root.alloc_storage('sessions')
+            self._checkpoint_storage = (root, sessions)
+        sessions = self._checkpoint_storage[1]
+        files:list[tuple[str, str]] = []
+        state = (json.dumps(self.getstate()), json.dumps(self.config))
+        if full or self._checkpoint_state != state:
+            # The files are allocated here, the index is written by the writer
+            for mark, data in zip(('intmeta', 'config'), state):
+                file = root[mark].path if mark in root else root.alloc_file(mark)
+                files.append((file, data))
+        writers:list[Callable[[], None]] = []
+        # The sessions removed (closed or evicted) since the last checkpoint are dropped, so they won't be loaded again
+        running = {i.hex for i in self._running_sessions}
+        removed = [i for i in sessions if i.mark not in running]
+        for i in removed:
+            sessions.delete(i.mark)
+        for i in self._running_sessions.values():
+            if not (full or i._dirty):
+                continue
+            if i.id.hex in sessions:
+                session_path = sessions[i.id.hex].path
+            else:
+                session_path = sessions.alloc_folder(i.id.hex)
+            writer = i._prepare_save(session_path)
+            if writer is not None:
+                writers.append(writer)
+        self._checkpoint_path = root.path
+        self._checkpoint_state = state
+
+        def _write():
+            for file, data in files:
+                utils.write_atomic(file, data)
+            for writer in writers:
+                writer()
+            sessions.save()
+            root.save()
+            # Removed after the index is written
+            for i in removed:
+                shutil.rmtree(i.path, ignore_errors=True)
+        return _write
+
+    def _invalidate_checkpoint(self) -> None:
+        '''Force the next checkpoint to be a full save'''
+        self._checkpoint_path = None
+        self._checkpoint_state = None
+        for i in self._running_sessions.values():
+            i._dirty = True
+
+    async def _write_in_executor(self, prepare:Callable[[], Optional[Callable[[], None]]]) -> None:
+        '''
+        Collect the changes in the event loop and run the writer in the executor,
+        the write lock is held until the writer finishes, even if cancelled
+
+        :param prepare: Function to collect the changes, return the writer, None if nothing to write
+        '''
+        await self._checkpoint_write_lock.acquire()
+        try:
+            writer = prepare()
+        except BaseException:
+            self._checkpoint_write_lock.release()
+            raise
+        if writer is None:
+            self._checkpoint_write_lock.release()
+            return
+        future = self._loop.run_in_executor(None, writer)
+        future.add_done_callback(lambda _: self._checkpoint_write_lock.release())
+        await asyncio.shield(future)
+
     def save(self, path:str | StorageManager):
-        '''Save handler to path'''
-        if isinstance(path, str):
-            path = StorageManager(path)
-        intmeta = self.getstate()
-        with open(path.alloc_file('intmeta'), 'w') as f:
-            json.dump(intmeta, f)
-        with open(path.alloc_file('config'), 'w') as f:
-            json.dump(self.config, f)
-        sessions = path.alloc_storage('sessions')
-        for i in self._running_sessions:
-            session_storage = sessions.alloc_storage(i.id.hex)
-            i.save(session_storage, True)
-        sessions.save()
-        path.save()
-        self.logger.info("Handler saved to %s", path.path)
+        '''
+        Save handler to path, this should be called in the event loop
+
+        Only the changes since the last checkpoint are written when saving to the same path again,
+        use `checkpoint` not to block the event loop
+        '''
+        if self._checkpoint_write_lock.locked():
+            # The stores can't be changed while the writer in flight is reading them
+            raise error.Conflict("A checkpoint is being written, await checkpoint() instead", handler=self)
+        try:
+            self._prepare_checkpoint(path)()
+        except BaseException:
+            self._invalidate_checkpoint()
+            raise
+        self.logger.info("Handler saved to %s", self._checkpoint_path)
+
+    async def checkpoint(self, path:Optional[str] = None) -> None:
+        '''
+        Save the changes since the last checkpoint, the files are written in the executor,
+        so the event loop won't be blocked
+
+        :param path: The path to save, `autosave_path` by default
+        '''
+        path = path or self.autosave_path
+        if path is None:
+            raise ValueError("No checkpoint path specified")
+        async with self._checkpoint_lock:
+            try:
+                await self._write_in_executor(lambda: self._prepare_checkpoint(path))
+            except BaseException:
+                self._invalidate_checkpoint()
+                raise
+        self.logger.debug("Checkpoint saved to %s", path)
+
+    def autosave(self, path:Optional[str] = None, interval:Optional[float] = None) -> None:
+        '''
+        Start the periodic checkpoints, a final checkpoint will be saved when the handler is closed
+
+        :param path: The path to save, `autosave_path` by default
+        :param interval: The interval (in seconds), `autosave_interval` by default
+        '''
+        self.autosave_path = path or self.autosave_path
+        self.autosave_interval = interval or self.autosave_interval
+        if self.autosave_path is None or self.autosave_interval is None:
+            raise ValueError("The autosave path and interval are required")
+        if self._autosave_task is None:
+            self._autosave_task = self._loop.create_task(self._autosave_loop())
+
+    async def _autosave_loop(self):
+        while self.autosave_interval is not None:
+            await asyncio.sleep(self.autosave_interval)
+            try:
+                await self.checkpoint()
+            except Exception as e:
+                await self.on_exception.trigger(e)
+        self._autosave_task = None
 
     @classmethod
     def load(cls, path:str | StorageManager, prehandler: Optional[Self] = None):
         '''Load handler from path'''
         if isinstance(path, str):
             path = StorageManager.load(path)
-        with open(path['intmeta'].path, 'r') as f:
-            intmeta = json.load(f)
-        with open(path['config'].path, 'r') as f:
-            config = Config(json.load(f))
+        intmeta = json.loads(path.read('intmeta'))
+        config = Config(json.loads(path.read('config')))
         if prehandler:
             ret = prehandler
             ret._namespace.config = config
@@ -583,9 +856,7 @@ class Handler(AsyncLifeTimeManager, Saveable):
         ret.setstate(intmeta)
         sessions = StorageManager.load(path['sessions'].path)
         for i in sessions:
-            session_storage = sessions[i.mark]
-            ret._running_sessions.append(Session.load(
-                StorageManager.load(session_storage.path), ret))
+            ret._add_session(Session.load(sessions[i.mark].path, ret))
         return ret
 
 __all__ = (
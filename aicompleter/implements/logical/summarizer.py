@@ -3,6 +3,7 @@ import uuid
 
 from ...ai.implements.openai.api import Chater
 from ...ai import ChatInterface, AI
+from ...ai.cache import single_flight
 from ... import *
 
 class SummaryInterface(ChatInterface):
@@ -20,6 +21,10 @@ class SummaryInterface(ChatInterface):
             config=config,
             id=id,
         )
+        self._flight:utils.SingleFlight = utils.SingleFlight()
+        '''The summaries in flight, the same text summarized by the concurrent sessions is requested only once'''
+        self._flight_ai = single_flight(self.ai, self._flight)
+        '''The ai sharing the summaries in flight'''
         
     async def summarize(self, text: str, user:Optional[str] = None, language:str = 'en-us') -> str:
         '''
@@ -40,7 +45,7 @@ Here is the text:
 '''
         )    
         from ... import language as lg
-        ret = await self.ai.ask_once(base_conversation, ai.Message(
+        ret = await self._flight_ai.ask_once(base_conversation, ai.Message(
             content = lg.DICT[language]['start_task'],
             role = 'user',
         ))
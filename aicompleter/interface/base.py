@@ -5,14 +5,15 @@ import copy
 import json
 import os
 import uuid
-from typing import Coroutine, Optional, Self, TypeVar, Union, overload
+from typing import Any, Callable, Coroutine, Optional, Self, TypeVar, Union, overload
 import asyncio
+import weakref
 
 import attr
 
 from .. import config, error, handler, log, session, utils
 from ..common import AsyncLifeTimeManager, JSONSerializable
-from ..config import Config, ConfigModel
+from ..config import Config, ConfigModel, LayeredConfig
 from ..session import Session
 from ..namespace import Namespace, BaseNamespace
 from ..utils import EnhancedDict
@@ -20,6 +21,37 @@ from .command import Command, Commands
 
 Handler = TypeVar('Handler', bound='handler.Handler')
 
+_hook_plans:weakref.WeakKeyDictionary[type, dict[str, tuple[tuple[Callable, frozenset[str]], ...]]] = weakref.WeakKeyDictionary()
+'''
+Cached hook plans of the interface classes
+'''
+
+def _get_hook_plan(cls:type, method_name:str) -> tuple[tuple[Callable, frozenset[str]], ...]:
+    '''
+    Get the hook plan of the class, 
+    which is the inherited methods (ordered by mro, base class first) and their parameter names
+
+    The plan is computed once per class
+    '''
+    plans = _hook_plans.get(cls, None)
+    if plans is None:
+        plans = _hook_plans[cls] = {}
+    ret = plans.get(method_name, None)
+    if ret is None:
+        from ..utils.typeval import get_signature
+        ret = plans[method_name] = tuple(
+            (func, frozenset(get_signature(func).parameters))
+            for func in utils.get_inherit_methods(cls, method_name) if callable(func)
+        )
+    return ret
+
+async def _run_hook_plan(plan:tuple[tuple[Callable, frozenset[str]], ...], instance:object, parameters:dict[str, Any], reverse:bool = False) -> None:
+    '''
+    Run the hook plan with the appliable parameters
+    '''
+    for func, names in (reversed(plan) if reverse else plan):
+        await func(instance, **{name: value for name, value in parameters.items() if name in names})
+
 @attr.dataclass(hash=False)
 class User(JSONSerializable):
     '''User'''
@@ -283,6 +315,11 @@ class Interface(AsyncLifeTimeManager):
     '''
     Data Factory, this factory will be used to create a data class for the interface
     '''
+    lazy_session_init: Optional[bool] = None
+    '''
+    Whether to run the session init lazily (when a command of this interface is called in the session for the first time),
+    None means following the setting of the handler
+    '''
     namespace: Optional[BaseNamespace] = None
     '''
     Base Namespace, this namespace will be used to create a namespace for the interface
@@ -291,12 +328,14 @@ class Interface(AsyncLifeTimeManager):
     def __init__(self, 
                  namespace:Optional[str] = None, 
                  user:Optional[User] = None,
-                 id:uuid.UUID = uuid.uuid4(), 
+                 id:Optional[uuid.UUID] = None, 
                  config: config.Config = config.Config()):
         
         super().__init__()
         self._user = user
         '''Character of the interface'''
+        if id is None:
+            id = uuid.uuid4()
         utils.typecheck(id, uuid.UUID)
         self._id:uuid.UUID = id
         '''ID'''
@@ -396,36 +435,21 @@ class Interface(AsyncLifeTimeManager):
         '''
         Invoke the init function of the interface
         '''
-        # find all init functions from the mro
-        inits = []
-        for func in utils.get_inherit_methods(self.__class__, "init"):
-            if callable(func):
-                inits.append(func)
-        # invoke all init functions
-        for i in inits:
-            params = utils.appliable_parameters(i, {
-                'in_handler': in_handler,
-                'handler': in_handler
-            })
-            await i(self, **params)
+        # invoke all init functions from the mro
+        await _run_hook_plan(_get_hook_plan(self.__class__, "init"), self, {
+            'in_handler': in_handler,
+            'handler': in_handler
+        })
 
     async def _invoke_final(self, in_handler: Handler):
         '''
         Invoke the final function of the interface
         '''
-        # find all final functions from the mro
-        finals = []
-        for func in utils.get_inherit_methods(self.__class__, "final"):
-            if callable(func):
-                finals.append(func)
-        finals.reverse()
         # invoke all final functions, from the last to the first
-        for i in finals:
-            params = utils.appliable_parameters(i, {
-                'in_handler': in_handler,
-                'handler': in_handler
-            })
-            await i(self, **params)
+        await _run_hook_plan(_get_hook_plan(self.__class__, "final"), self, {
+            'in_handler': in_handler,
+            'handler': in_handler
+        }, reverse=True)
 
     async def session_init(self):
         '''
@@ -458,42 +482,29 @@ class Interface(AsyncLifeTimeManager):
         '''
         Invoke the session init function of the interface
         '''
-        session_inits = []
-        for func in utils.get_inherit_methods(self.__class__, "session_init"):
-            if callable(func):
-                session_inits.append(func)
         raw_data = self.getdata(session)
         raw_config = self.getconfig(session)
-        for i in session_inits:
-            params = utils.appliable_parameters(i, {
-                'session': session,
-                'data': raw_data,
-                'config': raw_config
-            })
-            await i(self, **params)
+        await _run_hook_plan(_get_hook_plan(self.__class__, "session_init"), self, {
+            'session': session,
+            'data': raw_data,
+            'config': raw_config
+        })
         self.setdata(session, raw_data)
-        self.setconfig(raw_config, session)
+        self._write_back_config(raw_config, session)
 
     async def _invoke_session_final(self, session: Session):
         '''
         Invoke the session final function of the interface
         '''
-        session_finals = []
-        for func in utils.get_inherit_methods(self.__class__, "session_final"):
-            if callable(func):
-                session_finals.append(func)
-        session_finals.reverse()
         raw_data = self.getdata(session)
         raw_config = self.getconfig(session)
-        for i in session_finals:
-            params = utils.appliable_parameters(i, {
-                'session': session,
-                'data': raw_data,
-                'config': raw_config
-            })
-            await i(self, **params)
+        await _run_hook_plan(_get_hook_plan(self.__class__, "session_final"), self, {
+            'session': session,
+            'data': raw_data,
+            'config': raw_config
+        }, reverse=True)
         self.setdata(session, raw_data)
-        self.setconfig(raw_config, session)
+        self._write_back_config(raw_config, session)
 
     @overload
     def getconfig(self, session:session.Session) -> Config:
@@ -512,13 +523,32 @@ class Interface(AsyncLifeTimeManager):
         :return: Session Config, if session is None, return interface config
         '''
         # There is a config conflict when using mutable interface
-        ret = (configFactory or self.configFactory)()
-        ret.update(session.config['global'])
-        ret.update(self.namespace.config)
+        factory = configFactory or self.configFactory
         if session:
-            ret.update(session.config[self.namespace.name])
+            layers = (session.config['global'], self.namespace.config, session.config[self.namespace.name])
+        else:
+            layers = (self.namespace.config, )
+        if factory is Config or issubclass(factory, ConfigModel):
+            # Layered view, the configs are not merged until modified
+            view = LayeredConfig(*layers)
+            return view if factory is Config else factory(view)
+        ret = factory()
+        for layer in layers:
+            ret.update(layer)
         return ret
     
+    def _write_back_config(self, config: Config, session:session.Session):
+        '''
+        Write the config got by getconfig back to the session, only when it's modified
+        '''
+        if isinstance(config, ConfigModel):
+            config = config.__wrapped__
+        if isinstance(config, LayeredConfig):
+            if not config.modified:
+                return
+            config = config.materialize()
+        self.setconfig(config, session)
+
     def setconfig(self, config: Config, session:Optional[session.Session] = None):
         '''
         Set the config of the interface
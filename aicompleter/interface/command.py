@@ -9,6 +9,7 @@ import copy
 import functools
 import json
 import os
+import weakref
 from typing import (Any, Callable, Coroutine, Generator, Iterable, Iterator,
                     Optional, Self, TypeVar, overload)
 
@@ -21,7 +22,7 @@ import aicompleter
 from .. import config, error, log, session, utils
 from ..common import JSONSerializable
 from ..session.base import MultiContent
-from ..utils.special import getcallercommand
+from ..utils.special import getcallercommand, running_command
 
 Interface = TypeVar('Interface', bound='aicompleter.interface.Interface')
 User = TypeVar('User', bound='aicompleter.interface.User')
@@ -76,6 +77,94 @@ class CommandParamElement(JSONSerializable):
                     type=self.type.__name__ if isinstance(self.type,type) else 'auto',
                 )
 
+class _INVALID:
+    '''Placeholder for the invalid data'''
+
+def _compile_struct(struct:dict|list|CommandParamElement|CommandParamStruct) -> tuple[Callable[[Any], bool], Callable[[Any], Any]]:
+    '''
+    Compile the struct into a validator and a normalizer(validator and defaulter)
+
+    The normalizer return _INVALID if the data is not in proper format,
+    otherwise the data with default values, the containers are copied only when modified
+    '''
+    if isinstance(struct, CommandParamElement):
+        type_ = struct.type
+        if isinstance(type_, type):
+            def check(data) -> bool:
+                return isinstance(data, type_)
+        elif callable(type_):
+            def check(data) -> bool:
+                return bool(type_(data))
+        else:
+            raise TypeError("struct.type must be a type or a callable function")
+        def normalize(data):
+            return data if check(data) else _INVALID
+        return check, normalize
+    if isinstance(struct, list):
+        item_check, item_normalize = _compile_struct(struct[0])
+        def check(data) -> bool:
+            if not isinstance(data, list):
+                return False
+            for item in data:
+                if not item_check(item):
+                    return False
+            return True
+        def normalize(data):
+            if not isinstance(data, list):
+                return _INVALID
+            ret = data
+            for index, item in enumerate(data):
+                new_item = item_normalize(item)
+                if new_item is _INVALID:
+                    return _INVALID
+                if new_item is not item:
+                    if ret is data:
+                        ret = list(data)
+                    ret[index] = new_item
+            return ret
+        return check, normalize
+    if isinstance(struct, dict):
+        # (key, check, normalize, optional, default)
+        fields = []
+        for key, value in struct.items():
+            sub_check, sub_normalize = _compile_struct(value)
+            optional = isinstance(value, CommandParamElement) and value.optional
+            fields.append((key, sub_check, sub_normalize, optional, value.default if optional else None))
+        fields = tuple(fields)
+        def check(data) -> bool:
+            if not isinstance(data, dict):
+                return False
+            for key, sub_check, _, optional, _ in fields:
+                if key not in data:
+                    if optional:
+                        continue
+                    return False
+                if not sub_check(data[key]):
+                    return False
+            return True
+        def normalize(data):
+            if not isinstance(data, dict):
+                return _INVALID
+            ret = data
+            for key, _, sub_normalize, optional, default in fields:
+                if key not in data:
+                    if not optional:
+                        return _INVALID
+                    new_value = default
+                else:
+                    value = data[key]
+                    new_value = sub_normalize(value)
+                    if new_value is _INVALID:
+                        return _INVALID
+                    if new_value is value:
+                        continue
+                if ret is data:
+                    ret = dict(data)
+                ret[key] = new_value
+            return ret
+        return check, normalize
+    raise TypeError("struct must be a dict, list or CommandParamElement instance")
+
 class CommandParamStruct(JSONSerializable):
     '''
     Command Parameters Struct
@@ -83,8 +172,8 @@ class CommandParamStruct(JSONSerializable):
     '''
     @staticmethod
     def _check_struct(struct:dict|list|CommandParamElement) -> None:
-        if not isinstance(struct, (dict, list, CommandParamElement)):
-            raise TypeError("struct must be a dict, list or CommandParamElement instance")
+        if not isinstance(struct, (dict, list, CommandParamElement, CommandParamStruct)):
+            raise TypeError("struct must be a dict, list, CommandParamElement or CommandParamStruct instance")
         if isinstance(struct, dict):
             for i in struct:
                 CommandParamStruct._check_struct(struct[i])
@@ -95,9 +184,24 @@ class CommandParamStruct(JSONSerializable):
         elif isinstance(struct, CommandParamElement):
             pass
 
+    @staticmethod
+    def _unwrap_struct(struct:dict|list|CommandParamElement|CommandParamStruct) -> dict|list|CommandParamElement:
+        # The nested struct (loaded by load_brief) is stored as its raw struct
+        if isinstance(struct, CommandParamStruct):
+            return struct._struct
+        if isinstance(struct, dict):
+            return {key: CommandParamStruct._unwrap_struct(value) for key, value in struct.items()}
+        if isinstance(struct, list):
+            return [CommandParamStruct._unwrap_struct(value) for value in struct]
+        return struct
+
     def __init__(self, struct:dict|list|CommandParamElement) -> None:
-        self._struct = struct
         CommandParamStruct._check_struct(struct)
+        self._struct = CommandParamStruct._unwrap_struct(struct)
+        self._check:Optional[Callable[[Any], bool]] = None
+        '''Compiled validator'''
+        self._normalize:Optional[Callable[[Any], Any]] = None
+        '''Compiled validator and defaulter, return _INVALID if the data is not in proper format'''
 
     def __iter__(self) -> Iterator[CommandParamElement | CommandParamStruct | list | dict]:
         '''Iterate the struct'''
@@ -111,67 +215,57 @@ class CommandParamStruct(JSONSerializable):
         '''Iterate the struct'''
         return self._struct.items()
 
+    def compile(self) -> None:
+        '''
+        Compile the struct into flat closures, the struct will not be walked again when checking
+
+        This is called when the struct is set as the format of a command, and only once for each struct
+        '''
+        if self._check is None:
+            self._check, self._normalize = _compile_struct(self._struct)
+
     def check(self, data:dict) -> bool:
         '''Check the data to see whether it is in proper format.'''
         if isinstance(data, str):
             data = json.loads(data)
+        self.compile()
+        return self._check(data)
 
-        def _check(struct:dict|list|CommandParamElement, ndata:dict):
-            if isinstance(struct, dict):
-                for key,value in struct.items():
-                    if isinstance(value,CommandParamElement):
-                        if value.optional and key not in ndata:
-                            continue
-                    if key not in ndata:
-                        return False
-                    if not _check(value, ndata[key]):
-                        return False
-                return True
-            elif isinstance(struct, list):
-                if not isinstance(ndata, list):
-                    return False
-                for item in ndata:
-                    if not _check(struct[0], item):
-                        return False
-                return True
-            elif isinstance(struct, CommandParamElement):
-                if isinstance(struct.type, type):    
-                    if not isinstance(ndata, struct.type):
-                        return False
-                    return True
-                elif callable(struct.type):
-                    if not struct.type(ndata):
-                        return False
-                    return True
-                else:
-                    raise TypeError("struct.type must be a type or a callable function")
-        return _check(self._struct, data)
+    def check_many(self, datas:Iterable[dict]) -> list[bool]:
+        '''Check a batch of data to see whether they are in proper format.'''
+        self.compile()
+        check = self._check
+        return [check(json.loads(data) if isinstance(data, str) else data) for data in datas]
+
+    def normalize(self, data:dict) -> dict:
+        '''
+        Check the data and set the default values in a single pass
+
+        The data is not modified, the containers with defaults set are copied,
+        and the others are shared with the data
+        :raise ValueError: the data is not in proper format
+        '''
+        if isinstance(data, str):
+            data = json.loads(data)
+        self.compile()
+        ret = self._normalize(data)
+        if ret is _INVALID:
+            raise ValueError("data is not in proper format")
+        return ret
     
     def setdefault(self, data:dict):
         '''
         Set the default value if the parameter is optional and with default value
+
+        The data is not modified, a new data is returned if any default value is set
         '''
-        data = copy.deepcopy(data)
         if isinstance(data, str):
             data = json.loads(data)
-
-        def _set(struct:dict|list|CommandParamElement, ndata:dict):
-            if isinstance(struct, dict):
-                for key,value in struct.items():
-                    if isinstance(value,CommandParamElement):
-                        if value.optional and key not in ndata:
-                            ndata[key] = value.default
-                    _set(value, ndata[key])
-            elif isinstance(struct, list):
-                if not isinstance(ndata, list):
-                    raise TypeError("data must be a list")
-                for item in ndata:
-                    _set(struct[0], item)
-            elif isinstance(struct, CommandParamElement):
-                ...
-
-        _set(self._struct, data)
-        return data
+        self.compile()
+        ret = self._normalize(data)
+        if ret is _INVALID:
+            return data
+        return ret
     
     def __serialize__(self):
         '''
@@ -294,10 +388,112 @@ class CommandAuthority(JSONSerializable):
         # square mean
         return sum([_level_map[i]**2 for i in self.__dict__ if self.__dict__[i] == True])**0.5
 
+class _BindingPlan:
+    '''
+    Binding plan of a command callback, built when the callback is bound
+
+    It records which injectable values the callback requires and which keys of the payload it accepts
+    '''
+    __slots__ = ('injectors', 'payload_keys', 'param_count')
+
+    INJECTABLES:dict[str, Callable[[Command, session.Session, session.Message], Any]] = {
+        'session': lambda cmd, session, message: session,
+        'message': lambda cmd, session, message: message,
+        'logger': lambda cmd, session, message: cmd.logger,
+        'interface': lambda cmd, session, message: cmd.in_interface,
+        'config': lambda cmd, session, message: cmd.in_interface.getconfig(session),
+        'data': lambda cmd, session, message: cmd.in_interface.getdata(session),
+        'content': lambda cmd, session, message: message.content,
+    }
+    '''The values that can be injected into the callback, computed only when required'''
+
+    def __init__(self, injectors:tuple[tuple[str, Callable], ...], payload_keys:tuple[str, ...], param_count:int) -> None:
+        self.injectors = injectors
+        self.payload_keys = payload_keys
+        self.param_count = param_count
+
+    @classmethod
+    def build(cls, callback:Optional[Callable]) -> Optional[_BindingPlan]:
+        '''Build the binding plan of the callback'''
+        if callback is None:
+            return None
+        parameters = utils.get_signature(callback).parameters
+        return cls(
+            injectors=tuple((name, inject) for name, inject in cls.INJECTABLES.items() if name in parameters),
+            payload_keys=tuple(name for name in parameters if name not in cls.INJECTABLES),
+            param_count=len(parameters),
+        )
+
+    def bind(self, cmd:Command, session:session.Session, message:session.Message) -> dict[str, Any]:
+        '''Get the arguments of the callback, the payload doesn't override the injected values'''
+        params = {name: inject(cmd, session, message) for name, inject in self.injectors}
+
+        # if the parameter is in json format, load it
+        if self.payload_keys:
+            with contextlib.suppress(json.JSONDecodeError):
+                # use message content because it has been loaded by format
+                data = message.content._parsed()
+                if isinstance(data, dict):
+                    for k in self.payload_keys:
+                        if k in data:
+                            # Only the bound values are copied
+                            params[k] = message.content[k]
+        return params
+
+def _link(refs:list[weakref.ReferenceType], obj:Any) -> None:
+    '''Add a weak reference of the object to the list, the dead references are dropped'''
+    refs[:] = [ref for ref in refs if ref() is not None and ref() is not obj]
+    refs.append(weakref.ref(obj))
+
+def _unlink(refs:list[weakref.ReferenceType], obj:Any) -> None:
+    '''Remove the weak reference of the object from the list'''
+    refs[:] = [ref for ref in refs if ref() is not None and ref() is not obj]
+
+def _notify(refs:list[weakref.ReferenceType]) -> None:
+    '''Notify the alive referents that they are changed'''
+    for ref in list(refs):
+        obj = ref()
+        if obj is not None:
+            obj._changed()
+
+class CommandGroups(set[str]):
+    '''
+    Callable groups of a command
+
+    The modification will be notified to the command sets containing the command
+    '''
+    _command:Optional[weakref.ReferenceType[Command]] = None
+    '''The command of the groups'''
+
+    def _modifier(name:str):
+        method = getattr(set, name)
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            ret = method(self, *args, **kwargs)
+            command = self._command() if self._command is not None else None
+            if command is not None:
+                command._changed()
+            return ret
+        return wrapper
+    for _name in ('add', 'clear', 'discard', 'pop', 'remove', 'update',
+                  'difference_update', 'intersection_update', 'symmetric_difference_update',
+                  '__ior__', '__iand__', '__isub__', '__ixor__'):
+        locals()[_name] = _modifier(_name)
+    del _modifier, _name
+
+    def __repr__(self) -> str:
+        return repr(set(self))
+
+def _touch_setattr(inst, attr_, value):
+    if isinstance(value, CommandGroups):
+        value._command = weakref.ref(inst)
+    inst._changed()
+    return value
+
 @attrs.define(slots=False)
 class Command(JSONSerializable):
     '''Command Struct'''
-    cmd:str = field(default="", kw_only=False)
+    cmd:str = field(default="", kw_only=False, on_setattr=_touch_setattr)
     '''Command'''
     description:str = field(default="", kw_only=False)
     '''
@@ -305,7 +501,7 @@ class Command(JSONSerializable):
     
     This is sometimes necessery for AI to know what the command is
     '''
-    alias:set[str] = field(default=set(), kw_only=True)
+    alias:set[str] = field(default=set(), kw_only=True, converter=set, on_setattr=attr.setters.pipe(attr.setters.convert, _touch_setattr))
     '''Alias Names'''
 
     @staticmethod
@@ -314,14 +510,17 @@ class Command(JSONSerializable):
             inst.check = lambda x: True
             return None
         if isinstance(value, (dict, list)):
-            return CommandParamStruct.load_brief(value)
-        utils.typecheck(value, (CommandParamStruct, CommandParamElement))
+            value = CommandParamStruct.load_brief(value)
+        elif isinstance(value, CommandParamElement):
+            value = CommandParamStruct(value)
+        utils.typecheck(value, CommandParamStruct)
+        value.compile()
         inst.check = value.check
         return value
     
     format:Optional[CommandParamStruct] = field(default=None, kw_only=True, on_setattr=__format_setattr)
     '''Format For Command, if None, no format required'''
-    callable_groups:set[str] = field(default=set(), kw_only=True)
+    callable_groups:set[str] = field(default=set(), kw_only=True, converter=CommandGroups, on_setattr=attr.setters.pipe(attr.setters.convert, _touch_setattr))
     '''Groups who can call this command'''
     overrideable:bool = field(default=True, kw_only=True)
     '''Whether this command can be overrided by other command'''
@@ -334,7 +533,12 @@ class Command(JSONSerializable):
 
     in_interface:Optional[Interface] = field(default=None, kw_only=True)
     '''Interface where the command is from'''
-    callback:Optional[Callable[..., Any | Coroutine[Any, Any, Any]]] = field(default=None, kw_only=True)
+    @staticmethod
+    def __callback_setattr(inst, attr_, value):
+        inst._binding = _BindingPlan.build(value)
+        return value
+
+    callback:Optional[Callable[..., Any | Coroutine[Any, Any, Any]]] = field(default=None, kw_only=True, on_setattr=__callback_setattr)
     '''
     Call Function To Call The Command
 
@@ -354,6 +558,17 @@ class Command(JSONSerializable):
         self.logger = log.getLogger("Command", [self.in_interface.user.name if self.in_interface else 'Unknown', self.cmd])
         # This seem to be tricky
         self.format = self.format
+        self._binding:Optional[_BindingPlan] = _BindingPlan.build(self.callback)
+        '''The binding plan of the callback'''
+        self.callable_groups._command = weakref.ref(self)
+        self._containers:list[weakref.ReferenceType[Commands]] = []
+        '''The command sets containing the command'''
+
+    def _changed(self) -> None:
+        '''
+        Notify the command sets containing the command that the name, alias or callable groups is changed
+        '''
+        _notify(self.__dict__.get('_containers', ()))
 
     @in_interface.validator
     def _(inst, attr_, value):
@@ -390,7 +605,7 @@ class Command(JSONSerializable):
 
         if not message._check_cache.get('src_interface', False): 
             if message.src_interface == None:
-                callercommand = getcallercommand(commands=session.in_handler.commands)
+                callercommand = getcallercommand()
                 if callercommand:
                     message.src_interface = callercommand.in_interface
             message._check_cache['src_interface'] = True
@@ -402,12 +617,18 @@ class Command(JSONSerializable):
                 if message.src_interface != message.dest_interface:
                     if not self.check_support(session.in_handler, message.src_interface.user):  
                         raise error.PermissionDenied(f"user {message.src_interface.user} not in callable_groups: Command.call{str(self.callable_groups)}",message=message,interface=self.in_interface)
-            self.logger.info(f"Call ({session.id}, {message.id}) {message.content}")
+            if self.logger.isEnabledFor(log.INFO) and log.sampled('command.call'):
+                self.logger.info("Call (%s, %s) %s", session.id, message.id, message.content)
             message.dest_interface = self.in_interface
             if self.format != None:
-                if not self.format.check(message.content.pure_text):
-                    raise error.FormatError(f"[Command <{self.cmd}>]format error: Command.call",self.in_interface, src_message = message, format=self.format)
-                message.content = MultiContent(self.format.setdefault(message.content.json))
+                try:
+                    # The cached json is not modified by normalize, it's copied only when changed
+                    parsed = message.content._parsed()
+                    data = self.format.normalize(parsed)
+                except ValueError:
+                    raise error.FormatError(f"[Command <{self.cmd}>]format error: Command.call",self.in_interface, src_message = message, format=self.format) from None
+                if data is not parsed:
+                    message.content = MultiContent(data)
         
             try:
                 # Trigger the call event
@@ -419,33 +640,15 @@ class Command(JSONSerializable):
                 self.logger.error("Call interrupted by exception of event", exc_info=True)
                 raise error.Interrupted(f"Call interrupted by exception: Command.call",message=message,interface=self.in_interface, error=e) from e
             
+            if self.in_interface is not None:
+                # The session init may be lazy
+                await session._ensure_session_init(self.in_interface)
+
             if self.callback is not None:
-                params = utils.appliable_parameters(self.callback, {
-                    'session': session,
-                    'message': message,
-                    'logger': self.logger,
-                    'interface': self.in_interface,
-                })
-                sig = utils.get_signature(self.callback)
-                
-                if 'config' in sig.parameters:
-                    params['config'] = self.in_interface.getconfig(session)
-                if 'data' in sig.parameters:
-                    params['data'] = self.in_interface.getdata(session)
-                if 'content' in sig.parameters:
-                    params['content'] = message.content
-
-                # if the parameter is in json format, load it
-                with contextlib.suppress(json.JSONDecodeError):
-                    # use message content because it has been loaded by format
-                    data = message.content.json
-                    if isinstance(data, dict):
-                        for k,v in data.items():
-                            if k not in sig.parameters:
-                                continue
-                            params.setdefault(k, v) # do not override (!important)
-
-                if len(sig.parameters) != len(params):
+                plan = self._binding
+                params = plan.bind(self, session, message)
+
+                if plan.param_count != len(params):
                     # It seems that something unwanted happened
                     raise error.InnerException(
                         "The parameters list seem to have extra parameters as unexcepted. The function is called by Command.call." \
@@ -458,20 +661,22 @@ class Command(JSONSerializable):
                             paramslist='[%s]' % ','.join(params)
                         ))
                 
-                ret = self.callback(**params)
-                if asyncio.iscoroutine(ret):
-                    async with session._running_tasks.session(ret) as task:
-                        ret = await task
+                with running_command(self):
+                    ret = self.callback(**params)
+                    if asyncio.iscoroutine(ret):
+                        async with session._running_tasks.session(ret) as task:
+                            ret = await task
             else:   
                 if self.in_interface is None:
                     raise error.ParamRequired(f"[Command <{self.cmd}>]in_interface required: Command.call")
                 
-                ret = self.in_interface.call(session, message)
-                if asyncio.iscoroutine(ret):
-                    async with session._running_tasks.session(ret) as task:
-                        ret = await task
-            if ret is not None:
-                self.logger.debug("Command return value: %s" % repr(ret))
+                with running_command(self):
+                    ret = self.in_interface.call(session, message)
+                    if asyncio.iscoroutine(ret):
+                        async with session._running_tasks.session(ret) as task:
+                            ret = await task
+            if ret is not None and self.logger.isEnabledFor(log.DEBUG) and log.sampled('command.return'):
+                self.logger.debug("Command return value: %s", log.LazyRepr(ret))
             return ret
         
     def bind(self, callback:Optional[Callable[[session.Session, session.Message], None]] = None) -> None:
@@ -557,6 +762,22 @@ class Commands(dict[str,Command]):
     '''
     Commands Dict
     '''
+    generation:int = 0
+    '''
+    Generation of the command set,
+    increased when the set is modified, or the name, alias or callable groups of its command is changed
+    '''
+
+    @property
+    def _owners(self) -> list[weakref.ReferenceType]:
+        '''The namespaces owning the set'''
+        return self.__dict__.setdefault('_owners_', [])
+
+    def _changed(self) -> None:
+        '''Increase the generation, and notify the owners'''
+        self.generation += 1
+        _notify(self._owners)
+
     @classmethod
     def from_yield(cls, commands:Iterable[Command]) -> Commands:
         '''Create a Commands from a list of commands'''
@@ -599,7 +820,31 @@ class Commands(dict[str,Command]):
         utils.typecheck(__value, Command)
         if __key != __value.cmd:
             raise ValueError(f"Key {__key} must be the same as __value.cmd {__value.cmd}")
-        return super().__setitem__(__key, __value)
+        old = super().get(__key, None)
+        if old is not None and old is not __value:
+            _unlink(old._containers, self)
+        _link(__value._containers, self)
+        super().__setitem__(__key, __value)
+        self._changed()
+
+    def __delitem__(self, __key: str) -> None:
+        _unlink(super().__getitem__(__key)._containers, self)
+        super().__delitem__(__key)
+        self._changed()
+
+    def pop(self, key:str, *args) -> Command:
+        if not super().__contains__(key):
+            return super().pop(key, *args)
+        ret = super().pop(key)
+        _unlink(ret._containers, self)
+        self._changed()
+        return ret
+
+    def clear(self) -> None:
+        for cmd in super().values():
+            _unlink(cmd._containers, self)
+        super().clear()
+        self._changed()
     
     @overload
     def __contains__(self, __key: str) -> bool:
@@ -633,12 +878,12 @@ class Commands(dict[str,Command]):
         '''Remove a command from the set'''
         if isinstance(cmd, str):
             if cmd in self:
-                return super().__delitem__(cmd)
+                return self.__delitem__(cmd)
             raise error.NotFound(cmd, cmd_set=self)
         elif isinstance(cmd, Command):
             for i in self.values():
                 if i == cmd:
-                    super().__delitem__(i.cmd)
+                    return self.__delitem__(i.cmd)
             raise error.NotFound(cmd.cmd, cmd_set=self)
         raise TypeError("cmd must be a string instance or a Command instance")
 
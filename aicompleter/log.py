@@ -3,14 +3,21 @@ Custom logging module
 '''
 
 import asyncio
+import atexit
 import copy
 import functools
+import itertools
 import logging
+import logging.handlers
 import os
+import queue
+import reprlib
 import sys
+import threading
+import weakref
 from collections.abc import Mapping
 from types import TracebackType
-from typing import Any, Callable, Coroutine, Iterable, Optional, TypeAlias
+from typing import IO, Any, Callable, Coroutine, Iterable, Literal, Optional, TypeAlias
 
 import colorama
 
@@ -390,11 +397,24 @@ Logger.manager.setLogRecordFactory(LogRecord)
 colorstyle = Formatter(ColorStrFormatStyle(
     "{asctime} - {levelname} [{name}]{substruct} {message}"
 ))
+emptystyle = Formatter(defaultStrFormatStyle)
+
+def _isatty(stream:IO) -> bool:
+    try:
+        return stream.isatty()
+    except (AttributeError, ValueError):
+        return False
+
+def consoleFormatter(stream:IO) -> Formatter:
+    '''
+    Get the formatter of the console stream, the colored one only when the stream is a TTY
+    '''
+    return colorstyle if _isatty(stream) else emptystyle
+
 consolehandler = StreamHandler()
-consolehandler.setFormatter(colorstyle)
+consolehandler.setFormatter(consoleFormatter(consolehandler.stream))
 
-emptystyle = Formatter(defaultStrFormatStyle)
-filehandler = logging.FileHandler("log.log", encoding='utf-8')
+filehandler = logging.FileHandler("log.log", encoding='utf-8', delay=True)
 filehandler.setFormatter(emptystyle)
 
 root.handlers.append(consolehandler)
@@ -409,18 +429,216 @@ error = root.error
 critical = root.critical
 fatal = root.fatal
 
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    '''
+    Queue handler with a bounded queue, the records are formatted and written by the listener thread
+
+    When the queue is full, the records are handled by the policy:
+    - drop: the record is dropped, the number of dropped records will be logged later
+    - coalesce: the same records (by logger, level and message) are merged and enqueued when there is room, 
+        the others are dropped when too many are pending
+    - block: wait until there is room (this will block the event loop)
+
+    Note: the message is formatted in the listener thread, the arguments should not be modified after logging
+    '''
+    def __init__(self, maxsize:int = 10000, policy:Literal['drop', 'coalesce', 'block'] = 'drop') -> None:
+        if policy not in ('drop', 'coalesce', 'block'):
+            raise ValueError(f"Unknown policy: {policy}")
+        super().__init__(queue.Queue(maxsize))
+        self.policy:str = policy
+        '''Policy when the queue is full'''
+        self.dropped:int = 0
+        '''Number of the records dropped (not reported yet)'''
+        self._pending:dict[tuple, list] = {}
+        '''The coalesced records, key -> [record, count]'''
+        self._pending_lock:threading.Lock = threading.Lock()
+
+    def prepare(self, record:logging.LogRecord) -> logging.LogRecord:
+        # Defer the formatting to the listener, the substruct stack of the logger is mutable
+        record = copy.copy(record)
+        if isinstance(record, LogRecord):
+            record.substruct = list(record.substruct)
+        return record
+
+    def _report(self) -> bool:
+        '''
+        Enqueue the coalesced records and the drop report, return False if the queue is still full
+        '''
+        with self._pending_lock:
+            while self._pending:
+                key = next(iter(self._pending))
+                record, count = self._pending[key]
+                if count > 1:
+                    record = copy.copy(record)
+                    record.msg = f"{record.getMessage()} (repeated {count} times)"
+                    record.args = ()
+                try:
+                    self.queue.put_nowait(record)
+                except queue.Full:
+                    return False
+                del self._pending[key]
+            if self.dropped:
+                record = LogRecord(self.name or 'log', WARNING, __file__, 0, "%d log records dropped", (self.dropped,), None, '', None)
+                try:
+                    self.queue.put_nowait(record)
+                except queue.Full:
+                    return False
+                self.dropped = 0
+        return True
+
+    def enqueue(self, record:logging.LogRecord) -> None:
+        if self.policy == 'block':
+            self.queue.put(record)
+            return
+        if (self._pending or self.dropped) and not self._report():
+            self._overflow(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self._overflow(record)
+
+    def _overflow(self, record:logging.LogRecord) -> None:
+        if self.policy == 'coalesce':
+            key = (record.name, record.levelno, record.msg, repr(record.args))
+            with self._pending_lock:
+                if key in self._pending:
+                    self._pending[key][1] += 1
+                    return
+                if len(self._pending) < self.queue.maxsize:
+                    self._pending[key] = [record, 1]
+                    return
+        self.dropped += 1
+
+    def flush(self) -> None:
+        self._report()
+
+_queuehandler:Optional[BoundedQueueHandler] = None
+_listener:Optional[logging.handlers.QueueListener] = None
+
+def enable_queue(maxsize:int = 10000, 
+                 policy:Literal['drop', 'coalesce', 'block'] = 'drop', 
+                 filename:Optional[str] = "log.log", 
+                 max_bytes:int = 10 << 20, 
+                 backup_count:int = 5, 
+                 stream:Optional[IO] = None) -> BoundedQueueHandler:
+    '''
+    Enable the queued logging pipeline, 
+    the records are enqueued by the root logger and handled by a listener thread
+
+    :param maxsize: Max size of the queue
+    :param policy: Policy when the queue is full, see `BoundedQueueHandler`
+    :param filename: The log file, rotated by size, None to disable the file output
+    :param max_bytes: Max size of the log file
+    :param backup_count: Number of the rotated log files to keep
+    :param stream: The console stream, sys.stderr by default
+    :return: The queue handler
+    '''
+    global _queuehandler, _listener
+    disable_queue()
+    console = StreamHandler(stream)
+    console.setFormatter(consoleFormatter(console.stream))
+    handlers:list[logging.Handler] = [console]
+    if filename is not None:
+        rotating = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True)
+        rotating.setFormatter(emptystyle)
+        handlers.append(rotating)
+    _queuehandler = BoundedQueueHandler(maxsize, policy)
+    _listener = logging.handlers.QueueListener(_queuehandler.queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    for handler in (consolehandler, filehandler):
+        if handler in root.handlers:
+            root.removeHandler(handler)
+    filehandler.close()
+    root.addHandler(_queuehandler)
+    return _queuehandler
+
+def disable_queue() -> None:
+    '''
+    Disable the queued logging pipeline, the pending records are written before return
+    '''
+    global _queuehandler, _listener
+    if _queuehandler is None:
+        return
+    root.removeHandler(_queuehandler)
+    _queuehandler.flush()
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _queuehandler, _listener = None, None
+    root.addHandler(consolehandler)
+    root.addHandler(filehandler)
+
+atexit.register(disable_queue)
+
+_loggers:weakref.WeakValueDictionary[tuple[str, tuple[str, ...]], Logger] = weakref.WeakValueDictionary()
+'''Registry of the loggers, keyed by the name and the substruct'''
+_loggers_lock:threading.Lock = threading.Lock()
+
 def getLogger(name:str, substruct:list[str] = []) -> Logger:
     '''
-    Get a logger
+    Get a logger, the loggers with the same name and substruct are shared
+
+    Note: the stack of the logger is shared as well, 
+    get another logger with the substruct instead of pushing to a shared one
     '''
-    _log = Logger(name, substruct=substruct)
-    _log.parent = root
+    key = (name, tuple(str(i) for i in substruct))
+    with _loggers_lock:
+        _log = _loggers.get(key, None)
+        if _log is None:
+            _log = Logger(name, substruct=list(key[1]))
+            _log.parent = root
+            _loggers[key] = _log
     return _log
 
+_reprlib = reprlib.Repr()
+_reprlib.maxstring = 200
+_reprlib.maxother = 200
+
+class LazyRepr:
+    '''
+    Deferred and truncated repr of an object, to log large values
+
+    The repr is computed only when the record is formatted
+    '''
+    __slots__ = ('obj',)
+    def __init__(self, obj:Any) -> None:
+        self.obj = obj
+
+    def __str__(self) -> str:
+        return _reprlib.repr(self.obj)
+
+    __repr__ = __str__
+
+_sample_rates:dict[str, int] = {}
+_sample_counters:dict[str, itertools.count] = {}
+
+def setSampleRate(key:str, rate:int) -> None:
+    '''
+    Set the sample rate of the high-frequency event, one of every `rate` events will be logged
+    '''
+    if rate < 1:
+        raise ValueError("rate must be positive")
+    _sample_rates[key] = rate
+
+def sampled(key:str) -> bool:
+    '''
+    Whether the event should be logged by the sample rate, all events are logged by default
+    '''
+    rate = _sample_rates.get(key, 1)
+    if rate == 1:
+        return True
+    counter = _sample_counters.get(key, None)
+    if counter is None:
+        counter = _sample_counters.setdefault(key, itertools.count())
+    return next(counter) % rate == 0
+
 __all__ = (
     'CRITICAL', 'FATAL', 'ERROR', 'WARNING', 'WARN', 'INFO', 'DEBUG', 'NOTSET',
     'StreamHandler', 'Logger', 'getLogger', 'setLevel', 'debug', 'info', 'warning', 'warn', 'error', 'critical', 'fatal',
     'root', 'Formatter', 'ColorStrFormatStyle', 'LogRecord', 'defaultColorMap', 'defaultLevelColorMap',
-    'filehandler', 'consolehandler',
+    'filehandler', 'consolehandler', 'consoleFormatter',
+    'BoundedQueueHandler', 'enable_queue', 'disable_queue',
+    'LazyRepr', 'setSampleRate', 'sampled',
     'StrFormatStyle', 'defaultStrFormatStyle', 'defaultFormatMap', 'FormatMap'
 )
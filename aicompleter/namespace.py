@@ -1,9 +1,11 @@
 import asyncio
-from typing import Any, Iterator, Self, overload, TypeVar, Generator
+import weakref
+from typing import Any, Iterator, Optional, Self, overload, TypeVar, Generator
 
 from . import *
 from .utils import *
-from aicompleter.interface.command import Commands, Command
+from aicompleter.interface.command import Commands, Command, _link, _notify, _unlink
+from aicompleter import error
 import attr
 
 User = TypeVar('User', bound='interface.User')
@@ -16,12 +18,68 @@ class BaseNamespace:
     description: str = attr.ib(default="")
     'The description of the namespace'
 
+class SubNamespaces(dict[str, 'Namespace']):
+    '''
+    Subnamespaces of a namespace
+
+    The modification will be notified to the namespace owning it
+    '''
+    _owner:Optional[weakref.ReferenceType['Namespace']] = None
+    '''The namespace owning the subnamespaces'''
+
+    def _adopt(self, value:'Namespace') -> None:
+        owner = self._owner() if self._owner is not None else None
+        if owner is not None and isinstance(value, Namespace):
+            _link(value._parents, owner)
+
+    def _release(self, value:'Namespace') -> None:
+        owner = self._owner() if self._owner is not None else None
+        if owner is not None and isinstance(value, Namespace) and value not in self.values():
+            _unlink(value._parents, owner)
+
+    def _changed(self) -> None:
+        owner = self._owner() if self._owner is not None else None
+        if owner is not None:
+            owner._changed()
+
+    def __setitem__(self, __key: str, __value: 'Namespace') -> None:
+        old = super().get(__key, None)
+        super().__setitem__(__key, __value)
+        if old is not None and old is not __value:
+            self._release(old)
+        self._adopt(__value)
+        self._changed()
+
+    def __delitem__(self, __key: str) -> None:
+        old = super().pop(__key)
+        self._release(old)
+        self._changed()
+
+    def pop(self, key:str, *args) -> 'Namespace':
+        if not super().__contains__(key):
+            return super().pop(key, *args)
+        ret = super().pop(key)
+        self._release(ret)
+        self._changed()
+        return ret
+
+    def clear(self) -> None:
+        values = list(self.values())
+        super().clear()
+        for value in values:
+            self._release(value)
+        self._changed()
+
+    def update(self, *args, **kwargs) -> None:
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
 @attr.dataclass(kw_only=True)
 class Namespace(BaseNamespace):
     '''
     Namespace
     '''
-    subnamespaces: dict[str, Self] = attr.ib(factory=dict, on_setattr=attr.setters.frozen)
+    subnamespaces: dict[str, Self] = attr.ib(factory=SubNamespaces, converter=SubNamespaces, on_setattr=attr.setters.frozen)
     'The subnamespaces of the namespace'
     commands: Commands = attr.ib(factory=Commands, on_setattr=attr.setters.frozen)
     'The commands of the namespace'
@@ -34,6 +92,25 @@ class Namespace(BaseNamespace):
         '''
         Post init
         '''
+        self._generation:int = 0
+        '''
+        Generation of the namespace, increased when its commands or subnamespaces are changed,
+        and pushed up to the parent namespaces
+        '''
+        self._parents:list[weakref.ReferenceType[Namespace]] = []
+        '''The namespaces which this namespace is a subnamespace of'''
+        self._index_generation:int = -1
+        '''The generation of the namespace when the index is built'''
+        _link(self.commands._owners, self)
+        self.subnamespaces._owner = weakref.ref(self)
+        for value in self.subnamespaces.values():
+            self.subnamespaces._adopt(value)
+        self._name_index:dict[str, Command] = {}
+        '''The first command of each name'''
+        self._alias_index:dict[str, Command] = {}
+        '''The first command of each alias'''
+        self._group_index:dict[str, tuple[dict[str, list[Command]], dict[str, list[Command]]]] = {}
+        '''The commands of each group, indexed by name and by alias'''
         self.onConfigChange = events.Event(type=events.Type.Hook)
         '''Event that will be triggered when the config is changed'''
         # Warning: This may raise the disorder of the execution order
@@ -92,7 +169,7 @@ class Namespace(BaseNamespace):
             for grp in arg.all_groups:
                 yield from self.get_executable(grp)
         elif isinstance(arg, interface.Group):
-            return self.get_executable(arg.name)
+            yield from self.get_executable(arg.name)
         elif isinstance(arg, str):
             for cmd in self.commands:
                 if arg in cmd.callable_groups:
@@ -113,4 +190,93 @@ class Namespace(BaseNamespace):
             yield self.commands[name]
         for value in self.subnamespaces.values():
             yield from value.getcmd(name)
+
+    def _walk_commands(self) -> Iterator[Command]:
+        yield from self.commands
+        for value in self.subnamespaces.values():
+            yield from value._walk_commands()
+
+    def _changed(self) -> None:
+        '''
+        Mark the namespace and its parents changed, their command indexes will be rebuilt
+        '''
+        self._generation += 1
+        _notify(self._parents)
+
+    def _update_index(self) -> None:
+        '''
+        Rebuild the command index if the commands or subnamespaces of the namespace or its subnamespaces are changed
+        '''
+        if self._index_generation == self._generation:
+            return
+        name_index:dict[str, Command] = {}
+        alias_index:dict[str, Command] = {}
+        group_index:dict[str, tuple[dict[str, list[Command]], dict[str, list[Command]]]] = {}
+        for cmd in self._walk_commands():
+            name_index.setdefault(cmd.cmd, cmd)
+            for alias in cmd.alias:
+                alias_index.setdefault(alias, cmd)
+            for group in cmd.callable_groups:
+                names, aliases = group_index.setdefault(group, ({}, {}))
+                names.setdefault(cmd.cmd, []).append(cmd)
+                for alias in cmd.alias:
+                    aliases.setdefault(alias, []).append(cmd)
+        self._name_index = name_index
+        self._alias_index = alias_index
+        self._group_index = group_index
+        self._index_generation = self._generation
+
+    @overload
+    def get_executable_cmd(self, name:str, user:User) -> Optional[Command]:
+        ...
+
+    @overload
+    def get_executable_cmd(self, name:str, groupname:str) -> Optional[Command]:
+        ...
+
+    @overload
+    def get_executable_cmd(self, name:str, group:Group) -> Optional[Command]:
+        ...
+
+    @overload
+    def get_executable_cmd(self, name:str) -> Optional[Command]:
+        ...
+
+    def get_executable_cmd(self, name:str, arg:object = None) -> Optional[Command]:
+        '''
+        Get the command by name or alias through the command index
+
+        If the user or group is specified, only the command executable by it will be returned,
+        the conflicted commands are resolved as `Commands.add` does
+        '''
+        from . import interface
+        self._update_index()
+        if arg == None:
+            ret = self._name_index.get(name, None)
+            if ret is None:
+                ret = self._alias_index.get(name, None)
+            return ret
+        if isinstance(arg, interface.User):
+            groups = arg.all_groups
+        elif isinstance(arg, interface.Group):
+            groups = (arg.name,)
+        elif isinstance(arg, str):
+            groups = (arg,)
+        else:
+            raise TypeError(f'Invalid argument type: {arg!r}')
+        ret = None
+        for index in (0, 1):
+            # Name first, then alias
+            for group in groups:
+                group_index = self._group_index.get(group, None)
+                if group_index is None:
+                    continue
+                for cmd in group_index[index].get(name, ()):
+                    if ret is None or ret is cmd or ret.overrideable:
+                        ret = cmd
+                    elif not cmd.overrideable:
+                        raise error.Existed(cmd.cmd, namespace=self)
+            if ret is not None:
+                return ret
+        return None
     
\ No newline at end of file
@@ -5,3 +5,4 @@ the HTTP session, the conversation, the roles, and the extra information.
 '''
 from .base import (Audio, Content, Image, Message, MessageQueue, MessageStatus,
                    MultiContent, Session, Text)
+from .history import History
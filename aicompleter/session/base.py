@@ -1,12 +1,13 @@
 from __future__ import annotations
 
 import asyncio
+import contextvars
 import enum
 import json
 import time
 import uuid
 from asyncio import CancelledError
-from typing import Any, Coroutine, Optional, Self, TypeVar, overload
+from typing import Any, Callable, Coroutine, Optional, Self, TypeVar, overload
 
 import attr
 
@@ -14,7 +15,9 @@ import aicompleter
 
 from .. import config, events, log, utils
 from ..config import Config, EnhancedDict
-from ..utils.special import getcallercommand
+from ..utils.special import getcallercommand, running_command
+from .history import History
+from .store import SessionStore
 
 Handler = TypeVar('Handler', bound='aicompleter.handler.Handler')
 User = TypeVar('User', bound='aicompleter.interface.User')
@@ -23,6 +26,20 @@ Character = TypeVar('Character', bound='aicompleter.interface.Character')
 Interface = TypeVar('Interface', bound='aicompleter.interface.Interface')
 Command = TypeVar('Command', bound='aicompleter.interface.Command')
 
+_initializing:contextvars.ContextVar[frozenset[tuple[uuid.UUID, uuid.UUID]]] = contextvars.ContextVar('_initializing', default=frozenset())
+'''
+The (session, interface) pairs whose session init is running in the current context,
+the commands called by the session init won't wait for the init itself
+'''
+
+def _copy_json(value:Any) -> Any:
+    '''Copy the json value, the dicts and lists are copied recursively'''
+    if isinstance(value, dict):
+        return {key: _copy_json(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_copy_json(item) for item in value]
+    return value
+
 class Content(object):
     '''Common content class.'''
 
@@ -51,6 +68,9 @@ class Audio(Content):
     def __repr__(self) -> str:
         return f"Audio({self.url})"
 
+class _NOT_PARSED:
+    '''Placeholder for the json not parsed'''
+
 class MultiContent(Content):
     '''Combine text, images and audios.'''
     @overload
@@ -70,37 +90,80 @@ class MultiContent(Content):
         ...
 
     def __init__(self, param:str|list[Content]|dict|list|Self|type(None) = None) -> None:
-        self.contents:list[Content] = []
+        self._contents:Optional[list[Content]] = []
+        '''Contents, None if not built from the parsed json yet'''
+        self._text:Optional[str] = None
+        '''Cache of text'''
+        self._pure_text:Optional[str] = None
+        '''Cache of pure text'''
+        self._json:Any = _NOT_PARSED
+        '''Cache of json'''
         if isinstance(param, str):
-            self.contents.append(Text(param))
+            self._contents.append(Text(param))
         elif isinstance(param, list):
-            self.contents.extend(param)
+            self._contents.extend(param)
         elif isinstance(param, dict):
-            self.contents.append(Text(json.dumps(param, ensure_ascii=False)))
+            # The text will be generated when needed, the dict is copied not to share it with the caller
+            self._contents = None
+            self._json = _copy_json(param)
         elif param is None:
             pass
         elif isinstance(param, type(self)):
-            self.contents.extend(param.contents)
+            if param._contents is not None:
+                self._contents.extend(param._contents)
+            else:
+                self._contents = None
+            self._text = param._text
+            self._pure_text = param._pure_text
+            self._json = param._json
         else:
             raise TypeError(f"Unsupported type {type(param)}")
 
+    @property
+    def contents(self) -> list[Content]:
+        '''
+        Contents
+
+        *Note*: Modify the list by add / remove or set a new list, otherwise the cache will not be refreshed
+        '''
+        if self._contents is None:
+            self._contents = [Text(json.dumps(self._json, ensure_ascii=False))]
+        return self._contents
+
+    @contents.setter
+    def contents(self, value:list[Content]) -> None:
+        self._contents = value
+        self._invalidate()
+
+    def _invalidate(self) -> None:
+        '''Invalidate the cache'''
+        self._text = None
+        self._pure_text = None
+        self._json = _NOT_PARSED
+
     def add(self, content:Content) -> None:
         '''Add a content.'''
         self.contents.append(content)
+        self._invalidate()
     
     def remove(self, content:Content) -> None:
         '''Remove a content.'''
         self.contents.remove(content)
+        self._invalidate()
 
     @property
     def text(self) -> str:
         '''Get text content.'''
-        return "".join([str(content) for content in self.contents])
+        if self._text is None:
+            self._text = "".join([str(content) for content in self.contents])
+        return self._text
 
     @property
     def pure_text(self) -> str:
         '''Get pure text content.'''
-        return "".join([str(content) for content in self.contents if isinstance(content, Text)])
+        if self._pure_text is None:
+            self._pure_text = "".join([str(content) for content in self.contents if isinstance(content, Text)])
+        return self._pure_text
     
     @property
     def images(self) -> list[Image]:
@@ -115,13 +178,23 @@ class MultiContent(Content):
     def __str__(self):
         return self.text
 
+    def _parsed(self) -> Any:
+        '''The cached json, which is never modified (shared by the copies)'''
+        if self._json is _NOT_PARSED:
+            self._json = json.loads(self.pure_text)
+        return self._json
+
     @property
     def json(self) -> dict:
-        '''Get json content.'''
-        return json.loads(self.pure_text)
+        '''
+        Get json content.
+
+        The parsed result is cached, a copy is returned, so modifying it won't change the content
+        '''
+        return _copy_json(self._parsed())
     
     def __getitem__(self, key):
-        return self.json[key]
+        return _copy_json(self._parsed()[key])
 
 @enum.unique
 class MessageStatus(enum.Enum):
@@ -138,10 +211,10 @@ class Session:
     def __init__(self, handler:Handler) -> None:
         self.create_time: float = time.time()
         '''Create time'''
-        # self.last_used: float = self.create_time
-        # '''Last used time'''
-        self.history:list[Message] = []
-        '''History'''
+        self.last_active: float = self.create_time
+        '''Last active time, updated when a command is called in the session'''
+        self.history:History = History(self, window=handler.history_window, spill_dir=handler.history_spill_dir)
+        '''History, the messages sent in this session'''
         self._closed: bool = False
         '''Closed'''
         self._id:uuid.UUID = uuid.uuid4()
@@ -154,6 +227,14 @@ class Session:
         '''Data'''
         self._running_tasks: utils.TaskList = utils.TaskList()
         '''Running tasks'''
+        self._store:Optional[SessionStore] = None
+        '''The store that the session is saved to'''
+        self._dirty:bool = True
+        '''Whether the session is changed since the last save'''
+        self._initialized_interfaces:set[uuid.UUID] = set()
+        '''IDs of the interfaces which have been initialized in this session'''
+        self._init_locks:dict[uuid.UUID, asyncio.Lock] = {}
+        '''Locks of the session init of the interfaces'''
         self._running_commands: list[tuple[aicompleter.Command, Message]] = []
         '''
         Running commands.
@@ -166,9 +247,8 @@ class Session:
         If the event is stopped, the command will not be called
         '''
         
-        self.logger:log.Logger=log.Logger('session')
+        self.logger:log.Logger = log.getLogger('Session', [self.id.hex[:8]])
         '''Logger'''
-        self.logger = log.getLogger('Session', [self.id.hex[:8]])
 
     @property
     def id(self) -> uuid.UUID:
@@ -232,7 +312,7 @@ class Session:
                 raise RuntimeError("Session closed")
             
             if cmd_or_msg.src_interface is None:
-                callercommand = getcallercommand(commands=self.in_handler.get_executable_cmds())
+                callercommand = getcallercommand()
                 if callercommand is not None:
                     cmd_or_msg.src_interface = callercommand.in_interface
             cmd_or_msg._check_cache['src_interface'] = True
@@ -253,7 +333,7 @@ class Session:
                 raise RuntimeError("Session closed")
             
             if params['src_interface'] is None:
-                callercommand = getcallercommand(commands=self.in_handler.get_executable_cmds())
+                callercommand = getcallercommand()
                 if callercommand is not None:
                     params['src_interface'] = callercommand.in_interface
             msg = Message(**params)
@@ -306,18 +386,48 @@ class Session:
         else:
             raise TypeError(f"Unsupported type {type(cmd_or_msg)}")
         
+    def _is_lazy(self, interface:Interface) -> bool:
+        '''Whether the session init of the interface is lazy'''
+        if interface.lazy_session_init is not None:
+            return interface.lazy_session_init
+        return self.in_handler.lazy_session_init
+
+    async def _ensure_session_init(self, interface:Interface) -> None:
+        '''
+        Ensure the session init of the interface is done, 
+        the init will be run only once even if called concurrently
+        '''
+        if interface.id in self._initialized_interfaces or (self.id, interface.id) in _initializing.get():
+            return
+        lock = self._init_locks.get(interface.id, None)
+        if lock is None:
+            lock = self._init_locks[interface.id] = asyncio.Lock()
+        async with lock:
+            if interface.id in self._initialized_interfaces:
+                return
+            token = _initializing.set(_initializing.get() | {(self.id, interface.id)})
+            try:
+                # The init is not a part of the command which triggers it, neither are the tasks it creates
+                with running_command(None):
+                    await interface._invoke_session_init(self)
+            finally:
+                _initializing.reset(token)
+            self._initialized_interfaces.add(interface.id)
+
     async def _init_session(self):
         tasks = []
         loop = self.in_handler._loop
         for interface in self.in_handler.interfaces:
-            tasks.append(loop.create_task(interface._invoke_session_init(self)))
+            # The lazy interfaces will be initialized when their commands are called
+            if not self._is_lazy(interface):
+                tasks.append(loop.create_task(self._ensure_session_init(interface)))
         await asyncio.gather(*tasks)
 
     async def close(self):
         '''Close the session.'''
         if self.closed:
             return
-        self.logger.debug(f"Session closing")
+        self.logger.debug("Session closing")
         for task in self._running_tasks:
             task.cancel()
         result = await asyncio.gather(*self._running_tasks, return_exceptions=True)
@@ -326,9 +436,12 @@ class Session:
         tasks = []
         loop = self.in_handler._loop
         for interface in self.in_handler._interfaces:
-            tasks.append(loop.create_task(interface._invoke_session_final(self)))
+            # Only the initialized interfaces need to be finalized
+            if interface.id in self._initialized_interfaces:
+                tasks.append(loop.create_task(interface._invoke_session_final(self)))
         await asyncio.gather(*tasks)
         self._closed = True
+        self._dirty = True
 
     async def _update_tasks(self):
         for task in self._running_tasks:
@@ -342,6 +455,8 @@ class Session:
             'storage': []
         }
         for i in self.in_handler._interfaces:
+            if i.id not in self._initialized_interfaces:
+                continue
             data = i.getStorage(self)
             if data == None:
                 continue
@@ -351,35 +466,39 @@ class Session:
             })
         return ret
     
-    def save(self, storage: utils.StorageManager | str):
-        if isinstance(storage, str):
-            storage = utils.StorageManager(storage)
-        meta = {
-            'id': self.id.hex,
-            'config': dict(self.config),
-            'created_time': self.create_time,
-            'closed': self._closed,
-        }
-        with open(storage.alloc_file('meta'), 'w') as f:
-            json.dump(meta, f)
-        for i in self.in_handler._interfaces:
-            i.save_session(storage.alloc_file({
-                'type': 'interface',
-                'id': i.id.hex,
-            }), self)
-        for i in self.history:
-            i.save(storage.alloc_file({
-                'type': 'message',
-                'id': i.id.hex,
-            }))
-        storage.save()
+    def save(self, path: utils.StorageManager | str):
+        '''
+        Save the session to the directory, 
+        the saving is incremental when saving to the same directory again
+        '''
+        writer = self._prepare_save(path)
+        if writer is not None:
+            writer()
+
+    def _prepare_save(self, path: utils.StorageManager | str) -> Optional[Callable[[], None]]:
+        '''
+        Collect the changes to save in the event loop,
+        return the writer which can be run in another thread, None if nothing changed
+        '''
+        if isinstance(path, utils.StorageManager):
+            path = path.path
+        if self._store is None or self._store.path != path:
+            self._store = SessionStore(path)
+        self._dirty = False
+        return self._store.prepare(self)
 
     @classmethod
     def load(cls, storage: utils.StorageManager | str, in_handler: Handler):
+        '''
+        Load the session from the directory
+        '''
+        path = storage.path if isinstance(storage, utils.StorageManager) else storage
+        if SessionStore.isstore(path):
+            return SessionStore(path).load(in_handler)
+        # The legacy format, one file per message and interface
         if isinstance(storage, str):
             storage = utils.StorageManager.load(storage)
-        with open(storage['meta'].path, 'r') as f:
-            meta = json.load(f)
+        meta = json.loads(storage.read('meta'))
         session = cls(handler=in_handler)
         session.create_time = meta['created_time']
         session.config = Config(meta['config'])
@@ -391,12 +510,15 @@ class Session:
             if not isinstance(i.mark, dict) or 'type' not in i.mark:
                 continue
             if i.mark['type'] == 'interface':
-                intmap[i.mark['id']] = storage[i.mark]
+                intmap[i.mark['id']] = i
             elif i.mark['type'] == 'message':
-                hislis.append(storage[i.mark])
+                hislis.append(i)
         for i in in_handler._interfaces:
-            # If not found, will throw KeyError
-            i.load_session(storage[intmap.pop(i.id.hex).mark].path, session)
+            if i.id.hex not in intmap:
+                # Not initialized when saved (lazy session init)
+                continue
+            i.load_session(intmap.pop(i.id.hex).path, session)
+            session._initialized_interfaces.add(i.id)
         for i in hislis:
             session.history.append(Message.load(i.path, session))
         if len(intmap):
@@ -452,7 +574,8 @@ class Message(BaseMessage):
         if value.value <= self._status.value:
             raise ValueError(f"Cannot set status to {value.name} from {self._status.name}")
         self._status = value
-        if value == MessageStatus.SENT and self.session is not None and self._status != MessageStatus.SENT:
+        if value == MessageStatus.SENT and self.session is not None:
+            # The history is indexed by id
             if not self in self.session.history:
                 self.session.history.append(self)
 
@@ -470,8 +593,8 @@ class Message(BaseMessage):
             'data': self.data,
             'last_message': self.last_message.id.hex if self.last_message is not None else None,
             'cmd': self.cmd,
-            'src_interface': self.src_interface.namespace if self.src_interface is not None else None,
-            'dest_interface': self.dest_interface.namespace if self.dest_interface is not None else None,
+            'src_interface': self.src_interface.id.hex if self.src_interface is not None else None,
+            'dest_interface': self.dest_interface.id.hex if self.dest_interface is not None else None,
         }
     
     @classmethod
@@ -508,25 +631,31 @@ class Message(BaseMessage):
     def load(cls, file:str, session:Session):
         with open(file, 'r') as f:
             data = json.load(f)
+        return cls.from_record(data, session)
+
+    @classmethod
+    def from_record(cls, data:dict, session:Session):
+        '''
+        Get the message from the json record (created by `to_json`), the references are resolved in the session
+        '''
         msg = cls.from_json(data)
         msg.session = session
         if data['last_message'] is not None:
-            for i in session.history:
-                if i.id.hex == data['last_message']:
-                    msg.last_message = i
-                    break
+            last_message = session.history.get(uuid.UUID(data['last_message']))
+            if last_message is not None:
+                msg.last_message = last_message
             else:
                 log.warning(f"Last message not found: {data['last_message']}")
         if data['src_interface'] is not None:
             for i in session.in_handler._interfaces:
-                if i.id == data['src_interface']:
+                if i.id.hex == data['src_interface']:
                     msg.src_interface = i
                     break
             else:
                 log.warning(f"Source interface not found: {data['src_interface']}")
         if data['dest_interface'] is not None:
             for i in session.in_handler._interfaces:
-                if i.id == data['dest_interface']:
+                if i.id.hex == data['dest_interface']:
                     msg.dest_interface = i
                     break
             else:
@@ -0,0 +1,187 @@
+'''
+History of the session
+'''
+from __future__ import annotations
+
+import collections
+import json
+import os
+import tempfile
+import uuid
+import weakref
+from typing import IO, Iterator, Optional, TypeVar, overload
+
+import aicompleter
+
+Session = TypeVar('Session', bound='aicompleter.session.Session')
+Message = TypeVar('Message', bound='aicompleter.session.Message')
+
+def _remove_file(file:IO[bytes], path:str) -> None:
+    file.close()
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+class History:
+    '''
+    History of the session, messages are indexed by id
+
+    The latest messages are kept in memory (the window),
+    the older messages are spilled to an append-only segment file on disk,
+    they are still readable by index, by id and by iteration.
+
+    :param session: Session, the session of the history
+    :param window: Optional[int], the max number of messages in memory, None for no limit
+    :param spill_dir: Optional[str], the directory of the segment file, the temporary directory by default
+    '''
+    def __init__(self, session:Session, window:Optional[int] = None, spill_dir:Optional[str] = None) -> None:
+        if window is not None and window <= 0:
+            raise ValueError("window must be positive")
+        self._session:weakref.ReferenceType[Session] = weakref.ref(session)
+        self.window:Optional[int] = window
+        '''Max number of messages in memory'''
+        self.spill_dir:Optional[str] = spill_dir
+        '''Directory of the segment file'''
+        self._messages:collections.deque[Message] = collections.deque()
+        '''Messages in memory'''
+        self._index:dict[uuid.UUID, Message] = {}
+        '''Index of the messages in memory'''
+        self._offsets:list[int] = []
+        '''Offsets of the spilled messages in the segment'''
+        self._spilled:dict[uuid.UUID, int] = {}
+        '''Position of the spilled messages'''
+        self._loaded:weakref.WeakValueDictionary[uuid.UUID, Message] = weakref.WeakValueDictionary()
+        '''Spilled messages that have been loaded'''
+        self._segment:Optional[IO[bytes]] = None
+        self._finalizer:Optional[weakref.finalize] = None
+
+    @property
+    def session(self) -> Session:
+        '''Session of the history'''
+        return self._session()
+
+    def __len__(self) -> int:
+        return len(self._offsets) + len(self._messages)
+
+    def __bool__(self) -> bool:
+        return len(self) != 0
+
+    def __contains__(self, message:Message | uuid.UUID) -> bool:
+        id = message if isinstance(message, uuid.UUID) else message.id
+        return id in self._index or id in self._spilled
+
+    def __iter__(self) -> Iterator[Message]:
+        for position in range(len(self._offsets)):
+            yield self._load(position)
+        # The window may be changed while iterating
+        yield from list(self._messages)
+
+    @overload
+    def __getitem__(self, index:int) -> Message:
+        ...
+
+    @overload
+    def __getitem__(self, index:slice) -> list[Message]:
+        ...
+
+    def __getitem__(self, index:int | slice) -> Message | list[Message]:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("history index out of range")
+        if index < len(self._offsets):
+            return self._load(index)
+        return self._messages[index - len(self._offsets)]
+
+    def get(self, id:uuid.UUID, default:Optional[Message] = None) -> Optional[Message]:
+        '''
+        Get the message by id
+        '''
+        ret = self._index.get(id, None)
+        if ret is not None:
+            return ret
+        position = self._spilled.get(id, None)
+        if position is None:
+            return default
+        return self._load(position)
+
+    def append(self, message:Message) -> None:
+        '''
+        Append a message, the message existed will be ignored
+        '''
+        if message in self:
+            return
+        self._messages.append(message)
+        self._index[message.id] = message
+        session = self.session
+        if session is not None:
+            session._dirty = True
+        if self.window is not None:
+            while len(self._messages) > self.window:
+                self._spill(self._messages.popleft())
+
+    def extend(self, messages:list[Message]) -> None:
+        '''
+        Append messages
+        '''
+        for message in messages:
+            self.append(message)
+
+    def _open_segment(self) -> IO[bytes]:
+        if self._segment is None:
+            fd, path = tempfile.mkstemp(prefix='history-', suffix='.jsonl', dir=self.spill_dir)
+            self._segment = os.fdopen(fd, 'w+b')
+            # Remove the segment when the history is released
+            self._finalizer = weakref.finalize(self, _remove_file, self._segment, path)
+        return self._segment
+
+    def _spill(self, message:Message) -> None:
+        '''
+        Move the message from memory to the segment
+        '''
+        segment = self._open_segment()
+        segment.seek(0, os.SEEK_END)
+        offset = segment.tell()
+        # The data may contain non-json values, they are stored as string
+        segment.write(json.dumps(message.to_json(), default=str).encode('utf-8') + b'\n')
+        self._spilled[message.id] = len(self._offsets)
+        self._offsets.append(offset)
+        del self._index[message.id]
+        self._loaded[message.id] = message
+
+    def _load(self, position:int) -> Message:
+        '''
+        Load the spilled message at the position
+        '''
+        segment = self._segment
+        segment.seek(self._offsets[position])
+        data = json.loads(segment.readline())
+        ret = self._loaded.get(uuid.UUID(data['id']), None)
+        if ret is None:
+            from .base import Message
+            ret = Message.from_record(data, self.session)
+            self._loaded[ret.id] = ret
+        return ret
+
+    def clear(self) -> None:
+        '''
+        Clear the history, the segment is removed
+        '''
+        self.close()
+        self._messages.clear()
+        self._index.clear()
+        self._offsets.clear()
+        self._spilled.clear()
+        self._loaded.clear()
+
+    def close(self) -> None:
+        '''
+        Remove the segment
+        '''
+        if self._finalizer is not None:
+            self._finalizer()
+            self._finalizer = None
+            self._segment = None
@@ -0,0 +1,219 @@
+'''
+Append-only persistence of the session
+'''
+from __future__ import annotations
+
+import functools
+import json
+import os
+import uuid
+from typing import Any, Callable, Optional, TypeVar
+
+import aicompleter
+
+from .. import log
+from ..utils.storage import write_atomic
+
+Session = TypeVar('Session', bound='aicompleter.session.Session')
+Handler = TypeVar('Handler', bound='aicompleter.handler.Handler')
+
+class SessionStore:
+    '''
+    Append-only store of a session
+
+    The records (meta, interface storage and messages) are appended to a segment file,
+    one json per line, and the offsets of the latest records are kept in an index file,
+    which is replaced atomically at every checkpoint.
+    Every save only appends the messages added since the last checkpoint,
+    and the meta and interface storage only when they are changed.
+    When the superseded records take too much space, the segment will be compacted.
+
+    :param path: str, the directory of the store
+    '''
+    SEGMENT = 'segment.jsonl'
+    '''Name of the segment file'''
+    INDEX = 'segment.index.json'
+    '''Name of the index file'''
+    compact_ratio:float = 0.5
+    '''The segment will be compacted when the ratio of superseded records exceeds this'''
+    compact_min_size:int = 1 << 20
+    '''The segment smaller than this will not be compacted'''
+
+    def __init__(self, path:str) -> None:
+        os.makedirs(path, exist_ok=True)
+        self.path:str = path
+        '''Directory of the store'''
+        self._index:dict[str, Any] = self._new_index()
+        if os.path.isfile(os.path.join(path, self.INDEX)):
+            with open(os.path.join(path, self.INDEX), 'rb') as f:
+                self._index = json.load(f)
+        self._written:dict[str, bytes] = {}
+        '''The records written by this store, to skip the unchanged records'''
+
+    @staticmethod
+    def _new_index() -> dict[str, Any]:
+        return {
+            'session': None,
+            'meta': None,
+            'interfaces': {},
+            'messages': [],
+            'size': 0,
+        }
+
+    @staticmethod
+    def isstore(path:str) -> bool:
+        '''
+        Test whether the directory is a session store
+        '''
+        return os.path.isfile(os.path.join(path, SessionStore.INDEX))
+
+    @property
+    def segment_path(self) -> str:
+        return os.path.join(self.path, self.SEGMENT)
+
+    @property
+    def live_size(self) -> int:
+        '''Size of the records which are not superseded'''
+        ret = sum(length for _, length in self._index['interfaces'].values())
+        ret += sum(length for _, _, length in self._index['messages'])
+        if self._index['meta'] is not None:
+            ret += self._index['meta'][1]
+        return ret
+
+    def _reset(self, session:str) -> None:
+        self._index = self._new_index()
+        self._index['session'] = session
+        self._written.clear()
+        with open(self.segment_path, 'wb'):
+            pass
+
+    def prepare(self, session:Session) -> Optional[Callable[[], None]]:
+        '''
+        Collect the records changed since the last checkpoint, 
+        this should be called in the thread of the session (event loop).
+
+        :return: The writer to write the records, which can be run in another thread, 
+            None if there is nothing to write
+        '''
+        saved = self._index['messages']
+        history = session.history
+        reset = self._index['session'] != session.id.hex or len(saved) > len(history) \
+            or (saved and history[len(saved) - 1].id.hex != saved[-1][0])
+        written = {} if reset else self._written
+        records:list[tuple[str, Optional[str], bytes]] = []
+        meta = json.dumps({
+            'id': session.id.hex,
+            'config': session.config.__serialize__(),
+            'created_time': session.create_time,
+            'last_active': session.last_active,
+            'closed': session.closed,
+        }).encode('utf-8') + b'\n'
+        if written.get('meta', None) != meta:
+            records.append(('meta', None, meta))
+        for interface in session.in_handler._interfaces:
+            if interface.id not in session._initialized_interfaces:
+                continue
+            data = json.dumps(interface.getStorage(session) or {}).encode('utf-8') + b'\n'
+            key = interface.id.hex
+            if written.get(key, None) != data:
+                records.append(('interface', key, data))
+        # The history is not the one saved, rewrite all
+        for message in history[0 if reset else len(saved):]:
+            # The data may contain non-json values, they are stored as string
+            records.append(('message', message.id.hex, json.dumps(message.to_json(), default=str).encode('utf-8') + b'\n'))
+        if not records:
+            return None
+        return functools.partial(self._write, session.id.hex, reset, records)
+
+    def save(self, session:Session) -> None:
+        '''
+        Save the session incrementally
+        '''
+        writer = self.prepare(session)
+        if writer is not None:
+            writer()
+
+    def _write(self, session:str, reset:bool, records:list[tuple[str, Optional[str], bytes]]) -> None:
+        if reset:
+            self._reset(session)
+        with open(self.segment_path, 'ab') as f:
+            offset = f.seek(0, os.SEEK_END)
+            for kind, key, data in records:
+                f.write(data)
+                if kind == 'meta':
+                    self._index['meta'] = (offset, len(data))
+                    self._written['meta'] = data
+                elif kind == 'interface':
+                    self._index['interfaces'][key] = (offset, len(data))
+                    self._written[key] = data
+                else:
+                    self._index['messages'].append((key, offset, len(data)))
+                offset += len(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self._index['size'] = offset
+        if offset >= self.compact_min_size and offset - self.live_size > offset * self.compact_ratio:
+            self.compact()
+        else:
+            self._write_index()
+
+    def _write_index(self) -> None:
+        write_atomic(os.path.join(self.path, self.INDEX), json.dumps(self._index).encode('utf-8'))
+
+    def compact(self) -> None:
+        '''
+        Rewrite the segment with the latest records only
+        '''
+        index = self._new_index()
+        index['session'] = self._index['session']
+        tmp = self.segment_path + '.tmp'
+        with open(self.segment_path, 'rb') as src, open(tmp, 'wb') as dst:
+            def _copy(offset:int, length:int) -> tuple[int, int]:
+                src.seek(offset)
+                ret = (dst.tell(), length)
+                dst.write(src.read(length))
+                return ret
+            if self._index['meta'] is not None:
+                index['meta'] = _copy(*self._index['meta'])
+            for key, (offset, length) in self._index['interfaces'].items():
+                index['interfaces'][key] = _copy(offset, length)
+            for key, offset, length in self._index['messages']:
+                index['messages'].append((key, *_copy(offset, length)))
+            index['size'] = dst.tell()
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(tmp, self.segment_path)
+        self._index = index
+        self._write_index()
+
+    def _read(self, f, offset:int, length:int) -> Any:
+        f.seek(offset)
+        return json.loads(f.read(length))
+
+    def load(self, handler:Handler) -> Session:
+        '''
+        Load the session from the store
+        '''
+        from .base import Message, Session
+        from ..config import Config
+        if self._index['meta'] is None:
+            raise FileNotFoundError(f"No session saved in {self.path}")
+        with open(self.segment_path, 'rb') as f:
+            meta = self._read(f, *self._index['meta'])
+            session = Session(handler)
+            session._id = uuid.UUID(meta['id'])
+            session.config = Config(meta['config'])
+            session.create_time = meta['created_time']
+            session.last_active = meta.get('last_active', session.create_time)
+            session._closed = meta['closed']
+            interfaces = {i.id.hex: i for i in handler._interfaces}
+            for key, (offset, length) in self._index['interfaces'].items():
+                if key not in interfaces:
+                    log.warning(f"Interface(ID-based) not found: {key}. Are the interfaces changed?")
+                    continue
+                interfaces[key].setStorage(session, self._read(f, offset, length))
+                session._initialized_interfaces.add(interfaces[key].id)
+            for _, offset, length in self._index['messages']:
+                session.history.append(Message.from_record(self._read(f, offset, length), session))
+        session._store = self
+        return session
@@ -85,7 +85,7 @@ def run_handler(handler:Handler, config:Optional[Config] = None,*, loop:Optional
             logger.exception("Error when close the session: %s", str(e))
             # Force remove
             logger.warning("Force remove the session")
-            handler._running_sessions.remove(session)
+            handler._running_sessions.pop(session.id, None)
     
     handler.on_exception.add_callback(lambda event, e: logger.exception("Error when handle the exception: %s", str(e)))
 
@@ -14,6 +14,8 @@ from .aio import (
     aiterfunc,
     retry,
     retry_async,
+    CoalescingQueue,
+    SingleFlight,
 )
 from .etype import (
     Struct,
@@ -67,4 +69,12 @@ from .text import (
 from .storage import (
     Storage,
     StorageManager,
+    write_atomic,
+)
+from .network import (
+    ClientSessionPool,
+    get_session,
+    close_session,
+    ServerSentEvent,
+    SSEDecoder,
 )
@@ -1,8 +1,9 @@
 
 import asyncio
+import collections
 from concurrent.futures import ThreadPoolExecutor
 import functools
-from typing import Any, AsyncGenerator, Callable, Coroutine, Generator, Optional, TypeVar
+from typing import Any, AsyncGenerator, AsyncIterator, Awaitable, Callable, Coroutine, Generator, Hashable, Optional, TypeVar
 import typing
 
 _T = TypeVar('_T')
@@ -160,3 +161,222 @@ def retry_async(func:Optional[Callable[..., Coroutine]], /, max_time:int = 0, on
                     raise e
         raise
     return wrapper
+
+class CoalescingQueue(asyncio.Queue[_T]):
+    '''
+    Queue to get the items in batches
+
+    `get_batch` waits for the first item, then keeps collecting the items 
+    until the queue is quiescent (no item pending and no producer held) or `max_wait` is reached.
+    The producers, for example the running commands whose results will be put into the queue,
+    should be registered by `hold` (or `track`) and unregistered by `release`.
+
+    Parameters
+    ----------
+    max_wait : float, optional
+        The max time (in seconds) to wait for the held producers after the first item, by default 0.1
+    maxsize : int, optional
+        The max size of the queue, by default 0 (no limit)
+    '''
+    def __init__(self, max_wait:float = 0.1, maxsize:int = 0) -> None:
+        super().__init__(maxsize)
+        self.max_wait:float = max_wait
+        '''Max time to wait for the held producers'''
+        self.batch_sizes:collections.Counter[int] = collections.Counter()
+        '''Metrics, the number of batches by size'''
+        self._held:int = 0
+        self._changed:asyncio.Event = asyncio.Event()
+
+    @property
+    def held(self) -> int:
+        '''Number of the held producers'''
+        return self._held
+
+    def hold(self) -> None:
+        '''
+        Register a producer, the batch will wait for it
+        '''
+        self._held += 1
+
+    def release(self) -> None:
+        '''
+        Unregister a producer, call this after the item is put (or nothing will be put)
+        '''
+        if self._held <= 0:
+            raise ValueError("release() called too many times")
+        self._held -= 1
+        self._changed.set()
+
+    def track(self, future:asyncio.Future) -> asyncio.Future:
+        '''
+        Hold until the future is done, the done callbacks added before are called before releasing
+        '''
+        self.hold()
+        future.add_done_callback(lambda _: self.release())
+        return future
+
+    def put_nowait(self, item:_T) -> None:
+        super().put_nowait(item)
+        self._changed.set()
+
+    async def get_batch(self) -> list[_T]:
+        '''
+        Get a batch of items, at least one item
+        '''
+        ret = [await self.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while True:
+            while not self.empty():
+                ret.append(self.get_nowait())
+            remaining = deadline - loop.time()
+            if self._held == 0 or remaining <= 0:
+                break
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        self.batch_sizes[len(ret)] += 1
+        return ret
+
+    @property
+    def average_batch_size(self) -> float:
+        '''Metrics, the average size of the batches'''
+        count = self.batch_sizes.total()
+        if count == 0:
+            return 0.0
+        return sum(size * num for size, num in self.batch_sizes.items()) / count
+
+class _Flight:
+    '''
+    A call in flight of SingleFlight
+    '''
+    __slots__ = ('task', 'refs', 'items', 'done', 'waiter')
+    def __init__(self) -> None:
+        self.task:Optional[asyncio.Task] = None
+        self.refs:int = 0
+        self.items:list[Any] = []
+        self.done:bool = False
+        self.waiter:Optional[asyncio.Future] = None
+
+class SingleFlight:
+    '''
+    Deduplicate the concurrent identical calls
+
+    The calls with the same key share one underlying task while it's in flight,
+    the result (or the exception) is delivered to all the callers.
+    The task is reference-counted by the callers waiting for it,
+    a cancelled caller only drops its reference, the task is cancelled when no caller is left.
+    The key is forgotten when the task is done, so the later calls will start a new one.
+
+    Examples
+    --------
+    ::
+        >>> import asyncio
+        >>> flight = SingleFlight()
+        >>> calls = 0
+        >>> async def fetch():
+        ...     global calls
+        ...     calls += 1
+        ...     await asyncio.sleep(0.1)
+        ...     return 'page'
+        >>> async def main():
+        ...     return await asyncio.gather(*(flight.do('url', fetch) for _ in range(3)))
+        >>> asyncio.run(main()), calls
+        (['page', 'page', 'page'], 1)
+    '''
+    def __init__(self) -> None:
+        self._calls:dict[Hashable, _Flight] = {}
+        self._streams:dict[Hashable, _Flight] = {}
+        self.shared:int = 0
+        '''Metrics, the number of the calls served by a call in flight'''
+
+    def __len__(self) -> int:
+        return len(self._calls) + len(self._streams)
+
+    def _join(self, flights:dict[Hashable, _Flight], key:Hashable) -> Optional[_Flight]:
+        flight = flights.get(key, None)
+        if flight is not None:
+            self.shared += 1
+        return flight
+
+    def _forget(self, flights:dict[Hashable, _Flight], key:Hashable, flight:_Flight) -> None:
+        if flights.get(key, None) is flight:
+            del flights[key]
+
+    def _release(self, flights:dict[Hashable, _Flight], key:Hashable, flight:_Flight) -> None:
+        flight.refs -= 1
+        if flight.refs == 0 and not flight.task.done():
+            # No caller is waiting, drop the call
+            self._forget(flights, key, flight)
+            flight.task.cancel()
+
+    async def do(self, key:Hashable, func:Callable[[], Awaitable[_T]]) -> _T:
+        '''
+        Call the function, or wait for the call in flight with the same key
+
+        :param key: The key of the call
+        :param func: The function to call, without arguments
+        '''
+        flight = self._join(self._calls, key)
+        if flight is None:
+            flight = self._calls[key] = _Flight()
+            flight.task = asyncio.ensure_future(func())
+            flight.task.add_done_callback(lambda _: self._forget(self._calls, key, flight))
+        flight.refs += 1
+        try:
+            # The shared task is not cancelled with the caller
+            return await asyncio.shield(flight.task)
+        finally:
+            self._release(self._calls, key, flight)
+
+    async def _produce(self, flight:_Flight, func:Callable[[], AsyncIterator[_T]]) -> None:
+        loop = asyncio.get_running_loop()
+        def _notify() -> None:
+            waiter, flight.waiter = flight.waiter, loop.create_future()
+            waiter.set_result(None)
+        iterator = func()
+        try:
+            async for item in iterator:
+                flight.items.append(item)
+                _notify()
+        finally:
+            if hasattr(iterator, 'aclose'):
+                await iterator.aclose()
+            flight.done = True
+            _notify()
+
+    async def stream(self, key:Hashable, func:Callable[[], AsyncIterator[_T]]) -> AsyncGenerator[_T, None]:
+        '''
+        Iterate the async iterator, or follow the iteration in flight with the same key
+
+        The items produced before joining are replayed, so every caller gets the whole stream.
+
+        :param key: The key of the iteration
+        :param func: The function to get the async iterator, without arguments
+        '''
+        flight = self._join(self._streams, key)
+        if flight is None:
+            flight = self._streams[key] = _Flight()
+            flight.waiter = asyncio.get_running_loop().create_future()
+            flight.task = asyncio.ensure_future(self._produce(flight, func))
+            flight.task.add_done_callback(lambda _: self._forget(self._streams, key, flight))
+        flight.refs += 1
+        try:
+            index = 0
+            while True:
+                while index < len(flight.items):
+                    yield flight.items[index]
+                    index += 1
+                if flight.done:
+                    break
+                # asyncio.wait doesn't cancel the shared waiter when the caller is cancelled
+                await asyncio.wait((flight.waiter,))
+            # The task is done in the same step as flight.done is set
+            if flight.task.cancelled():
+                raise asyncio.CancelledError()
+            if flight.task.exception() is not None:
+                raise flight.task.exception()
+        finally:
+            self._release(self._streams, key, flight)
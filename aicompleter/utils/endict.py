@@ -4,13 +4,14 @@ import asyncio
 import copy
 import json
 from typing import Any, Callable, Optional, Self, overload
-from ..common import JSONSerializable
+from ..common import JSONSerializable, deserialize, serialize
 from .etype import make_model
 
 class defaultdict(dict):
     '''
     Dict that can automatically create new keys
     '''
+    __slots__ = ()
     def __missing__(self, key):
         self[key] = defaultdict()
         return self[key]
@@ -21,23 +22,69 @@ class EnhancedDict(defaultdict, JSONSerializable):
     
     param:
         readonly: bool, Optional, default: False, readonly or not
+
+    The nested dicts are wrapped when they are accessed for the first time,
+    the nested enhanced dicts from the source are copied as plain dicts when constructing,
+    so the source won't be shared with the new one.
     '''
-    def __update_dict(self) -> None:
-        for key, value in self.items():
-            if isinstance(value, dict):
-                self[key] = self.__class__(value, readonly=self._lock.locked())
-    
+    __slots__ = ('_lock', '_readonly')
+
     def __init__(self, *args, **kwargs) -> None:
-        self._lock:asyncio.Lock = asyncio.Lock()
-        self._lock._locked = kwargs.pop('readonly', False)
-        if not isinstance(self._lock._locked, bool):
+        readonly = kwargs.pop('readonly', False)
+        if not isinstance(readonly, bool):
             raise TypeError("readonly must be bool")
+        self._init_slots(readonly)
         super().__init__(*args, **kwargs)
-        self.__update_dict()
+        self._init_nested()
+
+    def _init_slots(self, readonly:bool) -> None:
+        '''
+        Initialize the slots, the subclasses with extra slots should override this
+        '''
+        self._lock:Optional[asyncio.Lock] = None
+        '''Lock, created when required'''
+        self._readonly:bool = readonly
+
+    def _init_nested(self) -> None:
+        '''
+        Detach the nested enhanced dicts from the source
+        '''
+        for key, value in dict.items(self):
+            if isinstance(value, EnhancedDict):
+                dict.__setitem__(self, key, dict(value))
+
+    @classmethod
+    def _from_nested(cls, value:dict, readonly:bool) -> Self:
+        '''
+        Wrap a nested dict, the values are not checked again
+        '''
+        ret = dict.__new__(cls)
+        ret._init_slots(readonly)
+        dict.update(ret, value)
+        EnhancedDict._init_nested(ret)
+        return ret
+
+    def _wrap(self, key:Any, value:Any) -> Any:
+        '''
+        Wrap the nested dict which is not wrapped yet
+        '''
+        if isinstance(value, dict) and not isinstance(value, EnhancedDict):
+            value = self._from_nested(value, self.readonly)
+            dict.__setitem__(self, key, value)
+        return value
 
     def __missing__(self, key):
         self[key] = self.__class__()
-        return super().__getitem__(key)
+        return dict.__getitem__(self, key)
+
+    def _get_lock(self) -> asyncio.Lock:
+        '''
+        Get the lock, create it if not exists
+        '''
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+            self._lock._locked = self._readonly
+        return self._lock
 
     @property
     def readonly(self) -> bool:
@@ -45,6 +92,8 @@ class EnhancedDict(defaultdict, JSONSerializable):
         Get readonly
         This identifies whether the dict is occupied by a session
         '''
+        if self._lock is None:
+            return self._readonly
         return self._lock.locked()
 
     def set(self, path:str, value:Any):
@@ -52,42 +101,47 @@ class EnhancedDict(defaultdict, JSONSerializable):
         Set a value
         '''
         if '.' in path:
-            spilts = path.split('.', 1)
-            if spilts[0] not in self:
-                super().__setitem__(spilts[0], self.__class__())
-            super().__getitem__(spilts[0]).set(spilts[1],value)
+            key, subpath = path.split('.', 1)
+            if key not in self:
+                dict.__setitem__(self, key, self.__class__())
+            self[key].set(subpath, value)
             return
         if isinstance(value, dict):
             value = self.__class__(value)
-        return super().__setitem__(path, value)
+        return dict.__setitem__(self, path, value)
+
+    def view(self, path:str, default:Any = ...) -> Any:
+        '''
+        Get a value without copying, the nested dict is shared with this dict
+
+        If the path is not found, return default or Self
+        '''
+        if '.' not in path:
+            if dict.__contains__(self, path):
+                return self._wrap(path, dict.__getitem__(self, path))
+            return self.__class__() if default is ... else default
+        key, subpath = path.split('.', 1)
+        return self[key].view(subpath, default)
 
     def get(self, path:str, default:Any = ...) -> Any:
         '''
-        Get a value
+        Get a value, the nested dict is copied, use `view` to get it without copying
 
         If the path is not found, return default or Self
         '''
-        spilts = path.split('.', 1)
-        if len(spilts) == 1:
-            if default is ...:
-                if path not in self:
-                    return self.__class__()
-            ret = super().get(path, default)
-            if isinstance(ret, dict):
-                return self.__class__(ret)
-            return ret
-        else:
-            return self[spilts[0]].get(spilts[1], default)
+        ret = self.view(path, default)
+        if isinstance(ret, EnhancedDict):
+            # The deeper dicts are copied when they are wrapped
+            return ret._from_nested(ret, False)
+        if isinstance(ret, dict):
+            return self.__class__(ret)
+        return ret
         
     def has(self, path:str) -> bool:
         '''
         Check whether the path exists
         '''
-        spilts = path.split('.', 1)
-        if len(spilts) == 1:
-            return path in self
-        else:
-            return self[spilts[0]].has(spilts[1])
+        return self.__contains__(path)
         
     def require(self, path:str) -> Any:
         '''
@@ -118,11 +172,10 @@ class EnhancedDict(defaultdict, JSONSerializable):
                 self.setdefault(key, value)
             return
         elif isinstance(path, str):
-            spilts = path.split('.', 1)
-            if len(spilts) == 1:
-                return super().setdefault(path, default)
-            else:
-                return self[spilts[0]].setdefault(spilts[1], default)
+            if '.' not in path:
+                return self._wrap(path, dict.setdefault(self, path, default))
+            key, subpath = path.split('.', 1)
+            return self[key].setdefault(subpath, default)
         else:
             raise TypeError("path must be str or dict")
         
@@ -135,34 +188,64 @@ class EnhancedDict(defaultdict, JSONSerializable):
                 self[key].update(value)
             else:
                 self[key] = value
+
+    def values(self) -> list[Any]:
+        return [self._wrap(key, value) for key, value in dict.items(self)]
+
+    def items(self) -> list[tuple[Any, Any]]:
+        return [(key, self._wrap(key, value)) for key, value in dict.items(self)]
+
+    def pop(self, key:Any, *args) -> Any:
+        ret = dict.pop(self, key, *args)
+        if isinstance(ret, dict) and not isinstance(ret, EnhancedDict):
+            ret = self._from_nested(ret, self.readonly)
+        return ret
+
+    def popitem(self) -> tuple[Any, Any]:
+        key, value = dict.popitem(self)
+        if isinstance(value, dict) and not isinstance(value, EnhancedDict):
+            value = self._from_nested(value, self.readonly)
+        return key, value
     
     def __str__(self) -> str:
-        return super().__repr__()
+        return dict.__repr__(self)
 
     def __repr__(self) -> str:
-        return super().__repr__()
+        return dict.__repr__(self)
     
     def __delitem__(self, __key: Any) -> None:
-        return super().__delitem__(__key)
+        return dict.__delitem__(self, __key)
     
     def __contains__(self, __key: str) -> bool:
-        spilts = __key.split('.', 1)
-        if len(spilts) == 1:
-            return super().__contains__(__key)
-        else:
-            return self[spilts[0]].__contains__(spilts[1])
+        if '.' not in __key:
+            return dict.__contains__(self, __key)
+        key, subpath = __key.split('.', 1)
+        return self[key].__contains__(subpath)
     
     def __getitem__(self, __key: str) -> Any:
-        spilts = __key.split('.', 1)
-        if len(spilts) == 1:
-            return super().__getitem__(__key)
-        else:
-            return self[spilts[0]].__getitem__(spilts[1])
+        if '.' not in __key:
+            return self._wrap(__key, dict.__getitem__(self, __key))
+        key, subpath = __key.split('.', 1)
+        return self[key].__getitem__(subpath)
 
     __setitem__ = set
 
     def __bool__(self) -> bool:
-        return super().__len__() != 0
+        return dict.__len__(self) != 0
+
+    def __reduce__(self):
+        # The slots are not pickled, the values are set by dict item setting
+        return (self.__class__, (), {'readonly': self._readonly}, None, iter(dict.items(self)))
+
+    def __setstate__(self, state:dict) -> None:
+        self._init_slots(state.get('readonly', False))
+
+    def __serialize__(self) -> dict:
+        return {key: serialize(value) for key, value in self.items()}
+
+    @classmethod
+    def __deserialize__(cls, data:dict) -> Self:
+        return cls({key: deserialize(value) for key, value in data.items()})
 
     class Session:
         '''
@@ -176,11 +259,11 @@ class EnhancedDict(defaultdict, JSONSerializable):
                 self._dict = copy.deepcopy(dict)
         
         async def __aenter__(self) -> EnhancedDict:
-            await self._dict._lock.acquire()
+            await self._dict._get_lock().acquire()
             return self._dict
         
         async def __aexit__(self, exc_type, exc_value, traceback) -> None:
-            self._dict._lock.release()
+            self._dict._get_lock().release()
 
     def session(self, locked:bool = True, save:bool = True) -> Session:
         '''
@@ -0,0 +1,246 @@
+'''
+Network utils for aicompleter
+
+Including a process-wide pool of aiohttp sessions, which is shared by all the transformers
+'''
+from __future__ import annotations
+
+import asyncio
+import weakref
+from typing import Optional
+
+import aiohttp
+
+class ClientSessionPool:
+    '''
+    Process-wide pool of aiohttp ClientSession
+
+    An aiohttp session is bound to the event loop that created it, so the pool keeps one session for each loop.
+    The session references its loop, so the entry of a loop is removed when the session is closed,
+    and the entries of the closed loops are dropped when the pool is accessed.
+    The sessions keep the connections alive, limit the connections per host and cache the DNS results,
+    so the following requests to the same host will not do the TCP and TLS handshake again.
+
+    Parameters
+    ----------
+    limit: int, the max count of connections of a session, 0 for no limit
+    limit_per_host: int, the max count of connections to the same host, 0 for no limit
+    ttl_dns_cache: Optional[int], the seconds that DNS results will be cached, None for caching forever
+    keepalive_timeout: float, the seconds that an idle connection will be kept
+    timeout: Optional[aiohttp.ClientTimeout], the default timeout of the requests
+    '''
+    def __init__(self, *,
+                 limit:int = 100,
+                 limit_per_host:int = 16,
+                 ttl_dns_cache:Optional[int] = 300,
+                 keepalive_timeout:float = 60,
+                 timeout:Optional[aiohttp.ClientTimeout] = None) -> None:
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.ttl_dns_cache = ttl_dns_cache
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+        self._sessions:dict[asyncio.AbstractEventLoop, aiohttp.ClientSession] = {}
+        '''Sessions of the pool, one for each loop, the values reference the keys, so the entries are removed explicitly'''
+        self._owners:weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, weakref.WeakSet] = weakref.WeakKeyDictionary()
+        '''Owners of the sessions, the session is closed when the last owner releases it'''
+
+    def _prune(self) -> None:
+        '''
+        Drop the sessions of the closed loops, they can't be closed any more
+        '''
+        for loop in [loop for loop in self._sessions if loop.is_closed()]:
+            del self._sessions[loop]
+            self._owners.pop(loop, None)
+
+    def _new_session(self) -> aiohttp.ClientSession:
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            use_dns_cache=True,
+            ttl_dns_cache=self.ttl_dns_cache,
+            keepalive_timeout=self.keepalive_timeout,
+        )
+        kwargs = {}
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+        return aiohttp.ClientSession(connector=connector, **kwargs)
+
+    def get(self, loop:Optional[asyncio.AbstractEventLoop] = None) -> aiohttp.ClientSession:
+        '''
+        Get the session of the loop, a new session will be created if not existed or closed
+
+        This should be called in the running loop if loop is not specified
+        '''
+        loop = loop or asyncio.get_running_loop()
+        session = self._sessions.get(loop, None)
+        if session is None or session.closed:
+            self._prune()
+            session = self._sessions[loop] = self._new_session()
+        return session
+
+    def acquire(self, owner:object, loop:Optional[asyncio.AbstractEventLoop] = None) -> None:
+        '''
+        Register an owner of the session of the loop, such as a handler,
+        the session is closed when all the owners release it
+
+        The session is not created here, so this can be called out of the running loop
+        '''
+        loop = loop or asyncio.get_running_loop()
+        owners = self._owners.get(loop, None)
+        if owners is None:
+            owners = self._owners[loop] = weakref.WeakSet()
+        owners.add(owner)
+
+    async def release(self, owner:object, loop:Optional[asyncio.AbstractEventLoop] = None) -> None:
+        '''
+        Unregister an owner of the session of the loop, close the session if no owner is left
+        '''
+        loop = loop or asyncio.get_running_loop()
+        owners = self._owners.get(loop, None)
+        if owners is None or owner not in owners:
+            return
+        owners.discard(owner)
+        if not owners:
+            del self._owners[loop]
+            await self.close(loop)
+
+    async def close(self, loop:Optional[asyncio.AbstractEventLoop] = None) -> None:
+        '''
+        Close the session of the loop
+
+        The pool is still usable after closed, a new session will be created when needed
+        '''
+        loop = loop or asyncio.get_running_loop()
+        session = self._sessions.pop(loop, None)
+        if session is not None and not session.closed:
+            await session.close()
+
+    def __contains__(self, loop:asyncio.AbstractEventLoop) -> bool:
+        session = self._sessions.get(loop, None)
+        return session is not None and not session.closed
+
+default_pool = ClientSessionPool()
+'''
+The default pool, shared by all transformers
+'''
+
+def get_session(loop:Optional[asyncio.AbstractEventLoop] = None) -> aiohttp.ClientSession:
+    '''
+    Get the shared session of the loop from the default pool
+    '''
+    return default_pool.get(loop)
+
+async def close_session(loop:Optional[asyncio.AbstractEventLoop] = None) -> None:
+    '''
+    Close the shared session of the loop in the default pool,
+    the requests still running on the session will fail, prefer `default_pool.release` for the owners
+    '''
+    await default_pool.close(loop)
+
+class ServerSentEvent:
+    '''
+    An event of server-sent events
+    '''
+    __slots__ = ('data', 'event', 'id')
+    def __init__(self, data:str, event:Optional[str] = None, id:Optional[str] = None) -> None:
+        self.data = data
+        '''Data of the event, the data lines are joined by \\n'''
+        self.event = event
+        '''Type of the event'''
+        self.id = id
+        '''ID of the event'''
+
+    def __repr__(self) -> str:
+        return f'ServerSentEvent(data={self.data!r}, event={self.event!r}, id={self.id!r})'
+
+class SSEDecoder:
+    '''
+    Incremental decoder of server-sent events (text/event-stream)
+
+    Feed the raw bytes of the response in any size, and the completed events will be returned.
+    Every byte is scanned only once, the partial line is kept in the buffer until the next feed.
+
+    Examples
+    --------
+    ::
+        >>> decoder = SSEDecoder()
+        >>> decoder.feed(b'data: {"a":')
+        []
+        >>> decoder.feed(b' 1}\\n\\ndata: [DONE]\\n\\n')
+        [ServerSentEvent(data='{"a": 1}', event=None, id=None), ServerSentEvent(data='[DONE]', event=None, id=None)]
+    '''
+    DONE:str = '[DONE]'
+    '''The data of the terminating event used by OpenAI'''
+
+    def __init__(self) -> None:
+        self._buffer = bytearray()
+        self._data:list[str] = []
+        self._event:Optional[str] = None
+        self._id:Optional[str] = None
+        self.done:bool = False
+        '''Whether the [DONE] event is received'''
+
+    def _process_line(self, line:str) -> Optional[ServerSentEvent]:
+        if not line:
+            # Dispatch the event
+            if not self._data:
+                self._event = None
+                return None
+            event = ServerSentEvent('\n'.join(self._data), self._event, self._id)
+            self._data = []
+            self._event = None
+            if event.data == self.DONE:
+                self.done = True
+            return event
+        if line[0] == ':':
+            # Comment
+            return None
+        field, sep, value = line.partition(':')
+        if sep and value[:1] == ' ':
+            value = value[1:]
+        if field == 'data':
+            self._data.append(value)
+        elif field == 'event':
+            self._event = value
+        elif field == 'id':
+            self._id = value
+        # retry and unknown fields are ignored
+        return None
+
+    def feed(self, chunk:bytes) -> list[ServerSentEvent]:
+        '''
+        Feed the bytes, return the completed events
+        '''
+        buffer = self._buffer
+        start = len(buffer)
+        buffer += chunk
+        ret:list[ServerSentEvent] = []
+        pos = 0
+        while True:
+            index = buffer.find(b'\n', start)
+            if index == -1:
+                break
+            end = index - 1 if index > pos and buffer[index - 1] == 0x0d else index
+            event = self._process_line(buffer[pos:end].decode('utf-8'))
+            if event is not None:
+                ret.append(event)
+            pos = start = index + 1
+        if pos:
+            del buffer[:pos]
+        return ret
+
+    def flush(self) -> list[ServerSentEvent]:
+        '''
+        Flush the decoder at the end of the stream, return the remaining events
+        '''
+        ret:list[ServerSentEvent] = []
+        if self._buffer:
+            event = self._process_line(self._buffer.decode('utf-8').rstrip('\r'))
+            self._buffer.clear()
+            if event is not None:
+                ret.append(event)
+        event = self._process_line('')
+        if event is not None:
+            ret.append(event)
+        return ret
@@ -1,40 +1,42 @@
-import inspect
-from typing import Iterable, TypeVar
+import contextlib
+import contextvars
+from typing import Iterable, Iterator, Optional, TypeVar
 from .. import *
-from .etype import getcaller, getcallerclass, getcallerclassinstance
 
 Command = TypeVar('Command', bound='interface.Command')
+Interface = TypeVar('Interface', bound='interface.Interface')
 
-def getcallercommand(stack_level:int = 1, commands: Iterable[Command] = ()):
-    from .. import Handler, Command, Interface
-    class_ = getcallerclass(stack_level + 1)
-    if class_ == None:
-        # Try directly get the caller
-        caller = getcaller(stack_level + 1)
-        if caller == None:
-            return None
-        # function defined outside of a class
-        for command in commands:
-            if command.callback == caller:
-                return command
-        return None
-    if issubclass(class_, Interface):
-        # function defined inside a class
-        instance = getcallerclassinstance(stack_level + 1)
-        if instance == None:
-            # static method or class method
-            caller = getcaller(stack_level + 1)
-            for command in commands:
-                if command.callback == caller:
-                    return command
-            return None
-        if not isinstance(instance, Interface):
-            return None
-        caller = getcaller(stack_level + 1)
-        for command in commands:
-            if hasattr(command, '__self__') and command.__self__ == instance:
-                # Get the function from the bound method
-                if hasattr(command, '__func__') and command.__func__ == caller:
-                    return command
+_current_command:contextvars.ContextVar[Optional[Command]] = contextvars.ContextVar('current_command', default=None)
+'''
+The command being executed in the current context
+
+This is set by Command.call, and inherited by the tasks created in the command
+'''
+
+def getcallercommand(stack_level:int = 1, commands: Iterable[Command] = ()) -> Optional[Command]:
+    '''
+    Get the command which is being executed in the current context
+
+    The parameters are kept for compatibility and ignored
+    '''
+    return _current_command.get()
+
+def getcallerinterface() -> Optional[Interface]:
+    '''
+    Get the interface of the command which is being executed in the current context
+    '''
+    command = _current_command.get()
+    if command is None:
         return None
-    return None
+    return command.in_interface
+
+@contextlib.contextmanager
+def running_command(command:Optional[Command]) -> Iterator[None]:
+    '''
+    Set the command being executed in the context, None for no command
+    '''
+    token = _current_command.set(command)
+    try:
+        yield
+    finally:
+        _current_command.reset(token)
@@ -2,10 +2,29 @@ from __future__ import annotations
 import contextlib
 import json
 import os
-from typing import Literal, Optional, Self
+from typing import IO, Any, Iterator, Literal, Optional, Self
 import uuid
 import attr
-from ..common import JSONSerializable, JsonType, serialize
+from ..common import JSONSerializable, JsonType, deserialize, serialize
+
+def write_atomic(path:str, data:str | bytes) -> None:
+    '''
+    Write the file atomically, the data is written to a temporary file and then renamed
+    '''
+    tmp = path + '.tmp'
+    with open(tmp, 'wb' if isinstance(data, bytes) else 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def _canonical_mark(mark:JSONSerializable|JsonType) -> str:
+    '''
+    Get the canonical form of the mark, which is hashable
+    '''
+    if not isinstance(mark, JsonType):
+        mark = serialize(mark)
+    return json.dumps(mark, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
 
 @attr.dataclass(frozen=True)
 class Storage:
@@ -50,9 +69,9 @@ class Storage:
     
     @classmethod
     def fromdict(cls, data:dict, in_manager:Optional[StorageManager]=None):
-        if data['mark-serialized']:
-            data['mark'] = json.loads(data['mark'])
-        del data['mark-serialized']
+        data = dict(data)
+        if data.pop('mark-serialized', False):
+            data['mark'] = deserialize(data['mark'])
         if in_manager != None:
             data['in_manager'] = in_manager
         return cls(**data)
@@ -65,6 +84,9 @@ class StorageManager:
     ----------
     basepath: str - base path
 
+    The storages are indexed by the canonical form of the marks and by the names,
+    the index file is only written when `save` is called (or at the end of `batch`),
+    and it's replaced atomically.
     '''
     def __init__(self, basepath:str):
         self._basepath = basepath
@@ -72,8 +94,20 @@ class StorageManager:
             os.mkdir(basepath)
         if not os.path.isdir(basepath):
             raise ValueError(f'{basepath} is not a directory')
-        self._metas:list[Storage] = []
-        self._indexfile = os.path.join(basepath, 'index.json')
+        self._init_index([])
+
+    def _init_index(self, metas:list[Storage]) -> None:
+        self._indexfile = os.path.join(self._basepath, 'index.json')
+        self._marks:dict[str, Storage] = {}
+        '''Storages indexed by the canonical marks, in the allocating order'''
+        self._names:dict[str, Storage] = {}
+        '''Storages indexed by the names'''
+        self._dirty:bool = False
+        '''Whether the index is changed since the last save'''
+        self._batch_depth:int = 0
+        for meta in metas:
+            self._marks[_canonical_mark(meta.mark)] = meta
+            self._names[meta.name] = meta
 
     @property
     def path(self):
@@ -97,17 +131,46 @@ class StorageManager:
         '''
         manager = cls.__new__(cls)
         manager._basepath = basepath
-        manager._indexfile = os.path.join(basepath, 'index.json')
-        with open(manager._indexfile, 'r') as f:
-            manager._metas = [Storage.fromdict(meta, manager) for meta in json.load(f)]
+        with open(os.path.join(basepath, 'index.json'), 'r') as f:
+            manager._init_index([Storage.fromdict(meta, manager) for meta in json.load(f)])
         return manager
 
-    def save(self):
+    def save(self, force:bool = False):
         '''
         Save Storage Metadata Manager
+
+        The index is written to a temporary file and then renamed,
+        it will be skipped if nothing is changed, or inside a batch
+
+        Args:
+        ----------
+        force: bool - write the index even if nothing is changed
         '''
-        with open(self._indexfile, 'w') as f:
-            json.dump([meta.asdict() for meta in self._metas], f)
+        if self._batch_depth and not force:
+            self._dirty = True
+            return
+        if not self._dirty and not force and os.path.exists(self._indexfile):
+            return
+        write_atomic(self._indexfile, json.dumps([meta.asdict() for meta in self._marks.values()]))
+        self._dirty = False
+
+    @contextlib.contextmanager
+    def batch(self) -> Iterator[Self]:
+        '''
+        Batch the modifications, the index will be saved once at the end
+
+        ::
+            >>> with manager.batch():
+            ...     for i in range(100):
+            ...         manager.alloc_file(i)
+        '''
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+        if self._batch_depth == 0:
+            self.save()
 
     @staticmethod
     def isstoragedir(path:str):
@@ -120,22 +183,19 @@ class StorageManager:
         return False
 
     def __getitem__(self, mark:JSONSerializable|JsonType):
-        for meta in self._metas:
-            if meta.mark == mark:
-                return meta
-        raise KeyError(f'No storage with mark {mark}')
+        try:
+            return self._marks[_canonical_mark(mark)]
+        except KeyError:
+            raise KeyError(f'No storage with mark {mark}') from None
     
     def __contains__(self, mark:JSONSerializable|JsonType):
-        for meta in self._metas:
-            if meta.mark == mark:
-                return True
-        return False
+        return _canonical_mark(mark) in self._marks
     
     def __iter__(self):
-        return iter(self._metas)
+        return iter(list(self._marks.values()))
     
     def __len__(self):
-        return len(self._metas)
+        return len(self._marks)
     
     def findmark(self, name:str):
         '''
@@ -149,17 +209,25 @@ class StorageManager:
         ----------
         mark if found else None
         '''
-        for meta in self._metas:
-            if meta.name == name:
-                return meta.mark
-        return None
+        meta = self._names.get(name, None)
+        return meta.mark if meta is not None else None
 
     def _get_available_name(self, subfix:str = ''):
         while True:
             name = str(uuid.uuid4()) + subfix
-            if self.findmark(name) is None and not os.path.exists(os.path.join(self._basepath, name)):
+            if name not in self._names:
                 return name
 
+    def _add(self, mark:JSONSerializable|JsonType, subfix:str = '', type:Literal['file', 'storage', 'folder'] = 'file') -> Storage:
+        key = _canonical_mark(mark)
+        if key in self._marks:
+            raise KeyError(f'Storage with mark {mark} already exists')
+        meta = Storage(mark, self._get_available_name(subfix), type, in_manager=self)
+        self._marks[key] = meta
+        self._names[meta.name] = meta
+        self._dirty = True
+        return meta
+
     def alloc_file(self, mark:JSONSerializable|JsonType, recommended_subfix:Optional[str] = None):
         '''
         Allocate a file
@@ -173,11 +241,7 @@ class StorageManager:
         ----------
         The absoult path of the file
         '''
-        if mark in self:
-            raise KeyError(f'Storage with mark {mark} already exists')
-        meta = Storage(mark, self._get_available_name(recommended_subfix or ''), in_manager=self)
-        self._metas.append(meta)
-        return os.path.join(self._basepath, meta.name)
+        return self._add(mark, recommended_subfix or '').path
 
     def alloc_folder(self, mark:JSONSerializable|JsonType):
         '''
@@ -191,12 +255,9 @@ class StorageManager:
         ----------
         The absoult path of the folder (created)
         '''
-        if mark in self:
-            raise KeyError(f'Storage with mark {mark} already exists')
-        meta = Storage(mark, self._get_available_name(), 'folder', in_manager=self)
-        self._metas.append(meta)
-        os.mkdir(os.path.join(self._basepath, meta.name))
-        return os.path.join(self._basepath, meta.name)
+        meta = self._add(mark, type='folder')
+        os.mkdir(meta.path)
+        return meta.path
     
     def alloc_storage(self, mark:JSONSerializable|JsonType) -> Self:
         '''
@@ -211,11 +272,54 @@ class StorageManager:
         ----------
         New StorageManager instance of the allocated folder
         '''
-        if mark in self:
-            raise KeyError(f'Storage with mark {mark} already exists')
-        meta = Storage(mark, self._get_available_name(), 'storage', in_manager=self)
-        self._metas.append(meta)
-        return type(self)(os.path.join(self._basepath, meta.name))
+        meta = self._add(mark, type='storage')
+        return type(self)(meta.path)
+
+    def open(self, mark:JSONSerializable|JsonType, mode:str = 'r', **kwargs) -> IO[Any]:
+        '''
+        Open the file of the mark, 
+        if the mark is not allocated and the file is opened for writing, the file will be allocated
+
+        Args:
+        ----------
+        mark: JSONSerializable - file mark
+        mode: str - open mode
+        kwargs: other arguments of `open`
+        '''
+        key = _canonical_mark(mark)
+        meta = self._marks.get(key, None)
+        if meta is None:
+            if not any(i in mode for i in 'wax'):
+                raise KeyError(f'No storage with mark {mark}')
+            meta = self._add(mark)
+        return open(meta.path, mode, **kwargs)
+
+    def read(self, mark:JSONSerializable|JsonType, binary:bool = False) -> str | bytes:
+        '''
+        Read the whole file of the mark
+
+        Args:
+        ----------
+        mark: JSONSerializable - file mark
+        binary: bool - read in binary mode
+        '''
+        with self.open(mark, 'rb' if binary else 'r') as f:
+            return f.read()
+
+    def write(self, mark:JSONSerializable|JsonType, data:str | bytes) -> None:
+        '''
+        Write the whole file of the mark atomically, the file will be allocated if not exists
+
+        Args:
+        ----------
+        mark: JSONSerializable - file mark
+        data: str | bytes - the content
+        '''
+        key = _canonical_mark(mark)
+        meta = self._marks.get(key, None)
+        if meta is None:
+            meta = self._add(mark)
+        write_atomic(meta.path, data)
 
     def delete(self, mark:JSONSerializable|JsonType):
         '''
@@ -225,8 +329,9 @@ class StorageManager:
         ----------
         mark: JSONSerializable - storage mark
         '''
-        for meta in self._metas:
-            if meta.mark == mark:
-                self._metas.remove(meta)
-                return
-        raise KeyError(f'No storage with mark {mark}')
+        key = _canonical_mark(mark)
+        if key not in self._marks:
+            raise KeyError(f'No storage with mark {mark}')
+        meta = self._marks.pop(key)
+        del self._names[meta.name]
+        self._dirty = True
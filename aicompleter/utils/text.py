@@ -5,6 +5,8 @@ import asyncio
 import json
 import re
 from .. import common
+from .aio import SingleFlight
+from .network import get_session
 
 def contains_substring(original, target):
     index = 0
@@ -17,13 +19,26 @@ def contains_substring(original, target):
                 return True
     return False
 
+_page_flight = SingleFlight()
+'''
+Fetches of the web pages in flight, shared by the pages with the same url and options
+'''
+
+async def _fetch_page(url:str, proxy:Optional[str], options:dict[str, Any]) -> str:
+    # The pooled session is used, the shared fetch should not depend on the session of any caller
+    async with get_session().get(url, proxy=proxy, **options) as response:
+        response.raise_for_status()
+        return await response.text()
+
 class RemoteWebPage(common.AsyncContentManager):
+    '''
+    Remote web page, the concurrent fetches of the same page are deduplicated
+    '''
     def __init__(self, url, proxy: Optional[str] = None, **options):
         self.url = url
         self.proxy = proxy
         self.options = options
         self._page_cache = None
-        self._session = aiohttp.ClientSession()
         self._bs4_cache = None
 
     async def __aenter__(self) -> Self:
@@ -31,13 +46,12 @@ class RemoteWebPage(common.AsyncContentManager):
         return self
 
     async def __aexit__(self, exc_type, exc_value, traceback) -> None:
-        await self._session.close()
+        pass
 
     async def _get_page(self):
         if self._page_cache is None:
-            async with self._session.get(self.url, proxy=self.proxy, **self.options) as response:
-                response.raise_for_status()
-                self._page_cache = await response.text()
+            key = (self.url, self.proxy, json.dumps(self.options, sort_keys=True, default=str))
+            self._page_cache = await _page_flight.do(key, lambda: _fetch_page(self.url, self.proxy, self.options))
         return self._page_cache
 
     async def getText(self) -> str:
@@ -58,10 +72,6 @@ class RemoteWebPage(common.AsyncContentManager):
         '''
         return (await self.getText()).splitlines()
 
-    def __del__(self):
-        if not self._session.closed:
-            asyncio.create_task(self._session.close())
-
     async def getParsed(self):
         if self._bs4_cache is None:
             import bs4
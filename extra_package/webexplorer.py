@@ -153,13 +153,13 @@ class WebSummarier(ac.ai.ChatInterface):
             await ac.utils.thread_run(driver.implicitly_wait)(10)
             # Get the text
             text = driver.find_element(By.CSS_SELECTOR, 'body').get_attribute('innerText')
-            encoded = self.ai.getToken(text)
+            encoded, = await self.ai.encoder.encode_many([text])
             if len(encoded) <= 1024:
                 # There is no need to summarize a short text
                 return text
             # Try extract the main content
             text = ac.utils.extract_text(driver.find_element(By.CSS_SELECTOR, 'body').get_attribute('innerHTML'))
-            encoded = self.ai.getToken(text)
+            encoded, = await self.ai.encoder.encode_many([text])
             split_token = ac.utils.getChunkedToken(encoded, 2048)
             # Summarize the text
             # Get the summary class
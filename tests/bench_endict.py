@@ -0,0 +1,98 @@
+'''
+Benchmark of EnhancedDict, compared with the legacy implementation
+
+Run with `python tests/bench_endict.py`
+'''
+import asyncio
+import sys, os
+import timeit
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from aicompleter.utils import EnhancedDict
+
+class LegacyEnhancedDict(dict):
+    '''
+    The legacy implementation (only the benchmarked methods),
+    which wraps the nested dicts eagerly and allocates a lock per dict
+    '''
+    def __update_dict(self) -> None:
+        for key, value in self.items():
+            if isinstance(value, dict):
+                self[key] = self.__class__(value, readonly=self._lock.locked())
+
+    def __init__(self, *args, **kwargs) -> None:
+        self._lock = asyncio.Lock()
+        self._lock._locked = kwargs.pop('readonly', False)
+        super().__init__(*args, **kwargs)
+        self.__update_dict()
+
+    def __missing__(self, key):
+        self[key] = self.__class__()
+        return super().__getitem__(key)
+
+    def set(self, path, value):
+        if '.' in path:
+            spilts = path.split('.', 1)
+            if spilts[0] not in self:
+                super().__setitem__(spilts[0], self.__class__())
+            super().__getitem__(spilts[0]).set(spilts[1],value)
+            return
+        if isinstance(value, dict):
+            value = self.__class__(value)
+        return super().__setitem__(path, value)
+
+    def get(self, path, default = ...):
+        spilts = path.split('.', 1)
+        if len(spilts) == 1:
+            if default is ...:
+                if path not in self:
+                    return self.__class__()
+            ret = super().get(path, default)
+            if isinstance(ret, dict):
+                return self.__class__(ret)
+            return ret
+        else:
+            return self[spilts[0]].get(spilts[1], default)
+
+    def __contains__(self, __key):
+        spilts = __key.split('.', 1)
+        if len(spilts) == 1:
+            return super().__contains__(__key)
+        else:
+            return self[spilts[0]].__contains__(spilts[1])
+
+    def __getitem__(self, __key):
+        spilts = __key.split('.', 1)
+        if len(spilts) == 1:
+            return super().__getitem__(__key)
+        else:
+            return self[spilts[0]].__getitem__(spilts[1])
+
+    __setitem__ = set
+
+def _make_data(width:int = 10, depth:int = 3) -> dict:
+    if depth == 0:
+        return {f'key{i}': i for i in range(width)}
+    return {f'key{i}': _make_data(width, depth - 1) for i in range(width)}
+
+DATA = _make_data()
+
+CASES = {
+    'construct': lambda cls: (lambda: cls(DATA)),
+    'getitem': lambda cls: (lambda d=cls(DATA): d['key1']),
+    'getitem-dotted': lambda cls: (lambda d=cls(DATA): d['key1.key2.key3']),
+    'contains': lambda cls: (lambda d=cls(DATA): 'key1' in d),
+    'get-nested': lambda cls: (lambda d=cls(DATA): d.get('key1')),
+    'setitem': lambda cls: (lambda d=cls(DATA): d.set('key1.key2.key3', 1)),
+}
+
+def main(number:int = 200) -> None:
+    print(f"{'case':<16}{'legacy(us)':>12}{'current(us)':>14}{'speedup':>10}")
+    for name, factory in CASES.items():
+        legacy = timeit.timeit(factory(LegacyEnhancedDict), number=number) / number * 1e6
+        current = timeit.timeit(factory(EnhancedDict), number=number) / number * 1e6
+        print(f"{name:<16}{legacy:>12.3f}{current:>14.3f}{legacy / current:>9.1f}x")
+    legacy_size = sys.getsizeof(LegacyEnhancedDict()) + sys.getsizeof(LegacyEnhancedDict().__dict__)
+    print(f"empty instance size: legacy {legacy_size} bytes (with lock excluded), current {sys.getsizeof(EnhancedDict())} bytes")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+import asyncio
+import pickle
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import aicompleter as ac
+from aicompleter.ai import Conversation, Message, MessageList
+
+class CharEncoder:
+    '''Encoder of one token per character'''
+    name = 'char'
+    def encode(self, text:str) -> list[int]:
+        return [ord(i) for i in text]
+    def decode(self, tokens:list[int]) -> str:
+        return ''.join(chr(i) for i in tokens)
+    def getTokenLength(self, text:str) -> int:
+        return len(text)
+
+def test_MessageList():
+    messages = [Message(content=f'message{i}') for i in range(3)]
+    base = MessageList(messages)
+    fork = base.fork()
+    # The appending is done in place, and invisible to the other forks
+    base.append(Message(content='base'))
+    fork.append(Message(content='fork'))
+    assert [str(i) for i in base] == ['message0', 'message1', 'message2', 'base']
+    assert [str(i) for i in fork] == ['message0', 'message1', 'message2', 'fork']
+    assert base._buffer is not fork._buffer
+
+    # The modification copies the shared buffer
+    snapshot = base.fork()
+    base[0] = Message(content='changed')
+    del base[-1]
+    assert str(snapshot[0]) == 'message0' and len(snapshot) == 4
+    assert [str(i) for i in base] == ['changed', 'message1', 'message2']
+    assert [str(i) for i in base[:2]] == ['changed', 'message1']
+    assert base == list(base)
+    assert pickle.loads(pickle.dumps(base)) == base
+
+def test_ConversationFork():
+    conversation = Conversation(messages=[Message(content='system', role='system')])
+    fork = conversation.fork()
+    fork.messages.append(Message(content='hello', role='user'))
+    assert len(conversation) == 1 and len(fork) == 2
+    assert fork.id == conversation.id
+
+    encoder = CharEncoder()
+    fork.messages.append(Message(content='abcdefgh', role='user'))
+    limited = fork.limit_token(encoder, max_token=6)
+    assert [str(i) for i in limited.messages] == ['system', 'cdefgh']
+    assert len(fork) == 3
+    assert ac.common.serialize(fork)['data']['messages']['type'] == 'list'
+
+def test_TokenPrefix():
+    class CountEncoder(CharEncoder):
+        calls = 0
+        def getTokenLength(self, text:str) -> int:
+            CountEncoder.calls += 1
+            return len(text)
+    class CountList(MessageList):
+        __slots__ = ()
+        calls = 0
+        def __getitem__(self, index):
+            CountList.calls += 1
+            return super().__getitem__(index)
+    encoder = CountEncoder()
+    conversation = Conversation(messages=CountList([Message(content='a' * i) for i in range(1, 4)]))
+    assert conversation.getTokenPrefix(encoder) == [0, 1, 3, 6]
+
+    # The appended messages are counted only, the cached part is not compared
+    for message in conversation.messages:
+        message.__dict__.pop('_token_cache', None)
+    CountEncoder.calls = CountList.calls = 0
+    conversation.messages.append(Message(content='abcd'))
+    assert conversation.getTokenPrefix(encoder) == [0, 1, 3, 6, 10]
+    assert CountEncoder.calls == 1 and CountList.calls == 0
+
+    # The replaced, removed and truncated messages are found
+    conversation.messages[1] = Message(content='xxxxx')
+    assert conversation.getTokenLength(encoder) == 13
+    del conversation.messages[0]
+    assert conversation.getTokenPrefix(encoder) == [0, 5, 8, 12]
+    conversation.messages = conversation.messages[:2]
+    assert conversation.getTokenPrefix(encoder) == [0, 5, 8]
+    conversation.messages.append(Message(content='y'))
+    assert conversation.getTokenPrefix(encoder) == [0, 5, 8, 9]
+
+def test_Encoder(monkeypatch):
+    import tiktoken
+    from aicompleter.ai import token
+    # A byte level encoding, the encoding files are not downloaded
+    encoding = tiktoken.Encoding('test-bytes', pat_str=r'\S+|\s+', mergeable_ranks={bytes([i]): i for i in range(256)}, special_tokens={})
+    monkeypatch.setattr(token, '_load_encoding', lambda model, name: encoding)
+    encoder = token.Encoder.get(encoding='test-bytes')
+    assert token.Encoder.get(encoding='test-bytes') is encoder
+    assert encoder.name == 'test-bytes'
+
+    texts = ['hello', 'world, 你好', '']
+    async def _intest():
+        assert await encoder.encode_many(texts) == [encoder.encode(i) for i in texts]
+        assert await encoder.count_many(texts) == [encoder.getTokenLength(i) for i in texts]
+    asyncio.run(_intest())
+
+def test_CommandExecutor():
+    from aicompleter.ai.agent import CommandExecutor
+    async def _intest():
+        running = 0
+        max_running = 0
+        calls = []
+        async def _call(cmd, param):
+            nonlocal running, max_running
+            running += 1
+            max_running = max(max_running, running)
+            calls.append((cmd, param))
+            await asyncio.sleep(0.01)
+            running -= 1
+            if cmd == 'fail':
+                raise ValueError('failed')
+            return f'{cmd}-result'
+
+        executor = CommandExecutor(_call, max_concurrency=2)
+        assert CommandExecutor.dependencies(['a', '$last_result', {'x': '$result[0]'}, 'd']) == [set(), {0}, {0}, set()]
+        tasks = executor.submit([
+            ('a', 'x'), ('b', 'y'), ('c', 'z'), ('d', {'value': '$result[0] $result[1]'}), ('e', '$last_result'),
+        ], last_result='init')
+        results = await asyncio.gather(*tasks)
+        assert results == ['a-result', 'b-result', 'c-result', 'd-result', 'e-result']
+        # The independent commands are run in parallel, with the limit
+        assert max_running == 2
+        assert ('d', {'value': 'a-result b-result'}) in calls
+        assert ('e', 'd-result') in calls
+
+        # The failure is passed to the dependent commands
+        tasks = executor.submit([('fail', ''), ('e', '$last_result')])
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        assert isinstance(results[0], ValueError)
+        assert isinstance(results[1], ac.error.Interrupted)
+
+        # The commands not done are cancelled
+        tasks = executor.submit([('f', ''), ('g', '$last_result')])
+        await asyncio.sleep(0)
+        executor.cancel()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        assert all(isinstance(i, asyncio.CancelledError) for i in results)
+        assert executor.running == 0
+    asyncio.run(_intest())
+
+def test_Agent():
+    from aicompleter.ai import ChatTransformer
+    from aicompleter.ai.agent import Agent
+    class FakeChater(ChatTransformer):
+        def __init__(self, responses):
+            super().__init__(name='fake', config=ac.Config())
+            self.responses = list(responses)
+            self.requests = []
+        async def generate(self, conversation):
+            self.requests.append((list(conversation.messages), agent._request_queue.held))
+            yield Message(content=self.responses.pop(0), role='assistant')
+
+    async def _run(responses):
+        nonlocal agent
+        called = []
+        async def _call(cmd, param):
+            await asyncio.sleep(0.01)
+            called.append(cmd)
+            return f'{cmd}-result'
+        chater = FakeChater(responses)
+        agent = Agent(chater)
+        agent.on_call = _call
+        agent.ask('start')
+        await asyncio.wait_for(agent.wait(), 5)
+        return chater, called
+
+    agent = None
+    async def _intest():
+        # The result of the command is requested after the command is done
+        chater, called = await _run([
+            '{"commands":[{"cmd":"echo","param":"hi"}]}',
+            '{"commands":[{"cmd":"stop","param":"done"}]}',
+        ])
+        assert called == ['echo']
+        assert agent.result == 'done'
+        messages, held = chater.requests[1]
+        assert held == 0
+        assert '"command-result"' in messages[-1].content and 'echo-result' in messages[-1].content
+
+        # The commands before stop are run
+        chater, called = await _run(['{"commands":[{"cmd":"echo","param":"hi"},{"cmd":"stop","param":"done"},{"cmd":"after","param":""}]}'])
+        assert called == ['echo']
+        assert agent.result == 'done'
+    asyncio.run(_intest())
+
+def test_ResponseCache(tmp_path):
+    from aicompleter.ai import ChatTransformer, ResponseCache, CachedChatTransformer
+    class FakeChater(ChatTransformer):
+        calls = 0
+        data = {}
+        async def generate(self, conversation):
+            FakeChater.calls += 1
+            yield Message(content=f'reply{FakeChater.calls}', role='assistant', data=FakeChater.data)
+
+    async def _intest():
+        path = str(tmp_path / 'cache.db')
+        chater = FakeChater(config=ac.Config({'chat': {'temperature': 0}, 'openai': {'api-key': 'secret'}}))
+        ai = CachedChatTransformer(chater, ResponseCache(maxsize=1, path=path))
+        conversation = Conversation(messages=[Message(content='hello', role='user')])
+        assert await ai.generate_text(conversation=conversation) == 'reply1'
+        assert await ai.generate_text(conversation=conversation) == 'reply1'
+        assert FakeChater.calls == 1
+        assert (ai.cache.hits, ai.cache.misses) == (1, 1)
+        # The api key is not a part of the key
+        chater.config['openai.api-key'] = 'other'
+        assert await ai.generate_text(conversation=conversation) == 'reply1'
+
+        # The evicted responses are read from the disk
+        other = Conversation(messages=[Message(content='other', role='user')])
+        assert await ai.generate_text(conversation=other) == 'reply2'
+        assert await ai.generate_text(conversation=conversation) == 'reply1'
+        assert ai.cache.disk_hits == 1
+
+        # The cached responses are not changed by the consumers
+        async for message in ai.generate(conversation):
+            message.data['changed'] = True
+        async for message in ai.generate(conversation):
+            assert message.data == {}
+
+        # The responses which can't be stored are still streamed
+        circular = {}
+        circular['self'] = circular
+        FakeChater.data = {'obj': object(), 'circular': circular}
+        third = Conversation(messages=[Message(content='third', role='user')])
+        assert await ai.generate_text(conversation=third) == 'reply3'
+        FakeChater.data = {}
+
+        # All the fields of the request are a part of the key
+        functions = Conversation(messages=[Message(content='hello', role='user')], data={'functions': [{'name': 'now'}]})
+        assert await ai.generate_text(conversation=functions) == 'reply4'
+        named = Conversation(messages=[Message(content='hello', role='user', data={'function_call': {'name': 'now'}})])
+        assert await ai.generate_text(conversation=named) == 'reply5'
+        assert await ai.generate_text(conversation=functions) == 'reply4'
+        ai.cache.close()
+
+        # The non-deterministic responses are not cached
+        chater.config['chat.temperature'] = 1
+        assert await ai.generate_text(conversation=conversation) == 'reply6'
+        assert await ai.generate_text(conversation=conversation) == 'reply7'
+        assert ai.config is chater.config
+    asyncio.run(_intest())
+
+def test_SingleFlightTransformer():
+    from aicompleter.ai import ChatTransformer
+    from aicompleter.ai.cache import single_flight
+    class FakeChater(ChatTransformer):
+        calls = 0
+        async def generate(self, conversation):
+            FakeChater.calls += 1
+            for i in range(3):
+                await asyncio.sleep(0.01)
+                yield Message(content=f'reply{FakeChater.calls}-{i}', role='assistant')
+
+    async def _intest():
+        # The non-deterministic requests in flight are deduplicated as well
+        ai = single_flight(FakeChater(config=ac.Config({'chat': {'temperature': 1}})))
+        conversation = Conversation(messages=[Message(content='hello', role='user')])
+        results = await asyncio.gather(*(ai.generate_text(conversation=conversation) for _ in range(3)))
+        assert results == ['reply1-2'] * 3
+        assert FakeChater.calls == 1
+        # The requests not in flight are not deduplicated
+        assert await ai.generate_text(conversation=conversation) == 'reply2-2'
+
+        # Each consumer of a shared stream gets its own messages
+        async def _last():
+            async for message in ai.generate(conversation):
+                pass
+            message.content = 'changed'
+            message.data['changed'] = True
+            return message
+        messages = await asyncio.gather(*(_last() for _ in range(3)))
+        assert FakeChater.calls == 3
+        assert len({id(i) for i in messages}) == len({id(i.data) for i in messages}) == 3
+    asyncio.run(_intest())
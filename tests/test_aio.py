@@ -0,0 +1,92 @@
+import asyncio
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import aicompleter as ac
+import pytest
+
+def test_CoalescingQueue():
+    async def _intest():
+        loop = asyncio.get_running_loop()
+        queue = ac.utils.CoalescingQueue(max_wait=10)
+        # No producer held, return without waiting
+        queue.put_nowait(1)
+        queue.put_nowait(2)
+        start = loop.time()
+        assert await queue.get_batch() == [1, 2]
+        assert loop.time() - start < 1
+
+        # Wait until the held producers are released
+        async def _produce(value, delay):
+            await asyncio.sleep(delay)
+            queue.put_nowait(value)
+        queue.put_nowait(0)
+        for i in range(1, 4):
+            queue.track(loop.create_task(_produce(i, i * 0.01)))
+        start = loop.time()
+        assert await queue.get_batch() == [0, 1, 2, 3]
+        assert loop.time() - start < 1
+        assert queue.held == 0
+
+        # The max wait is the upper bound
+        queue.max_wait = 0.05
+        queue.put_nowait(0)
+        queue.hold()
+        assert await queue.get_batch() == [0]
+        queue.release()
+
+        assert queue.batch_sizes == {2: 1, 4: 1, 1: 1}
+        assert queue.average_batch_size == pytest.approx(7 / 3)
+    asyncio.run(_intest())
+
+def test_SingleFlight():
+    async def _intest():
+        flight = ac.utils.SingleFlight()
+        calls = 0
+        started = asyncio.Event()
+        async def _fetch():
+            nonlocal calls
+            calls += 1
+            started.set()
+            await asyncio.sleep(0.05)
+            return calls
+        assert await asyncio.gather(*(flight.do('url', _fetch) for _ in range(3))) == [1, 1, 1]
+        assert (calls, flight.shared, len(flight)) == (1, 2, 0)
+
+        # One caller cancelled, the others still get the result
+        callers = [asyncio.create_task(flight.do('url', _fetch)) for _ in range(2)]
+        await started.wait()
+        callers[0].cancel()
+        assert await callers[1] == 2
+        assert callers[0].cancelled()
+
+        # All the callers cancelled, the call is dropped
+        started.clear()
+        caller = asyncio.create_task(flight.do('url', _fetch))
+        await started.wait()
+        caller.cancel()
+        await asyncio.sleep(0)
+        assert len(flight) == 0
+        assert await flight.do('url', _fetch) == 4
+
+        # The stream is shared, and replayed to the late subscribers
+        async def _produce():
+            nonlocal calls
+            calls += 1
+            for i in range(3):
+                await asyncio.sleep(0.01)
+                yield i
+        async def _collect():
+            return [item async for item in flight.stream('stream', _produce)]
+        first = asyncio.create_task(_collect())
+        await asyncio.sleep(0.015)
+        assert await asyncio.gather(first, _collect()) == [[0, 1, 2], [0, 1, 2]]
+        assert calls == 5
+
+        # The errors are delivered to all the callers
+        async def _fail():
+            await asyncio.sleep(0.01)
+            raise ValueError('failed')
+        results = await asyncio.gather(*(flight.do('fail', _fail) for _ in range(2)), return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+        assert len(flight) == 0
+    asyncio.run(_intest())
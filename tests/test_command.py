@@ -1,3 +1,4 @@
+import asyncio
 import sys,os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import pytest
@@ -13,6 +14,14 @@ def test_Format():
     assert not struct.check({'wrong-key': 1})
     assert not struct.check({'key': 1, 'key2': 2})
     assert struct.check({'key': 1, 'key2': '2'})
+    assert struct.check_many([{'key': 1}, {'key': '1'}]) == [True, False]
+
+    data = {'key': 1}
+    assert struct.normalize(data) == {'key': 1, 'key2': 'default'}
+    # The data should not be modified
+    assert data == {'key': 1}
+    with pytest.raises(ValueError):
+        struct.normalize({'key': '1'})
 
 def test_BaseCommand():
     ac.Command('cmd')
@@ -29,3 +38,116 @@ def test_BaseCommand():
     assert cmd.callback == testfunc
     assert cmd.check({'key': 1})
     assert not cmd.check({'key': '1'})
+
+def test_NamespaceIndex():
+    root = ac.Namespace(name='root')
+    sub = ac.Namespace(name='sub')
+    other = ac.Namespace(name='other')
+    root.subnamespaces['sub'] = sub
+    root.subnamespaces['other'] = other
+    echo = ac.Command('echo', alias={'say'}, callable_groups={'user'}, overrideable=False)
+    root.commands.add(echo)
+    sub.commands.add(ac.Command('list', callable_groups={'user', 'admin'}))
+
+    # Resolution by name, alias and group
+    assert root.get_executable_cmd('echo') is echo
+    assert root.get_executable_cmd('say') is echo
+    assert root.get_executable_cmd('say', 'user') is echo
+    assert root.get_executable_cmd('echo', 'admin') is None
+    assert root.get_executable_cmd('list', 'admin') is sub.commands['list']
+    assert root.get_executable_cmd('missing') is None
+
+    # The overrideable command is overridden, the conflicted ones raise
+    override = ac.Command('echo', callable_groups={'user'}, overrideable=True)
+    other.commands.add(override)
+    assert root.get_executable_cmd('echo', 'user') is echo
+    other.commands.add(ac.Command('list', callable_groups={'admin'}, overrideable=False))
+    sub.commands['list'].overrideable = False
+    with pytest.raises(ac.error.Existed):
+        root.get_executable_cmd('list', 'admin')
+    other.commands.remove('list')
+
+    # The index is updated after the commands are changed
+    sub.commands.add(ac.Command('new', callable_groups={'user'}))
+    assert root.get_executable_cmd('new', 'user') is sub.commands['new']
+    sub.commands.remove('new')
+    assert root.get_executable_cmd('new', 'user') is None
+    echo.callable_groups.add('admin')
+    assert root.get_executable_cmd('echo', 'admin') is echo
+    echo.callable_groups = {'user'}
+    assert root.get_executable_cmd('echo', 'admin') is None
+    echo.alias = {'print'}
+    assert root.get_executable_cmd('print') is echo
+    assert root.get_executable_cmd('say') is None
+
+    # Only the namespaces owning the changed commands are invalidated
+    root._update_index()
+    generations = (root._generation, sub._generation, other._generation)
+    ac.Commands().add(ac.Command('throwaway'))
+    ac.Command('detached').callable_groups.add('user')
+    assert (root._generation, sub._generation, other._generation) == generations
+    other.commands.add(ac.Command('other'))
+    assert sub._generation == generations[1]
+    assert root._generation > generations[0]
+    del root.subnamespaces['other']
+    other.commands.add(ac.Command('another'))
+    root._update_index()
+    generation = root._generation
+    other.commands.add(ac.Command('more'))
+    assert root._generation == generation
+
+def test_BindingPlan():
+    from aicompleter.interface.command import _BindingPlan
+    def _legacy_bind(cmd, session, message):
+        # The binding before the plan was introduced
+        params = ac.utils.appliable_parameters(cmd.callback, {
+            'session': session,
+            'message': message,
+            'logger': cmd.logger,
+            'interface': cmd.in_interface,
+        })
+        sig = ac.utils.get_signature(cmd.callback)
+        if 'config' in sig.parameters:
+            params['config'] = cmd.in_interface.getconfig(session)
+        if 'data' in sig.parameters:
+            params['data'] = cmd.in_interface.getdata(session)
+        if 'content' in sig.parameters:
+            params['content'] = message.content
+        data = message.content.json
+        if isinstance(data, dict):
+            for k, v in data.items():
+                if k in sig.parameters:
+                    params.setdefault(k, v)
+        return params
+
+    async def _async(key, message): pass
+    callbacks = [
+        lambda: None,
+        lambda session, message: None,
+        lambda logger, interface: None,
+        lambda config, data: None,
+        lambda content: None,
+        lambda key, key2: None,
+        # The payload doesn't override the injected values
+        lambda key, session: None,
+        # The missing keys are not bound
+        lambda key, missing: None,
+        _async,
+    ]
+    interface = ac.Interface('test')
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    handler = ac.Handler(loop=loop)
+    async def _intest():
+        await handler.add_interface(interface)
+        session = await handler.new_session()
+        message = ac.Message(content={'key': 1, 'key2': '2', 'session': 'payload'}, session=session)
+        for callback in callbacks:
+            cmd = ac.Command('cmd', callback=callback, in_interface=interface)
+            plan = _BindingPlan.build(callback)
+            params = plan.bind(cmd, session, message)
+            assert params == _legacy_bind(cmd, session, message)
+            assert plan.param_count == len(ac.utils.get_signature(callback).parameters)
+        assert _BindingPlan.build(None) is None
+        await handler.close()
+    loop.run_until_complete(_intest())
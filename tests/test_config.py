@@ -1,3 +1,4 @@
+import json
 import sys, os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import aicompleter as ac
@@ -44,6 +45,16 @@ def test_Config():
     with pytest.raises(ac.error.ConfigureMissing):
         config.require('d')
 
+    # get copies the nested dicts, view shares them
+    config = ac.Config({'a': {'b': {'c': 1}}})
+    copied = config.get('a')
+    copied['b.c'] = 2
+    copied['d'] = 3
+    assert config['a.b.c'] == 1 and 'd' not in config['a']
+    assert config.view('a') is config['a']
+    config.view('a.b')['c'] = 4
+    assert config['a.b.c'] == 4
+
     with pytest.raises(TypeError):
         config = ac.Config(1)
 
@@ -83,4 +94,85 @@ def test_ConfigModel():
     assert isinstance(config.v, TestModel)
     assert config.v == TestModel(a='a', b=1, c=[1, 2, 3], d={'a': 'b'})
 
+def test_ConfigGeneration():
+    config = ac.Config({'a': 1, 'b': {'c': 2}})
+    generation = config.generation
+    # The other configs and the no-op writes don't change the generation
+    ac.Config()['a'] = 2
+    config['a'] = 1
+    config.setdefault('a', 3)
+    config['b'] = {'c': 2}
+    assert config.generation == generation
+
+    # The changes of the nested configs are counted
+    config['b']['c'] = 3
+    assert config.generation > generation
+    generation = config.generation
+    config['b.d'] = 4
+    assert config.generation > generation
+    generation = config.generation
+    config['e.f'] = 5
+    assert config.generation > generation
+
+    # The layered views follow the changes of the layers
+    view = ac.LayeredConfig(config)
+    assert view['b.c'] == 3
+    config['b']['c'] = 6
+    assert view['b.c'] == 6
+    config.pop('a')
+    assert 'a' not in view
+
+def test_LayeredConfig():
+    base = ac.Config({'a': 'b', 'c': {'d': 'e', 'f': 'g'}})
+    top = ac.Config({'c': {'d': 'h'}})
+    config = ac.LayeredConfig(base, top)
+
+    # Lookup through the layers
+    assert config['a'] == 'b'
+    assert config['c.d'] == 'h'
+    assert config['c']['f'] == 'g'
+    assert isinstance(config['c'], ac.Config)
+    assert config == {'a': 'b', 'c': {'d': 'h', 'f': 'g'}}
+    assert not config.modified
+
+    # The change of layers is visible
+    base['a'] = 'i'
+    assert config['a'] == 'i'
+
+    # The modification will not change the layers
+    config['c.f'] = 'j'
+    assert config['c.f'] == 'j'
+    assert base['c.f'] == 'g'
+    assert config.modified
+    assert config.materialize() == {'a': 'i', 'c': {'d': 'h', 'f': 'j'}}
+
+    with pytest.raises(ac.error.ConfigureMissing):
+        config.require('d')
 
+    # The lists in the layers are copied on write
+    base['l'] = [1, 2]
+    view = ac.LayeredConfig(base)
+    view['l'].append(3)
+    assert view['l'] == [1, 2, 3]
+    assert base['l'] == [1, 2]
+    assert view.modified
+    assert type(view.materialize()['l']) is list
+
+    # The empty nested view of a missing key doesn't hide the key added later
+    view = ac.LayeredConfig(base)
+    assert not view['x']
+    base['x'] = {'y': 1}
+    assert view['x.y'] == 1
+    view['z']['y'] = 2
+    assert view['z.y'] == 2 and view.modified
+
+    # The dict storage keeps the merged values for the code reading it directly
+    base = ac.Config({'a': 1, 'b': {'c': 2, 'l': [1]}})
+    view = ac.LayeredConfig(base, ac.Config({'b': {'d': 3}}))
+    assert json.loads(json.dumps(view)) == {'a': 1, 'b': {'c': 2, 'l': [1], 'd': 3}}
+    assert json.loads(json.dumps(view['b'])) == {'c': 2, 'l': [1], 'd': 3}
+    view['a'] = 4
+    del view['b.c']
+    base['e'] = 5
+    assert json.loads(json.dumps(view)) == {'a': 4, 'b': {'l': [1], 'd': 3}, 'e': 5}
+    assert dict.copy(view)['e'] == 5
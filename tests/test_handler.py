@@ -139,5 +139,170 @@ def test_InterfaceCommand():
         assert await session.asend('test2', {'key': 1, 'key2': '2'}) == (1, '2')
         assert await session.asend('test3', {'key': 1}) == True
 
+        # The content is rebuilt only if the format changes it
+        message = ac.Message(content={'key': 1, 'key2': '2'}, cmd='test2')
+        content = message.content
+        assert await session.asend(message) == (1, '2')
+        assert message.content is content
+        message = ac.Message(content={'key': 1}, cmd='test2')
+        assert await session.asend(message) == (1, 'default')
+        assert message.content.json == {'key': 1, 'key2': 'default'}
+
+    loop.run_until_complete(_intest())
+
+
+def test_SessionTemplate():
+    class TestInterface(ac.Interface):
+        async def session_init(self, config:Config):
+            config['count'] = config.get('count', 0) + 1
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    handler = ac.Handler(config=ac.Config({
+        'global': {'a': 'b'},
+        'test': {'count': 1},
+    }), loop=loop)
+    async def _intest():
+        await handler.add_interface(TestInterface('test'))
+        session1 = await handler.new_session()
+        session2 = await handler.new_session()
+        # The sessions are isolated, and the handler config is untouched
+        assert session1.config['test.count'] == 2
+        assert session2.config['test.count'] == 2
+        assert session1.config['test.a'] == 'b'
+        assert handler.config['test.count'] == 1
+        # The writes to the sessions and the no-op writes don't drop the template
+        template = handler._get_session_template()
+        handler.config.setdefault('test.count', 3)
+        handler.config['global.a'] = 'b'
+        await handler.new_session()
+        assert handler._get_session_template() is template
+
+        # The template is rebuilt when the config is changed
+        handler.config['test.count'] = 5
+        session3 = await handler.new_session()
+        assert session3.config['test.count'] == 6
+        await handler.close()
+
     loop.run_until_complete(_intest())
 
+def test_LazySessionInit():
+    inited = []
+    finaled = []
+    class TestInterface(ac.Interface):
+        cmdreg:ac.Commands = ac.Commands()
+        async def session_init(self, session:ac.Session):
+            await asyncio.sleep(0)
+            inited.append(self.namespace.name)
+        async def session_final(self, session:ac.Session):
+            finaled.append(self.namespace.name)
+
+        @cmdreg.register('echo', 'echo')
+        async def echo(self, message:ac.Message):
+            return message.content.text
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    handler = ac.Handler(loop=loop)
+    handler.lazy_session_init = True
+    lazy = TestInterface('lazy')
+    eager = TestInterface('eager')
+    eager.lazy_session_init = False
+    spawn_sessions = []
+    class SpawnInterface(ac.Interface):
+        cmdreg:ac.Commands = ac.Commands()
+        async def session_init(self, session:ac.Session):
+            inited.append(self.namespace.name)
+            if spawn_sessions and session is spawn_sessions[0]:
+                # The task inherits the context of the init
+                await asyncio.get_running_loop().create_task(spawn_sessions[1].asend(ac.Message(content='b', cmd='echo', dest_interface=self)))
+
+        @cmdreg.register('echo', 'echo')
+        async def echo(self, message:ac.Message):
+            return message.content.text
+    spawn = SpawnInterface('spawn')
+    async def _intest():
+        await handler.add_interface(lazy, eager, spawn)
+        session = await handler.new_session()
+        assert inited == ['eager']
+        # Concurrent first calls init the interface only once
+        results = await asyncio.gather(*[session.asend(ac.Message(content='a', cmd='echo', dest_interface=lazy)) for _ in range(3)])
+        assert results == ['a'] * 3
+        assert sorted(inited) == ['eager', 'lazy']
+        await session.close()
+        assert sorted(finaled) == ['eager', 'lazy']
+
+        # The init in another session is not skipped by the tasks created in the init
+        spawn_sessions.extend([await handler.new_session(), await handler.new_session()])
+        inited.clear()
+        assert await spawn_sessions[0].asend(ac.Message(content='a', cmd='echo', dest_interface=spawn)) == 'a'
+        assert inited.count('spawn') == 2
+        await handler.close()
+
+    loop.run_until_complete(_intest())
+
+def test_CurrentCommand():
+    from aicompleter.utils.special import getcallercommand, getcallerinterface
+    seen = []
+    class TestInterface(ac.Interface):
+        cmdreg:ac.Commands = ac.Commands()
+        @cmdreg.register('a', 'a')
+        async def a(self):
+            seen.append(('a', getcallercommand().name))
+            await asyncio.sleep(0.01)
+            # The tasks created in the command inherit it
+            task_command = await asyncio.get_running_loop().create_task(asyncio.sleep(0, getcallercommand()))
+            seen.append(('a', getcallercommand().name, task_command.name))
+            return getcallerinterface() is self
+
+        @cmdreg.register('b', 'b')
+        async def b(self):
+            seen.append(('b', getcallercommand().name))
+            await asyncio.sleep(0.01)
+            seen.append(('b', getcallercommand().name))
+
+        @cmdreg.register('outer', 'outer')
+        async def outer(self, session:ac.Session):
+            await session.asend(ac.Message(content='', cmd='a', dest_interface=self))
+            # Restored after the inner command returns
+            return getcallercommand().name
+
+        @cmdreg.register('call-lazy', 'call-lazy')
+        async def call_lazy(self, session:ac.Session):
+            return await session.asend(ac.Message(content='', cmd='lazy', src_interface=lazy, dest_interface=lazy))
+
+    init_seen = []
+    class LazyInterface(ac.Interface):
+        cmdreg:ac.Commands = ac.Commands()
+        async def session_init(self, session:ac.Session):
+            init_seen.append(getcallercommand())
+            init_seen.append(await asyncio.get_running_loop().create_task(asyncio.sleep(0, getcallercommand())))
+
+        @cmdreg.register('lazy', 'lazy')
+        async def lazy(self):
+            return getcallercommand().name
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    handler = ac.Handler(loop=loop)
+    handler.lazy_session_init = True
+    test = TestInterface('test')
+    lazy = LazyInterface('lazy')
+    async def _intest():
+        await handler.add_interface(test, lazy)
+        session = await handler.new_session()
+        assert getcallercommand() is None
+        # The concurrent commands are isolated
+        assert await asyncio.gather(session.asend('a'), session.asend('b')) == [True, None]
+        assert sorted(seen) == [('a', 'a'), ('a', 'a', 'a'), ('b', 'b'), ('b', 'b')]
+        assert getcallercommand() is None
+
+        assert await session.asend('outer') == 'outer'
+        assert getcallercommand() is None and getcallerinterface() is None
+
+        # The lazy session init isn't run as a part of the command triggering it
+        assert await session.asend('call-lazy') == 'lazy'
+        assert init_seen == [None, None]
+        await handler.close()
+
+    loop.run_until_complete(_intest())
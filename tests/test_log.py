@@ -12,3 +12,48 @@ def test_logModule():
 
     assert hasattr(log, 'getLogger')
     assert hasattr(log, 'setLevel')
+
+def test_QueueLogging(tmp_path):
+    handler = log.BoundedQueueHandler(maxsize=2, policy='coalesce')
+    logger = log.getLogger('test', ['sub'])
+    logger.setLevel(log.INFO)
+    record = logger.makeRecord('test', log.INFO, __file__, 0, 'message %d', (1,), None)
+    # The substruct is copied, the stack of the logger is mutable
+    prepared = handler.prepare(record)
+    logger.push('other')
+    assert prepared.substruct == ['sub']
+    logger.pop()
+
+    for _ in range(2):
+        handler.enqueue(handler.prepare(record))
+    for _ in range(3):
+        handler.enqueue(handler.prepare(record))
+    assert handler.queue.qsize() == 2
+    handler.queue.get_nowait()
+    handler.flush()
+    assert handler.queue.qsize() == 2
+    assert handler.queue.queue[-1].getMessage() == 'message 1 (repeated 3 times)'
+
+    # The pipeline writes the file in the listener thread
+    filename = str(tmp_path / 'test.log')
+    log.enable_queue(filename=filename, stream=open(os.devnull, 'w'))
+    try:
+        assert log.filehandler not in log.root.handlers
+        logger.warning('queued %s', 'message')
+    finally:
+        log.disable_queue()
+    assert log.filehandler in log.root.handlers
+    with open(filename, encoding='utf-8') as f:
+        assert 'queued message' in f.read()
+
+def test_LoggerRegistry():
+    # The loggers are shared by the name and the substruct
+    assert log.getLogger('test', ['a']) is log.getLogger('test', ['a'])
+    assert log.getLogger('test', ['a']) is not log.getLogger('test', ['b'])
+
+    assert '...' in str(log.LazyRepr('a' * 1000))
+    assert len(str(log.LazyRepr('a' * 1000))) < 1000
+
+    log.setSampleRate('test', 3)
+    assert [log.sampled('test') for _ in range(6)] == [True, False, False, True, False, False]
+    assert log.sampled('other')
@@ -0,0 +1,72 @@
+import asyncio
+import pytest
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import aicompleter as ac
+from aicompleter.utils.network import ClientSessionPool, SSEDecoder
+
+def test_SSEDecoder():
+    decoder = SSEDecoder()
+    # The partial line should be kept until the next feed
+    assert decoder.feed(b'data: {"a":') == []
+    events = decoder.feed(b' 1}\r\n\r\n: comment\nevent: update\ndata: a\ndata: b\n\n')
+    assert [i.data for i in events] == ['{"a": 1}', 'a\nb']
+    assert events[1].event == 'update'
+    assert not decoder.done
+
+    assert decoder.feed(b'data: [DONE]') == []
+    events = decoder.flush()
+    assert [i.data for i in events] == ['[DONE]']
+    assert decoder.done
+
+def test_ClientSessionPool():
+    async def _intest():
+        pool = ClientSessionPool()
+        session = pool.get()
+        # One session for each loop, recreated after closed
+        assert pool.get() is session
+        assert asyncio.get_running_loop() in pool
+        await pool.close()
+        assert session.closed
+        session = pool.get()
+        assert not session.closed
+
+        # The session is closed when the last owner releases it
+        class _Owner:
+            pass
+        first, second = _Owner(), _Owner()
+        pool.acquire(first)
+        pool.acquire(second)
+        await pool.release(first)
+        assert not session.closed
+        await pool.release(first)
+        assert not session.closed
+        await pool.release(second)
+        assert session.closed
+        # The loop is not referenced after the session is closed
+        assert not pool._sessions and not pool._owners
+
+        # Closing a handler doesn't close the session used by the other handlers
+        handler1 = ac.Handler(loop=asyncio.get_running_loop())
+        handler2 = ac.Handler(loop=asyncio.get_running_loop())
+        session = ac.utils.get_session()
+        await handler1.close()
+        assert not session.closed
+        await handler2.close()
+        assert session.closed
+    asyncio.run(_intest())
+
+    # The sessions of the closed loops are dropped
+    pool = ClientSessionPool()
+    async def _get():
+        return pool.get()
+    loop = asyncio.new_event_loop()
+    session = loop.run_until_complete(_get())
+    loop.run_until_complete(session.close())
+    loop.close()
+    assert loop in pool._sessions
+    async def _check():
+        pool.get()
+        assert loop not in pool._sessions and len(pool._sessions) == 1
+        await pool.close()
+    asyncio.run(_check())
@@ -0,0 +1,194 @@
+import asyncio
+import json
+import sys, os
+import time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import aicompleter as ac
+import pytest
+from aicompleter.session import Message, MessageStatus
+
+def test_History():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    handler = ac.Handler(loop=loop)
+    handler.history_window = 2
+    async def _intest():
+        session = await handler.new_session()
+        messages = []
+        for i in range(5):
+            message = Message(content=f'message{i}', cmd='test', session=session, last_message=messages[-1] if messages else None)
+            message.status = MessageStatus.SENT
+            messages.append(message)
+        # The status setter appends the message only once
+        assert len(session.history) == 5
+        assert len(session.history._messages) == 2
+
+        # The spilled messages are readable
+        assert [str(i) for i in session.history] == [f'message{i}' for i in range(5)]
+        assert all(i in session.history for i in messages)
+        assert session.history[0].id == messages[0].id
+        assert session.history.get(messages[1].id).last_message.id == messages[0].id
+        assert [i.id for i in session.history[-2:]] == [i.id for i in messages[-2:]]
+
+        session.history.clear()
+        assert len(session.history) == 0
+        await handler.close()
+    loop.run_until_complete(_intest())
+
+def test_MultiContent():
+    from aicompleter.session.base import MultiContent
+    source = {'a': [1, 2], 'b': {'c': 'd'}}
+    content = MultiContent(source)
+    # The content is not changed with the source dict
+    source['a'].append(3)
+    source['b']['c'] = 'e'
+    assert content.json == {'a': [1, 2], 'b': {'c': 'd'}}
+    assert json.loads(content.text) == {'a': [1, 2], 'b': {'c': 'd'}}
+
+    # Modifying the returned json does not change the content or its copies
+    copied = MultiContent(content)
+    content.json['a'].append(4)
+    content['b']['c'] = 'f'
+    assert content.json == copied.json == {'a': [1, 2], 'b': {'c': 'd'}}
+    assert json.loads(copied.text) == {'a': [1, 2], 'b': {'c': 'd'}}
+
+    # The parsed text is cached but handed out as copies
+    parsed = MultiContent('{"x": [1]}')
+    parsed.json['x'].append(2)
+    assert parsed.json == {'x': [1]}
+    assert parsed.text == '{"x": [1]}'
+
+def test_SessionEviction(tmp_path):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    handler = ac.Handler(loop=loop)
+    handler.max_sessions = 2
+    handler.session_save_dir = str(tmp_path)
+    async def _intest():
+        session1 = await handler.new_session()
+        session2 = await handler.new_session()
+        assert handler.get_session(session1.id) is session1
+        # session1 is used recently, so session2 is the least recently used
+        handler._touch_session(session1)
+        session3 = await handler.new_session()
+        assert session2.closed
+        assert handler.sessions == [session1, session3]
+        assert os.path.isdir(tmp_path / session2.id.hex)
+        with pytest.raises(ac.error.NotFound):
+            handler.get_session(session2.id)
+
+        # Idle sessions are evicted
+        handler.session_ttl = 10
+        session1.last_active -= 20
+        assert await handler.evict_sessions() == [session1]
+        assert handler.sessions == [session3]
+        await handler.close()
+    loop.run_until_complete(_intest())
+
+def test_SessionStore(tmp_path):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    handler = ac.Handler(loop=loop)
+    async def _intest():
+        session = await handler.new_session()
+        def _send(num:int):
+            for _ in range(num):
+                message = Message(content=f'message{len(session.history)}', cmd='test', session=session)
+                message.status = MessageStatus.SENT
+        segment = tmp_path / 'segment.jsonl'
+        _send(3)
+        session.save(str(tmp_path))
+        size = segment.stat().st_size
+        # Nothing changed, nothing written
+        session.save(str(tmp_path))
+        assert segment.stat().st_size == size
+        # Only the new messages are appended
+        _send(2)
+        session.save(str(tmp_path))
+        assert segment.read_bytes().count(b'\n') == 6
+
+        loaded = ac.Session.load(str(tmp_path), handler)
+        assert loaded.id == session.id
+        assert [str(i) for i in loaded.history] == [f'message{i}' for i in range(5)]
+        await handler.close()
+    loop.run_until_complete(_intest())
+
+def test_Checkpoint(tmp_path):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    handler = ac.Handler(loop=loop)
+    async def _intest():
+        first = await handler.new_session()
+        second = await handler.new_session()
+        await handler.checkpoint(str(tmp_path))
+        assert not first._dirty and not second._dirty
+        sessions = ac.utils.StorageManager.load(ac.utils.StorageManager.load(str(tmp_path))['sessions'].path)
+        segment = os.path.join(sessions[second.id.hex].path, 'segment.jsonl')
+        size = os.path.getsize(segment)
+
+        # Only the dirty session is written
+        message = Message(content='message', cmd='test', session=first)
+        message.status = MessageStatus.SENT
+        assert first._dirty and not second._dirty
+        await handler.checkpoint(str(tmp_path))
+        assert os.path.getsize(segment) == size
+
+        loaded = ac.Handler.load(str(tmp_path))
+        assert [str(i) for i in loaded.get_session(first.id).history] == ['message']
+        assert len(loaded.get_session(second.id).history) == 0
+
+        # The changes of the state are written, not only the config
+        handler.getstate = lambda: {'interfaces': [], 'changed': True}
+        await handler.checkpoint(str(tmp_path))
+        root = ac.utils.StorageManager.load(str(tmp_path))
+        assert json.loads(root.read('intmeta'))['changed']
+        del handler.getstate
+
+        # The checkpoint in flight doesn't block the event loop, the synchronous save is refused meanwhile
+        prepare = handler._prepare_checkpoint
+        def _slow_prepare(path):
+            writer = prepare(path)
+            def _write():
+                time.sleep(0.1)
+                writer()
+            return _write
+        handler._prepare_checkpoint = _slow_prepare
+        message = Message(content='message3', cmd='test', session=first)
+        message.status = MessageStatus.SENT
+        task = asyncio.create_task(handler.checkpoint(str(tmp_path)))
+        await asyncio.sleep(0.01)
+        del handler._prepare_checkpoint
+        message = Message(content='message4', cmd='test', session=first)
+        message.status = MessageStatus.SENT
+        started = time.monotonic()
+        with pytest.raises(ac.error.Conflict):
+            handler.save(str(tmp_path))
+        assert time.monotonic() - started < 0.05
+        # The next checkpoint waits for the one in flight
+        await asyncio.gather(task, handler.checkpoint(str(tmp_path)))
+        handler.save(str(tmp_path))
+        loaded = ac.Handler.load(str(tmp_path))
+        assert [str(i) for i in loaded.get_session(first.id).history] == ['message', 'message3', 'message4']
+        with open(os.path.join(sessions[first.id.hex].path, 'segment.index.json')) as f:
+            assert len(json.load(f)['messages']) == 3
+
+        # The removed sessions are dropped from the checkpoint
+        removed = await handler.new_session()
+        await handler.checkpoint(str(tmp_path))
+        removed_path = sessions.__class__.load(sessions.path)[removed.id.hex].path
+        await handler.close_session(removed)
+        await handler.checkpoint(str(tmp_path))
+        loaded = ac.Handler.load(str(tmp_path))
+        assert removed.id not in loaded._running_sessions
+        assert set(loaded._running_sessions) == {first.id, second.id}
+        assert not os.path.exists(removed_path)
+
+        # The final checkpoint on close
+        handler.autosave(str(tmp_path), 3600)
+        message = Message(content='message2', cmd='test', session=second)
+        message.status = MessageStatus.SENT
+        await handler.close()
+        loaded = ac.Handler.load(str(tmp_path))
+        # The sessions are saved closed
+        assert [str(i) for i in loaded._running_sessions[second.id].history] == ['message2']
+    loop.run_until_complete(_intest())
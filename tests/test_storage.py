@@ -0,0 +1,30 @@
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pytest
+from aicompleter.utils import StorageManager
+
+def test_StorageManager(tmp_path):
+    manager = StorageManager(str(tmp_path))
+    with manager.batch():
+        for i in range(100):
+            manager.alloc_file({'type': 'message', 'id': i})
+        # The index is written once at the end of the batch
+        assert not os.path.exists(tmp_path / 'index.json')
+    assert os.path.exists(tmp_path / 'index.json')
+
+    # The marks are compared in canonical form
+    assert {'id': 3, 'type': 'message'} in manager
+    with pytest.raises(KeyError):
+        manager.alloc_file({'id': 3, 'type': 'message'})
+
+    with manager.open('text', 'w') as f:
+        f.write('content')
+    assert manager.read('text') == 'content'
+    assert manager.findmark(manager['text'].name) == 'text'
+    manager.delete('text')
+    assert 'text' not in manager
+    manager.save()
+
+    loaded = StorageManager.load(str(tmp_path))
+    assert len(loaded) == 100
+    assert loaded[{'type': 'message', 'id': 99}].path == manager[{'type': 'message', 'id': 99}].path